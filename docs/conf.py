@@ -232,6 +232,7 @@ Run Control Parameters
 """
 rcdocs += summarize_rcdocs([
     'polyphemus.base',
+    'polyphemus.eventqueue',
     'polyphemus.batlabbase',
     'polyphemus.batlabrun',
     'polyphemus.batlabstat',
@@ -240,6 +241,8 @@ rcdocs += summarize_rcdocs([
     'polyphemus.githubhook',
     'polyphemus.githubstat',
     'polyphemus.github',
+    'polyphemus.dashboard',
+    'polyphemus.dashboardevents',
     'polyphemus.apache2',    
     ])
 newoverwrite(rcdocs, 'rcdocs.rst')
@@ -1,5 +1,11 @@
 """The basic functionality for BaTLab.
 
+Connections to the BaTLab submit hosts are pooled and kept alive, so that jobs 
+are submitted over an existing session rather than with a new handshake.  When
+there are several submit hosts, each job goes to the least loaded one that 
+can be reached.  The outcomes of finished jobs are remembered by the content
+of the build, see build_key(), so that identical builds are not rerun.
+
 This module is available as an polyphemus plugin by the name `polyphemus.batlabbase`.
 
 Basic BaTLaB API
@@ -8,6 +14,11 @@ Basic BaTLaB API
 from __future__ import print_function
 import os
 import sys
+import time
+import socket
+import hashlib
+import threading
+from contextlib import contextmanager
 from tempfile import NamedTemporaryFile
 import subprocess
 from warnings import warn
@@ -15,7 +26,7 @@ from getpass import getuser, getpass
 
 import paramiko
 
-from .utils import RunControl, NotSpecified, writenewonly, \
+from .utils import RunControl, NotSpecified, PersistentCache, writenewonly, \
     DEFAULT_RC_FILE, DEFAULT_PLUGINS, nyansep, indent, check_cmd
 from .plugins import Plugin
 from .base import ssh_pub_key
@@ -25,6 +36,449 @@ if sys.version_info[0] >= 3:
 
 BATLAB_SUBMIT_HOSTNAME = 'submit-1.batlab.org'
 
+def split_host(host, port=22):
+    """Splits a 'host:port' string into its host name and integer port."""
+    if ':' in host:
+        host, port = host.rsplit(':', 1)
+    return host, int(port)
+
+class SSHPool(object):
+    """A pool of persistent SSH connections, keyed by host, user, and key file.
+    Connections are kept alive and shared between threads, which each open 
+    their own channels on the same transport.  Connections are checked before
+    being handed out and are reopened if they have died or have been idle for 
+    too long.  The pool also bounds the number of jobs that are worked on 
+    concurrently on each host, see slot().
+    """
+
+    def __init__(self, keepalive=30, idle_timeout=600.0, timeout=30.0, 
+                 max_concurrent=4):
+        """Parameters
+        ----------
+        keepalive : int, optional
+            The interval, in seconds, between keep alive packets.
+        idle_timeout : float, optional
+            Connections which have not been used for this long, in seconds, are 
+            closed.  If zero or less, connections are never closed for idleness.
+        timeout : float, optional
+            The TCP connection timeout, in seconds.
+        max_concurrent : int, optional
+            The maximum number of slots that may be held on each host.
+
+        """
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.max_concurrent = max_concurrent
+        self.connects = 0
+        self._slots = {}
+        self._active = {}
+        self._clients = {}
+        self._last_used = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    def _key_lock(self, key):
+        with self._lock:
+            lock = self._key_locks.get(key, None)
+            if lock is None:
+                lock = self._key_locks[key] = threading.Lock()
+            return lock
+
+    def client(self, host, user, key_file=None, password=None):
+        """Returns a connected SSHClient from the pool, connecting if needed.
+        The client must not be closed by the caller.
+
+        Parameters
+        ----------
+        host : str
+            The host name, optionally with a port as 'host:port'.
+        user : str
+            The user name to log in with.
+        key_file : str, optional
+            The private key file to authenticate with.
+        password : str, optional
+            The password to authenticate with, if not using a key.
+
+        Raises
+        ------
+        paramiko.SSHException, socket.error
+            If the connection could not be made.
+
+        """
+        self.reap()
+        key = (host, user, key_file)
+        with self._key_lock(key):
+            client = self._clients.get(key, None)
+            if client is not None and not self._healthy(client):
+                self.discard(host, user, key_file)
+                client = None
+            if client is None:
+                client = self._connect(host, user, key_file, password)
+                with self._lock:
+                    self._clients[key] = client
+            with self._lock:
+                self._last_used[key] = time.time()
+        return client
+
+    def _connect(self, host, user, key_file, password):
+        hostname, port = split_host(host)
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(hostname, port=port, username=user, key_filename=key_file,
+                       password=password, timeout=self.timeout)
+        client.get_transport().set_keepalive(self.keepalive)
+        self.connects += 1
+        return client
+
+    def _healthy(self, client):
+        transport = client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (paramiko.SSHException, socket.error, EOFError):
+            return False
+        return True
+
+    @contextmanager
+    def slot(self, host):
+        """A context manager which blocks until fewer than max_concurrent 
+        threads are working on a host, e.g. ``with SSH_POOL.slot(host): ...``.
+        """
+        with self._lock:
+            sem = self._slots.get(host, None)
+            if sem is None:
+                sem = self._slots[host] = threading.BoundedSemaphore(
+                                                    self.max_concurrent)
+        sem.acquire()
+        with self._lock:
+            self._active[host] = self._active.get(host, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active[host] -= 1
+            sem.release()
+
+    def active(self, host):
+        """Returns the number of slots currently held on a host."""
+        with self._lock:
+            return self._active.get(host, 0)
+
+    def discard(self, host, user, key_file=None):
+        """Closes and forgets a pooled connection, e.g. after it has failed."""
+        key = (host, user, key_file)
+        with self._lock:
+            client = self._clients.pop(key, None)
+            self._last_used.pop(key, None)
+        if client is not None:
+            client.close()
+
+    def reap(self):
+        """Closes connections which have been idle for longer than the idle
+        timeout."""
+        if self.idle_timeout <= 0:
+            return
+        now = time.time()
+        with self._lock:
+            idle = [key for key, t in self._last_used.items() 
+                    if now - t > self.idle_timeout]
+        for key in idle:
+            self.discard(*key)
+
+    def close(self):
+        """Closes all pooled connections."""
+        with self._lock:
+            keys = list(self._clients.keys())
+        for key in keys:
+            self.discard(*key)
+
+SSH_POOL = SSHPool()
+"""The SSH connection pool for this process."""
+
+class HostBalancer(object):
+    """Chooses the least loaded of several BaTLab submit hosts.  The load of a
+    host is the number of jobs in its queue, as reported by a cheap command 
+    over the pooled connection, plus the number of jobs that this process is 
+    working on there.  Hosts which cannot be reached are skipped until they 
+    are probed again.
+    """
+
+    def __init__(self, pool=SSH_POOL, load_cmd='condor_q -totals', ttl=30.0):
+        """Parameters
+        ----------
+        pool : SSHPool, optional
+            The connection pool to probe hosts with.
+        load_cmd : str, optional
+            The command whose last line of output starts with the number of 
+            queued jobs, though any leading words are skipped.
+        ttl : float, optional
+            The time, in seconds, that a probed load is trusted.
+
+        """
+        self.pool = pool
+        self.load_cmd = load_cmd
+        self.ttl = ttl
+        self._loads = {}
+        self._lock = threading.Lock()
+
+    def probe(self, host, user, key_file=None):
+        """Returns the queue length of a host, zero if it could not be parsed, 
+        or None if the host could not be reached."""
+        try:
+            client = self.pool.client(host, user, key_file=key_file)
+            stdin, stdout, stderr = client.exec_command(self.load_cmd)
+            output = stdout.read()
+            stdout.channel.recv_exit_status()
+        except (paramiko.SSHException, socket.error, EOFError):
+            load = None
+        else:
+            if not isinstance(output, basestring):
+                output = output.decode('utf-8', 'replace')
+            lines = [l for l in output.splitlines() if 
+                     any([c.isdigit() for c in l])]
+            nums = [w for w in lines[-1].split() if w.isdigit()] if lines else []
+            load = int(nums[0]) if nums else 0
+        with self._lock:
+            self._loads[host] = (time.time(), load)
+        return load
+
+    def loads(self, hosts, user, key_file=None):
+        """Returns a dictionary of the queue lengths of the hosts, probing those
+        whose load is stale concurrently.  Unreachable hosts have a load of 
+        None."""
+        now = time.time()
+        with self._lock:
+            stale = [h for h in hosts if h not in self._loads or 
+                     now - self._loads[h][0] > self.ttl]
+        threads = [threading.Thread(target=self.probe, args=(h, user, key_file))
+                   for h in stale]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        with self._lock:
+            return dict([(h, self._loads[h][1]) for h in hosts])
+
+    def choose(self, hosts, user, key_file=None, prefer=None):
+        """Returns the least loaded reachable host.
+
+        Parameters
+        ----------
+        hosts : list of str
+            The candidate submit hosts.
+        user : str
+            The user name to log in with.
+        key_file : str, optional
+            The private key file to authenticate with.
+        prefer : str, optional
+            A host to use as long as it is reachable, e.g. the host that an 
+            earlier job for the same pull request was submitted to.
+
+        Raises
+        ------
+        socket.error
+            If none of the hosts can be reached.
+
+        """
+        if len(hosts) == 1 and prefer in (None, hosts[0]):
+            return hosts[0]  # nothing to choose from, let connect() fail
+        candidates = list(hosts)
+        if prefer is not None and prefer not in candidates:
+            candidates.append(prefer)
+        loads = self.loads(candidates, user, key_file=key_file)
+        if prefer is not None and loads[prefer] is not None:
+            return prefer
+        up = [(load + self.pool.active(h), i, h) for i, (h, load) in 
+              enumerate([(h, loads[h]) for h in hosts]) if load is not None]
+        if len(up) == 0:
+            raise socket.error("none of the BaTLab submit hosts {0} could be "
+                               "reached".format(", ".join(hosts)))
+        return min(up)[2]
+
+BALANCER = HostBalancer()
+"""The submit host balancer for this process."""
+
+RESULT_STATES = frozenset(['success', 'failure'])
+"""The job states which are remembered as the result of a build.  Errors are
+not, since they are usually problems with BaTLab rather than with the build."""
+
+def build_key(head_sha, base_sha, scripts_version, run_spec):
+    """Returns the key which identifies a build by its content, or None if any
+    part of it is unknown.
+
+    Parameters
+    ----------
+    head_sha : str
+        The commit hash of the head of the pull request.
+    base_sha : str
+        The commit hash of the branch that the pull request merges into.
+    scripts_version : str
+        The version of the BaTLab scripts.
+    run_spec : str
+        The contents of the run-spec file which is submitted.
+
+    """
+    parts = [head_sha, base_sha, scripts_version, run_spec]
+    if any([p is None for p in parts]):
+        return None
+    h = hashlib.sha1()
+    for p in parts:
+        h.update(p.encode('utf-8') if not isinstance(p, bytes) else p)
+        h.update(b'\0')
+    return h.hexdigest()
+
+def record_result(rc, info, data):
+    """Remembers the outcome of a finished job under its build key, if it has
+    one, so that the same build is not submitted again.
+
+    Parameters
+    ----------
+    rc : RunControl
+        The run control, which provides the results cache.
+    info : dict
+        The jobs cache entry of the job.
+    data : dict
+        The batlab-status event data of the job.
+
+    """
+    key = info.get('build_key', None)
+    if key is None or data['status'] not in RESULT_STATES:
+        return
+    result = dict([(k, data[k]) for k in ('status', 'description', 'target_url', 
+                                           'gid') if data.get(k, None)])
+    result.setdefault('target_url', info.get('report_url', ''))
+    result.setdefault('gid', info.get('gid', None))
+    result['time'] = time.time()
+    results = PersistentCache(cachefile=rc.batlab_results_cache)
+    results[key] = result
+
+STEP_MARKER = '@@polyphemus'
+"""The prefix of the lines that delimit the steps of a remote script."""
+
+TASK_MARKER = STEP_MARKER + ' task'
+"""The prefix of the timing records which BaTLab tasks print, see
+polyphemus.batlabstat for their format."""
+
+TIMED_TASKS = ('pre_all', 'remote_pre_declare', 'remote_declare', 'remote_pre',
+               'remote_task', 'remote_post', 'platform_pre', 'platform_post')
+"""The BaTLab tasks which are wrapped so that they print timing records.  The
+post_all task sends the records back and so is not timed itself."""
+
+script_step_template = """{name}() {{
+{body}
+}}
+"""
+
+script_template = """exec 2>&1
+step() {{
+    echo "{marker} begin $1"
+    "$1"
+    rc=$?
+    echo "{marker} end $1 $rc"
+    [ $rc -eq 0 ] || exit $rc
+}}
+{preamble}
+{functions}
+{calls}
+"""
+
+def build_script(steps, preamble=''):
+    """Builds a bash script which runs a sequence of steps, stopping at the 
+    first step that fails.  The output of every step is delimited by marker
+    lines so that it may be parsed with parse_steps().
+
+    Parameters
+    ----------
+    steps : list of (str, str) tuples
+        The name and body of each step.  Names must be valid bash function 
+        names.
+    preamble : str, optional
+        Commands, such as variable assignments, to run before the steps.
+
+    """
+    functions = "".join([script_step_template.format(name=name, body=body) 
+                         for name, body in steps])
+    calls = "\n".join(["step " + name for name, body in steps])
+    return script_template.format(marker=STEP_MARKER, preamble=preamble, 
+                                  functions=functions, calls=calls)
+
+class StepResult(object):
+    """The outcome of a single step of a remote script."""
+
+    __slots__ = ('name', 'status', 'output')
+
+    def __init__(self, name, status=None, output=''):
+        """Parameters
+        ----------
+        name : str
+            The step name.
+        status : int or None, optional
+            The exit status of the step, or None if the step did not finish.
+        output : str, optional
+            The combined stdout and stderr of the step.
+
+        """
+        self.name = name
+        self.status = status
+        self.output = output
+
+    @property
+    def ok(self):
+        return self.status == 0
+
+    def __repr__(self):
+        return "{0}({1!r}, status={2!r})".format(self.__class__.__name__, 
+                                                 self.name, self.status)
+
+def parse_steps(output):
+    """Parses the output of a script from build_script() into a list of 
+    StepResults, in the order that the steps were run."""
+    if not isinstance(output, basestring):
+        output = output.decode('utf-8', 'replace')
+    steps = []
+    current = None
+    for line in output.splitlines():
+        if not line.startswith(STEP_MARKER):
+            if current is not None:
+                current.output += line + '\n'
+            continue
+        fields = line.split()
+        if fields[1] == 'begin':
+            current = StepResult(fields[2])
+            steps.append(current)
+        elif fields[1] == 'end' and current is not None:
+            current.status = int(fields[3])
+            current = None
+    return steps
+
+def run_script(client, script):
+    """Runs a script on a remote host in a single invocation.
+
+    Parameters
+    ----------
+    client : paramiko.SSHClient
+        A connected client.
+    script : str
+        The bash script, as from build_script().
+
+    Returns
+    -------
+    steps : list of StepResults
+        The results of the steps that were started.
+
+    """
+    stdin, stdout, stderr = client.exec_command('bash -s')
+    stdin.write(script)
+    stdin.flush()
+    stdin.channel.shutdown_write()
+    output = stdout.read()
+    stdout.channel.recv_exit_status()
+    return parse_steps(output)
+
+
 class PolyphemusPlugin(Plugin):
     """This class provides basic BaTLab functionality."""
 
@@ -32,16 +486,60 @@ class PolyphemusPlugin(Plugin):
 
     defaultrc = RunControl(
         batlab_user=NotSpecified,
+        batlab_ssh_keepalive=30,
+        batlab_ssh_idle_timeout=600.0,
+        batlab_max_concurrent=4,
+        batlab_submit_hosts=[BATLAB_SUBMIT_HOSTNAME],
+        batlab_load_cmd='condor_q -totals',
+        batlab_load_ttl=30.0,
+        batlab_results_cache='results.cache',
         )
 
     rcdocs = {
         'batlab_user': ("The BaTLab user name to login with.  Must have rights "
                         "on the submit node."),
+        'batlab_ssh_keepalive': ("The interval, in seconds, between keep alive "
+                                 "packets on pooled BaTLab SSH connections."),
+        'batlab_ssh_idle_timeout': ("The time, in seconds, after which an unused "
+                                    "pooled BaTLab SSH connection is closed.  If "
+                                    "zero or less, connections are kept open."),
+        'batlab_max_concurrent': ("The maximum number of jobs that are prepared "
+                                  "and submitted concurrently on a BaTLab submit "
+                                  "host.  Jobs are handled by the event workers, "
+                                  "see event_workers."),
+        'batlab_submit_hosts': ("The BaTLab submit hosts, optionally as 'host:port'. "
+                                "Each job is submitted to the least loaded host "
+                                "which can be reached."),
+        'batlab_load_cmd': ("The command on a submit host whose output ends with "
+                            "a line giving the number of queued jobs first, "
+                            "which is used as the load of the host."),
+        'batlab_load_ttl': ("The time, in seconds, that the load of a submit host "
+                            "is trusted before it is probed again."),
+        'batlab_results_cache': ("The cache file of the outcomes of finished BaTLab "
+                                 "jobs, keyed by the head and base commits, the "
+                                 "scripts version, and the run-spec.  Identical "
+                                 "builds reuse these rather than being rerun."),
         }
 
     def update_argparser(self, parser):
         parser.add_argument('--batlab-user', dest='batlab_user',
                             help=self.rcdocs["batlab_user"])
+        parser.add_argument('--batlab-ssh-keepalive', dest='batlab_ssh_keepalive',
+                            type=int, help=self.rcdocs["batlab_ssh_keepalive"])
+        parser.add_argument('--batlab-ssh-idle-timeout', 
+                            dest='batlab_ssh_idle_timeout', type=float, 
+                            help=self.rcdocs["batlab_ssh_idle_timeout"])
+        parser.add_argument('--batlab-max-concurrent', dest='batlab_max_concurrent',
+                            type=int, help=self.rcdocs["batlab_max_concurrent"])
+        parser.add_argument('--batlab-submit-hosts', nargs='+', 
+                            dest='batlab_submit_hosts', 
+                            help=self.rcdocs["batlab_submit_hosts"])
+        parser.add_argument('--batlab-load-cmd', dest='batlab_load_cmd',
+                            help=self.rcdocs["batlab_load_cmd"])
+        parser.add_argument('--batlab-load-ttl', dest='batlab_load_ttl', 
+                            type=float, help=self.rcdocs["batlab_load_ttl"])
+        parser.add_argument('--batlab-results-cache', dest='batlab_results_cache',
+                            help=self.rcdocs["batlab_results_cache"])
 
     def setup(self, rc):
         if rc.batlab_user is NotSpecified:
@@ -49,27 +547,33 @@ class PolyphemusPlugin(Plugin):
             print("batlab username not specified, found {0!r}".format(user))
             rc.batlab_user = user
 
-        # make sure that we can authenticate in the future with SSH public keys
-        key = paramiko.RSAKey(filename=rc.ssh_key_file)
-        client = paramiko.SSHClient()
-        client.load_system_host_keys()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        #client.get_host_keys().add(BATLAB_SUBMIT_HOSTNAME, 'ssh-rsa', key)
+        SSH_POOL.keepalive = rc.batlab_ssh_keepalive
+        SSH_POOL.idle_timeout = rc.batlab_ssh_idle_timeout
+        SSH_POOL.max_concurrent = rc.batlab_max_concurrent
+
+        BALANCER.load_cmd = rc.batlab_load_cmd
+        BALANCER.ttl = rc.batlab_load_ttl
+        for host in rc.batlab_submit_hosts:
+            try:
+                self._ensure_key_auth(rc, host)
+            except (paramiko.SSHException, socket.error) as e:
+                warn("could not connect to BaTLab submit host {0}: {1}".format(
+                     host, e), RuntimeWarning)
+
+    def _ensure_key_auth(self, rc, host):
+        """Makes sure that we can authenticate in the future with SSH public keys."""
         try:
-            client.connect(BATLAB_SUBMIT_HOSTNAME, username=rc.batlab_user, 
-                           key_filename=rc.ssh_key_file)
-            client.close()
+            SSH_POOL.client(host, rc.batlab_user, key_file=rc.ssh_key_file)
             can_connect = True
         except paramiko.AuthenticationException:
             can_connect = False
-        except paramiko.BadHostKeyException:
-            import pdb; pdb.set_trace()
+        except paramiko.BadHostKeyException as e:
+            warn("bad host key for {0}: {1}".format(host, e), RuntimeWarning)
             can_connect = False
         if not can_connect:
             password = False
             while not password:
-                password = getpass("{0}@{1} password: ".format(rc.batlab_user, 
-                                                        BATLAB_SUBMIT_HOSTNAME))
+                password = getpass("{0}@{1} password: ".format(rc.batlab_user, host))
             pub = ssh_pub_key(rc.ssh_key_file)
             cmds = ["mkdir -p ~/.ssh",
                 'echo "{0}" >> ~/.ssh/authorized_keys'.format(pub),
@@ -77,14 +581,14 @@ class PolyphemusPlugin(Plugin):
                 'chmod a-x ~/.ssh/authorized_keys',
                 'chmod 700 ~/.ssh',
                 ]
-            client.connect(BATLAB_SUBMIT_HOSTNAME, username=rc.batlab_user, 
-                           password=password)
+            client = SSH_POOL.client(host, rc.batlab_user, password=password)
             for cmd in cmds:
                 stdin, stdout, stderr = client.exec_command(cmd)
-            client.close()
-            # verify thatthis key works
-            client.connect(BATLAB_SUBMIT_HOSTNAME, username=rc.batlab_user, 
-                           key_filename=rc.ssh_key_file)
-            client.close()
+                stdout.channel.recv_exit_status()
+            SSH_POOL.discard(host, rc.batlab_user)
+            # verify that this key works, the connection is kept for later use
+            SSH_POOL.client(host, rc.batlab_user, key_file=rc.ssh_key_file)
             print("finished connecting")
-        client.close()  # Just to be safe
+
+    def teardown(self, rc):
+        SSH_POOL.close()
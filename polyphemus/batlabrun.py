@@ -1,5 +1,10 @@
 """The plug in to run on batlab.
 
+Before a job is submitted, the outcome of an identical earlier build, one with
+the same head and base commits, scripts version, and run-spec, is looked up in
+the results cache.  If there is one it is reported again rather than spending
+BaTLab time on rebuilding it.
+
 This module is available as an polyphemus plugin by the name ``polyphemus.batlabrun``.
 
 BaTLaB Plugin API
@@ -7,21 +12,35 @@ BaTLaB Plugin API
 """
 from __future__ import print_function
 import os
+import io
 import sys
+import time
 import socket
-import subprocess
+import shutil
+import hashlib
+import tarfile
+import zipfile
+import tempfile
+import threading
+import uuid
 from warnings import warn
 
-import github3
 import paramiko
 
-from .utils import RunControl, NotSpecified, PersistentCache
+from .utils import RunControl, NotSpecified, PersistentCache, check_cmd
 from .plugins import Plugin
 from .event import Event, runfor
-from .batlabbase import BATLAB_SUBMIT_HOSTNAME
+from .batlabbase import BATLAB_SUBMIT_HOSTNAME, SSH_POOL, BALANCER, build_script, \
+    run_script, build_key, TASK_MARKER, TIMED_TASKS
 
 if sys.version_info[0] >= 3:
     basestring = str
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+    from shlex import quote
+else:
+    from urllib2 import urlopen, Request, HTTPError
+    from pipes import quote
 
 git_fetch_template = \
 """method = git
@@ -29,26 +48,32 @@ git_repo = {repo_url}
 git_path = {repo_dir};cd {repo_dir};git checkout {branch}
 """
 
-pre_curl_template = r"""# polyphemus pre_all callback
-curl --form status='{{\"status\":\"pending\",\"number\":{number},\"description\":\"build and test initialized\"}}' {server_url}:{port}/batlabstatus
+pre_curl_template = """# polyphemus pre_all callback
+curl --form status='{{"status":"pending","number":{number},"token":"{token}","description":"build and test initialized"}}' {server_url}:{port}/batlabstatus
 """
 
-post_curl_template = r"""# polyphemus post_all callbacks
-val0=\`grep \"return value 0\" ../../run.log | wc -l\`
-valAny=\`grep \"return value\" ../../run.log | wc -l\`
+post_curl_template = """# polyphemus post_all callbacks
+val0=`grep "return value 0" ../../run.log | wc -l`
+valAny=`grep "return value" ../../run.log | wc -l`
+# the timing records of the tasks are sent along as telemetry
+grep -rhI --exclude=polyphemus-telemetry.log "^{marker} " ../.. | sort -u | \
+    tail -n 2000 > polyphemus-telemetry.log
 
-if [ \$val0 == \$valAny ]
+if [ $val0 == $valAny ]
 then
-    curl --form status='{{\"status\":\"success\",\"number\":{number},\"description\":\"build and test completed successfully\"}}' {server_url}:{port}/batlabstatus
+    curl --form status='{{"status":"success","number":{number},"token":"{token}","description":"build and test completed successfully"}}' --form "telemetry=<polyphemus-telemetry.log" {server_url}:{port}/batlabstatus
 else
-    curl --form status='{{\"status\":\"failure\",\"number\":{number},\"description\":\"build and test failed\"}}' {server_url}:{port}/batlabstatus
+    curl --form status='{{"status":"failure","number":{number},"token":"{token}","description":"build and test failed"}}' --form "telemetry=<polyphemus-telemetry.log" {server_url}:{port}/batlabstatus
 fi
 """
 
-unzip_cmds_template = \
-"""curl -L -o batlab_scripts.zip {batlab_scripts_url};
-unzip -d {jobdir} batlab_scripts.zip;
-rm batlab_scripts.zip;
+timed_task_template = """#!/bin/bash
+# polyphemus timing wrapper, runs the {task} task and records its timing
+start=`date +%s`
+"`dirname "$0"`/{script}" "$@"
+ret=$?
+echo "{marker} ${{NMI_PLATFORM:-local}} {task} $start `date +%s` $ret"
+exit $ret
 """
 
 jobdir_scp_template = \
@@ -57,6 +82,133 @@ scp_file = {jobdir}/*
 recursive = true
 """
 
+prep_preamble_template = """jobdir={jobdir}
+tarball={tarball}
+scripts={scripts}
+scripts_tarball={scripts_tarball}
+"""
+
+prep_kill_template = """    local gid={gid}
+    {kill_cmd} "$gid" || echo "job $gid could not be killed, it may have finished\""""
+
+prep_scripts_template = """    local tmp="$scripts.tmp.$$"
+    mkdir -p "$tmp" || return 1
+    tar -xzf "$scripts_tarball" -C "$tmp" || return 1
+    rm -f "$scripts_tarball"
+    # another job may have installed this version concurrently
+    mv -T "$tmp" "$scripts" 2>/dev/null || rm -rf "$tmp"
+    find "$(dirname "$scripts")" -mindepth 1 -maxdepth 1 -type d \\
+         -mtime +{keep_days} -exec rm -rf {{}} +"""
+
+prep_unpack_template = """    rm -rf "$jobdir" || return 1
+    touch "$scripts"
+    cp -al "$scripts" "$jobdir" || return 1
+    # tar replaces existing files rather than writing through them, so the
+    # hardlinked scripts are never modified
+    tar -xzf "$tarball" -C "$jobdir" || return 1
+    rm -f "$tarball\""""
+
+prep_errors = {
+    'kill_job': "Error killing existing BaTLab job.",
+    'install_scripts': "Error installing BaTLab scripts.",
+    'unpack_job': "Error unpacking the BaTLab job directory.",
+    }
+"""Descriptions of the failures of each remote job preparation step."""
+
+class ScriptsCache(object):
+    """A local copy of the BaTLab scripts at batlab_scripts_url, which is 
+    refreshed once it is older than a time to live.  Git repositories are 
+    cloned once and then fetched.  Zip files are downloaded conditionally on
+    their ETag and unpacked.
+    """
+
+    def __init__(self, url, cachedir, ttl=300.0):
+        """Parameters
+        ----------
+        url : str
+            The URL of the scripts, ending in '.git' or '.zip'.
+        cachedir : str
+            The local directory to keep the scripts in.
+        ttl : float, optional
+            The time, in seconds, before the scripts are checked for changes.
+
+        """
+        self.url = url
+        self.cachedir = os.path.abspath(cachedir)
+        self.ttl = ttl
+        self.version = None
+        self.refreshed = None
+        self._root = None
+        self._etag = None
+        self._lock = threading.Lock()
+
+    def path(self):
+        """Returns the local directory holding the scripts, refreshing it first
+        if it is stale.
+
+        Raises
+        ------
+        RuntimeError, IOError, OSError
+            If the scripts could not be fetched.
+
+        """
+        with self._lock:
+            now = time.time()
+            if self._root is None or now - self.refreshed > self.ttl:
+                if not os.path.isdir(self.cachedir):
+                    os.makedirs(self.cachedir)
+                if self.url.endswith('.git'):
+                    self._refresh_git()
+                else:
+                    self._refresh_zip()
+                self.refreshed = now
+            return self._root
+
+    def _git(self, *args):
+        rtn, out = check_cmd(('git',) + args)
+        if rtn != 0:
+            raise RuntimeError("git {0} failed:\n{1}".format(args[0], out))
+        return out
+
+    def _refresh_git(self):
+        repo = os.path.join(self.cachedir, 'repo')
+        if os.path.isdir(os.path.join(repo, '.git')):
+            self._git('-C', repo, 'fetch', '--quiet', self.url)
+            self._git('-C', repo, 'reset', '--quiet', '--hard', 'FETCH_HEAD')
+        else:
+            self._git('clone', '--quiet', self.url, repo)
+        rtn, out = check_cmd(['git', '-C', repo, 'rev-parse', 'HEAD'])
+        self.version = out.decode().strip() if rtn == 0 else None
+        self._root = repo
+
+    def _refresh_zip(self):
+        unpacked = os.path.join(self.cachedir, 'zip')
+        req = Request(self.url)
+        if self._etag is not None and os.path.isdir(unpacked):
+            req.add_header('If-None-Match', self._etag)
+        try:
+            resp = urlopen(req)
+        except HTTPError as e:
+            if e.code == 304:
+                return
+            raise
+        data = resp.read()
+        self._etag = resp.info().get('ETag', None)
+        self.version = hashlib.sha1(data).hexdigest()
+        tmp = unpacked + '.tmp'
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            zf.extractall(tmp)
+        if os.path.isdir(unpacked):
+            shutil.rmtree(unpacked)
+        os.rename(tmp, unpacked)
+        ls = os.listdir(unpacked)
+        if len(ls) == 1 and os.path.isdir(os.path.join(unpacked, ls[0])):
+            # the zip has a single top-level directory holding the scripts
+            unpacked = os.path.join(unpacked, ls[0])
+        self._root = unpacked
+
 def _find_startswith(x, s):
     """Finds the index of a sequence that starts with s or returns -1.
     """
@@ -65,38 +217,189 @@ def _find_startswith(x, s):
             return i
     return -1
 
-def _ensure_task_script(task, run_spec_lines, run_spec_path, jobdir, client):
+def _stage_file(scriptsdir, stagedir, relpath):
+    """Copies a file of the scripts, if it exists, into the staging directory
+    so that it may be modified.  Returns the staged path."""
+    src = os.path.join(scriptsdir, relpath)
+    dst = os.path.join(stagedir, relpath)
+    if not os.path.isdir(os.path.dirname(dst)):
+        os.makedirs(os.path.dirname(dst))
+    if os.path.isfile(src) and not os.path.isfile(dst):
+        shutil.copy2(src, dst)
+    return dst
+
+def _ensure_task_script(task, run_spec_lines, scriptsdir, stagedir):
     i = _find_startswith(run_spec_lines, task)
     if i >= 0:
         task_file = run_spec_lines[i].split('=', 1)[1].strip()
     else:
         task_file = '{0}.sh'.format(task)
-        cmd = "echo '#!/bin/bash' > {0}/{1}".format(jobdir, task_file)
-        stdin, stdout, sterr = client.exec_command(cmd)
-        stdout.channel.recv_exit_status()
-        cmd = 'chmod 755 {0}/{1}'.format(jobdir, task_file)
-        stdin, stdout, sterr = client.exec_command(cmd)
-        stdout.channel.recv_exit_status()
-        cmd = 'echo "{0} = {1}" >> {2}/{3}'.format(task, task_file, 
-                                                   jobdir, run_spec_path)
-        stdin, stdout, sterr = client.exec_command(cmd)
-        stdout.channel.recv_exit_status()
-    return task_file
-
-def _ensure_runspec_option(option, run_spec_lines, run_spec_path, jobdir, client, value):
+        run_spec_lines.append("{0} = {1}".format(task, task_file))
+    path = _stage_file(scriptsdir, stagedir, task_file)
+    if not os.path.isfile(path):
+        with io.open(path, 'w') as f:
+            f.write(u'#!/bin/bash\n')
+        os.chmod(path, 0o755)
+    return path
+
+def _ensure_runspec_option(option, run_spec_lines, value):
     i = _find_startswith(run_spec_lines, option)
-    if i >= 0:
-        old_val = run_spec_lines[i].split('=', 1)[1].strip()
-        if old_val != value:
-            cmd = "sed -i -e 's/{0}/{1}={2}/g' {3}/{4}".format(
-                            run_spec_lines[i], option, value, jobdir, run_spec_path)
-            stdin, stdout, sterr = client.exec_command(cmd)
-            stdout.channel.recv_exit_status()
+    if i < 0:
+        run_spec_lines.append("{0} = {1}".format(option, value))
+    elif run_spec_lines[i].split('=', 1)[-1].strip() != value:
+        run_spec_lines[i] = "{0} = {1}".format(option, value)
+
+def _time_tasks(run_spec_lines, specdir):
+    """Points the timed tasks of the run-spec at wrappers which run the
+    original task script and then print its timing record."""
+    for i, line in enumerate(run_spec_lines):
+        task, _, script = line.partition('=')
+        task, script = task.strip(), script.strip()
+        if task not in TIMED_TASKS or len(script) == 0:
+            continue
+        wrapper = 'polyphemus-{0}.sh'.format(task)
+        path = os.path.join(specdir, wrapper)
+        with io.open(path, 'w') as f:
+            f.write(u'' + timed_task_template.format(task=task, script=script, 
+                                                     marker=TASK_MARKER))
+        os.chmod(path, 0o755)
+        run_spec_lines[i] = "{0} = {1}".format(task, wrapper)
+
+def _append(path, s):
+    with io.open(path, 'a') as f:
+        f.write(u'' + s)
+
+def stage_job(rc, pr, scriptsdir, stagedir, jobdir, token=''):
+    """Renders the files of a BaTLab job which differ from the scripts: the 
+    fetch file points at the head of the pull request, the pre_all and 
+    post_all tasks call back to polyphemus, the other tasks are wrapped so 
+    that they report their timing, and the job directory itself is
+    added to the run-spec inputs.  Only these files are written to the staging
+    directory, they are laid over a copy of the scripts on the submit host.
+
+    Parameters
+    ----------
+    rc : RunControl
+        The run control.
+    pr : PullRequestInfo
+        The pull request to test.
+    scriptsdir : str
+        The local copy of the BaTLab scripts.
+    stagedir : str
+        The directory to render the job files into.
+    jobdir : str
+        The absolute path that the job directory will have on the submit host.
+    token : str, optional
+        The token of this submission, which the callbacks send back so that
+        they may be told apart from those of earlier jobs.
+
+    Raises
+    ------
+    ValueError
+        If the run-spec has no inputs.
+
+    """
+    # Overwrite fetch file
+    fetch = git_fetch_template.format(repo_url=pr.head.clone_url,
+                                      repo_dir=pr.base.repo[1], branch=pr.head.ref)
+    fetch_path = _stage_file(scriptsdir, stagedir, rc.batlab_fetch_file)
+    with io.open(fetch_path, 'w') as f:
+        f.write(u'' + fetch)
+
+    # append callbacks to run spec
+    run_spec_path = _stage_file(scriptsdir, stagedir, rc.batlab_run_spec)
+    with io.open(run_spec_path, 'r') as f:
+        run_spec_lines = [l.strip() for l in f.readlines()]
+    append = ', <a href="{0}/dashboard">{1}</a>'.format(rc.server_url, 
+                                                        "Polyphemus Dashboard")
+    run_spec_lines = [
+        (l + append if l.split('=')[0].strip() == "description" else l) 
+        for l in run_spec_lines
+        ]
+    pre_file = _ensure_task_script('pre_all', run_spec_lines, scriptsdir, stagedir)
+    _append(pre_file, pre_curl_template.format(number=pr.number, port=rc.port, 
+                                               server_url=rc.server_url, 
+                                               token=token))
+    post_file = _ensure_task_script('post_all', run_spec_lines, scriptsdir, 
+                                    stagedir)
+    _ensure_runspec_option('always_run_post_all', run_spec_lines, 'true')
+    _append(post_file, post_curl_template.format(number=pr.number, port=rc.port, 
+                                                 server_url=rc.server_url, 
+                                                 marker=TASK_MARKER, token=token))
+    _time_tasks(run_spec_lines, os.path.dirname(run_spec_path))
+
+    # create scp for jobdir and add it to the inputs
+    _append(_stage_file(scriptsdir, stagedir, 'jobdir.scp'), 
+            jobdir_scp_template.format(jobdir=jobdir))
+    i = _find_startswith(run_spec_lines, 'inputs')
+    if i < 0:
+        raise ValueError("run-spec {0!r} has no inputs".format(rc.batlab_run_spec))
+    if len(run_spec_lines[i].split('=', 1)[-1].strip()) > 0:
+        run_spec_lines[i] += ',jobdir.scp'
     else:
-        cmd = 'echo "{0} = {1}" >> {2}/{3}'.format(option, value,
-                                                   jobdir, run_spec_path)
-        stdin, stdout, sterr = client.exec_command(cmd)
-        stdout.channel.recv_exit_status()
+        run_spec_lines[i] = 'inputs = jobdir.scp'
+    with io.open(run_spec_path, 'w') as f:
+        f.write(u'\n'.join(run_spec_lines) + u'\n')
+
+def upload_tree(sftp, localdir, remotefile):
+    """Streams a directory to a remote file as a gzipped tarball over SFTP.
+
+    Parameters
+    ----------
+    sftp : paramiko.SFTPClient
+        An open SFTP session.
+    localdir : str
+        The directory to upload, its contents are at the root of the tarball.
+    remotefile : str
+        The path of the tarball on the remote host.
+
+    """
+    skipgit = lambda info: None if os.path.basename(info.name) == '.git' else info
+    f = sftp.open(remotefile, 'wb')
+    try:
+        f.set_pipelined(True)
+        tar = tarfile.open(fileobj=f, mode='w|gz')
+        try:
+            tar.add(localdir, arcname='.', filter=skipgit)
+        finally:
+            tar.close()
+    finally:
+        f.close()
+
+def job_prep_script(rc, jobdir, tarball, scripts, scripts_tarball=None, gid=None):
+    """Builds the script which creates a BaTLab job directory in a single remote
+    invocation.  The job directory is a hardlinked copy of the scripts, which
+    are kept on the submit host per version, with the uploaded job files laid
+    over it.
+
+    Parameters
+    ----------
+    rc : RunControl
+        The run control.
+    jobdir : str
+        The job directory on the submit host.
+    tarball : str
+        The uploaded tarball of the job files on the submit host.
+    scripts : str
+        The directory of this version of the scripts on the submit host.
+    scripts_tarball : str, optional
+        The uploaded tarball of the scripts, if they must be installed first.
+    gid : str, optional
+        The id of an existing job to kill first.
+
+    """
+    steps = []
+    if gid is not None:
+        steps.append(('kill_job', prep_kill_template.format(
+                                    kill_cmd=rc.batlab_kill_cmd, gid=quote(gid))))
+    if scripts_tarball is not None:
+        steps.append(('install_scripts', prep_scripts_template.format(
+                            keep_days=rc.batlab_remote_scripts_days)))
+    steps.append(('unpack_job', prep_unpack_template))
+    preamble = prep_preamble_template.format(jobdir=quote(jobdir), 
+                    tarball=quote(tarball), scripts=quote(scripts), 
+                    scripts_tarball=quote(scripts_tarball or ''))
+    return build_script(steps, preamble=preamble)
 
 class PolyphemusPlugin(Plugin):
     """This class provides functionality for running batlab."""
@@ -110,6 +413,10 @@ class PolyphemusPlugin(Plugin):
         batlab_scripts_url=NotSpecified,
         batlab_fetch_file=NotSpecified,
         batlab_run_spec=NotSpecified,
+        batlab_scripts_cache='batlab-scripts',
+        batlab_scripts_ttl=300.0,
+        batlab_remote_scripts_cache='.polyphemus/scripts',
+        batlab_remote_scripts_days=7,
         )
 
     rcdocs = {
@@ -128,6 +435,18 @@ class PolyphemusPlugin(Plugin):
         'batlab_run_spec': ("The top level *.run-spec file that is submitted to "
                             "BaTLab. This should be a relative path from "
                             "the base of the batlab_scripts_url dir."),
+        'batlab_scripts_cache': ("The local directory where a copy of the BaTLab "
+                                 "scripts is kept.  Jobs are rendered from this "
+                                 "copy and uploaded to BaTLab."),
+        'batlab_scripts_ttl': ("The time, in seconds, after which the local copy "
+                               "of the BaTLab scripts is checked for changes."),
+        'batlab_remote_scripts_cache': ("The directory on the submit host, relative "
+                                        "to the home directory, where each version "
+                                        "of the BaTLab scripts is kept.  Job "
+                                        "directories are hardlinked copies of it."),
+        'batlab_remote_scripts_days': ("Versions of the BaTLab scripts on the submit "
+                                       "host which have not been used for this many "
+                                       "days are removed."),
         }
 
     def update_argparser(self, parser):
@@ -143,6 +462,16 @@ class PolyphemusPlugin(Plugin):
                             help=self.rcdocs["batlab_fetch_file"])
         parser.add_argument('--batlab-run-spec', dest='batlab_run_spec',
                             help=self.rcdocs["batlab_run_spec"])
+        parser.add_argument('--batlab-scripts-cache', dest='batlab_scripts_cache',
+                            help=self.rcdocs["batlab_scripts_cache"])
+        parser.add_argument('--batlab-scripts-ttl', dest='batlab_scripts_ttl',
+                            type=float, help=self.rcdocs["batlab_scripts_ttl"])
+        parser.add_argument('--batlab-remote-scripts-cache', 
+                            dest='batlab_remote_scripts_cache',
+                            help=self.rcdocs["batlab_remote_scripts_cache"])
+        parser.add_argument('--batlab-remote-scripts-days', 
+                            dest='batlab_remote_scripts_days', type=int,
+                            help=self.rcdocs["batlab_remote_scripts_days"])
 
     def setup(self, rc):
         if rc.batlab_scripts_url is NotSpecified:
@@ -155,159 +484,190 @@ class PolyphemusPlugin(Plugin):
             raise ValueError('batlab_fetch_file must be provided!')
         if rc.batlab_run_spec is NotSpecified:
             raise ValueError('batlab_run_spec must be provided!')
-    
+        self._scripts = ScriptsCache(rc.batlab_scripts_url, rc.batlab_scripts_cache,
+                                     ttl=rc.batlab_scripts_ttl)
+        self._remote_scripts = set()
+
+    def _upload_job(self, rc, client, host, pr, jobname, token=''):
+        """Renders the job files locally and uploads them, along with the 
+        scripts if the submit host does not have this version yet.  Returns
+        the remote job directory, job tarball, scripts directory, and scripts
+        tarball, which is None if the scripts are already there."""
+        stagedir = tempfile.mkdtemp(prefix='polyphemus-')
+        sftp = client.open_sftp()
+        try:
+            scriptsdir = self._scripts.path()
+            if self._scripts.version is None:
+                raise RuntimeError("the version of the BaTLab scripts is unknown")
+            home = sftp.normalize('.')
+            jobdir = home + '/' + jobname
+            tarball = jobdir + '.tar.gz'
+            scripts = '/'.join([home, rc.batlab_remote_scripts_cache, 
+                                self._scripts.version])
+            scripts_tarball = None
+            if (host, scripts) not in self._remote_scripts:
+                try:
+                    sftp.stat(scripts)
+                    self._remote_scripts.add((host, scripts))
+                except IOError:
+                    # one tarball per job, concurrent jobs may both upload
+                    scripts_tarball = home + '/.polyphemus-scripts-{0}--{1}.tar.gz'\
+                                      .format(self._scripts.version, jobname)
+                    upload_tree(sftp, scriptsdir, scripts_tarball)
+            stage_job(rc, pr, scriptsdir, stagedir, jobdir, token=token)
+            upload_tree(sftp, stagedir, tarball)
+        finally:
+            sftp.close()
+            shutil.rmtree(stagedir)
+        return jobdir, tarball, scripts, scripts_tarball
+
+    def _build_key(self, rc, pr):
+        """Returns the build key of a pull request, or None if it is unknown."""
+        try:
+            scriptsdir = self._scripts.path()
+            with io.open(os.path.join(scriptsdir, rc.batlab_run_spec), 'r') as f:
+                run_spec = f.read()
+        except (RuntimeError, IOError, OSError):
+            return None
+        return build_key(pr.head.sha, pr.base.sha, self._scripts.version, run_spec)
+
+    def _kill_job(self, rc, info):
+        """Kills a job on the submit host that it was submitted to, given its 
+        jobs cache entry.  Returns whether the kill command succeeded."""
+        host = info.get('host', BATLAB_SUBMIT_HOSTNAME)
+        cmd = "{0} {1}".format(rc.batlab_kill_cmd, quote(info['gid']))
+        try:
+            client = SSH_POOL.client(host, rc.batlab_user, key_file=rc.ssh_key_file)
+            _, stdout, _ = client.exec_command(cmd)
+            return stdout.channel.recv_exit_status() == 0
+        except (paramiko.SSHException, socket.error) as e:
+            warn("could not kill BaTLab job {0} on {1}: {2}".format(info['gid'], 
+                 host, e), RuntimeWarning)
+            return False
+
+    def _reuse_result(self, rc, jobs, job, key, result):
+        """Reports the outcome of an identical earlier build, killing any other
+        job which is still running for the pull request."""
+        if job in jobs and jobs[job].get('build_key', None) != key:
+            self._kill_job(rc, jobs[job])
+            del jobs[job]
+        desc = result.get('description', None) or "BaTLab job finished."
+        rc.event.data.update(status=result['status'], 
+            description=desc + " (reused from an identical build)",
+            target_url=result.get('target_url', ''), gid=result.get('gid', None))
+        if rc.verbose:
+            print("reusing BaTLab result for build {0}: {1}".format(key, 
+                                                                   result['status']))
+
     @runfor('batlab-run', 'github-pr-new', 'github-pr-sync')
     def execute(self, rc):
-        event_name = rc.event.name
+        origin = rc.event
         pr = rc.event.data  # pull request object
-        #job = pr.repository + (pr.number,)  # job key (owner, repo, number) 
-        job = pr.base.repo + (pr.number,)  # job key (owner, repo, number) 
-        #jobdir = "${HOME}/" + "--".join(pr.repository + (str(pr.number),))
-        jobdir = "${HOME}/" + "--".join(pr.base.repo + (str(pr.number),))
         jobs = PersistentCache(cachefile=rc.batlab_jobs_cache)
         event = rc.event = Event(name='batlab-status', data={'status': 'error', 
                                  'number': pr.number, 'description': ''})
-        # connect to batlab
-        key = paramiko.RSAKey(filename=rc.ssh_key_file)
-        client = paramiko.SSHClient()
-        client.load_system_host_keys()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        #client.get_host_keys().add(BATLAB_SUBMIT_HOSTNAME, 'ssh-rsa', key)
+        job = pr.base.repo + (pr.number,)
+        # report the outcome of an identical build rather than rerunning it
+        key = self._build_key(rc, pr)
+        if key is not None and job in jobs and \
+           jobs[job].get('build_key', None) == key:
+            # finished jobs leave the cache, so this build is still running
+            info = jobs[job]
+            event.data.update(status='pending', target_url=info['report_url'], 
+                              description="BaTLab job already running.", 
+                              gid=info['gid'])
+            return
+        if key is not None and not origin.cancelled:
+            results = PersistentCache(cachefile=rc.batlab_results_cache)
+            if key in results:
+                self._reuse_result(rc, jobs, job, key, results[key])
+                return
+        # connect to the least loaded submit host, reusing a pooled connection.
+        # Jobs for a pull request stay on one host so that old jobs may be killed.
+        prefer = jobs[job].get('host', BATLAB_SUBMIT_HOSTNAME) if job in jobs \
+                 else None
         try:
-            client.connect(BATLAB_SUBMIT_HOSTNAME, username=rc.batlab_user,
-                           key_filename=rc.ssh_key_file)
+            host = BALANCER.choose(rc.batlab_submit_hosts, rc.batlab_user,
+                                   key_file=rc.ssh_key_file, prefer=prefer)
+            client = SSH_POOL.client(host, rc.batlab_user, key_file=rc.ssh_key_file)
         except (paramiko.BadHostKeyException, paramiko.AuthenticationException, 
                 paramiko.SSHException, socket.error):
             msg = 'Error connecting to BaTLab.'
             warn(msg, RuntimeWarning)
             event.data['description'] = msg
             return
-        # if sync event, kill an existing job.
-        if event_name == 'github-pr-sync' and job in jobs:
-            try:
-                cmd = rc.batlab_kill_cmd + ' ' + jobs[job]['gid']
-                sin, out, err = client.exec_command(cmd)
-                out.channel.recv_exit_status()
-            except paramiko.SSHException:
-                event.data['description'] = "Error killing existing BaTLab job."
-                return
-            del jobs[job]
+        # work on the job once the submit host has a free slot
+        with SSH_POOL.slot(host):
+            self._submit_job(rc, origin, client, host, jobs, key=key)
 
-        # make sure we have a clean jobdir
-        stdin, stdout, sterr = client.exec_command('rm -rf ' + jobdir)
-        stdout.channel.recv_exit_status()
-        # put the scripts on batlab in a '~/owner--reposiotry--number' dir
-        if rc.batlab_scripts_url.endswith('.git'):
-            cmd = 'git clone {0} {1}'.format(rc.batlab_scripts_url, jobdir)
-            try:
-                stdin, stdout, sterr = client.exec_command(cmd)
-                stdout.channel.recv_exit_status()
-            except paramiko.SSHException:
-                event.data['description'] = "Error cloning BaTLab scripts."
-                return            
-        elif rc.batlab_scripts_url.endswith('.zip'):
-            cmds = unzip_cmds_template.format(jobdir=jobdir, 
-                    batlab_scripts_url=rc.batlab_scripts_url)
-
-            try:
-                stdin, stdout, sterr = client.exec_command(cmds)
-                stdout.channel.recv_exit_status()
-            except paramiko.SSHException:
-                event.data['description'] = "Error unzipping BaTLab scripts."
-                return            
-            cmd = 'ls {0}'.format(jobdir)
-            stdin, stdout, sterr = client.exec_command(cmd)
-            stdout.channel.recv_exit_status()
- 
-            ls = stdout.read().split()
-            if len(ls) == 1:
-                try:
-                    cmd = 'mv {0}/{1}/* {0}'.format(jobdir, ls[0])
-                    stdin, stdout, sterr = client.exec_command(cmd)
-                    stdout.channel.recv_exit_status()
-                except paramiko.SSHException:
-                    event.data['description'] = "Error moving BaTLab scripts."
-                    return            
-        else:
-            raise ValueError("rc.batlab_scripts_url not understood.")
-
-        # Overwrite fetch file
-        head_repo = github3.repository(*pr.head.repo)
-        fetch = git_fetch_template.format(repo_url=head_repo.clone_url,
-                                          repo_dir=job[1], branch=pr.head.ref)
-        cmd = 'echo "{0}" > {1}/{2}'.format(fetch, jobdir, rc.batlab_fetch_file)
-        try:
-            stdin, stdout, sterr = client.exec_command(cmd)
-            stdout.channel.recv_exit_status()
-        except paramiko.SSHException:
-            event.data['description'] = "Error overwritting fetch file."
+    def _submit_job(self, rc, origin, client, host, jobs, key=None):
+        """Uploads, prepares, and submits the job for the pull request of the
+        original event, updating the batlab-status event in rc.  The build key
+        is kept with the job so that its outcome may be reused, along with the
+        token which the callbacks of this submission carry."""
+        event = rc.event
+        pr = origin.data
+        job = pr.base.repo + (pr.number,)  # job key (owner, repo, number) 
+        jobname = "--".join(pr.base.repo + (str(pr.number),))
+        if origin.cancelled:
+            event.data['description'] = "Superseded by a newer event."
             return
-        
-        # append callbacks to run spec
-        try:
-            cmd = 'cat {0}/{1}'.format(jobdir, rc.batlab_run_spec)
-            _, x, _ = client.exec_command(cmd)
-            x.channel.recv_exit_status()
-            append = ', <a href="{0}/dashboard">{1}</a>'.format(
-                rc.server_url, 
-                "Polyphemus Dashboard")
-            run_spec_lines = [l.strip() for l in x.readlines()]
-            run_spec_lines = [
-                (l + append if l.split('=')[0].strip() == "description" else l) 
-                for l in run_spec_lines
-                ]
-            
-            pre_file = _ensure_task_script('pre_all', run_spec_lines, 
-                                           rc.batlab_run_spec, jobdir, client)
-            pre_curl = pre_curl_template.format(number=pr.number, port=rc.port, 
-                                                server_url=rc.server_url)
-            cmd = 'echo "{0}" >> {1}/{2}'.format(pre_curl, jobdir, pre_file)
-            sin, out, err = client.exec_command(cmd)
-            out.channel.recv_exit_status()
-            post_file = _ensure_task_script('post_all', run_spec_lines, 
-                                            rc.batlab_run_spec, jobdir, client)
-            _ensure_runspec_option('always_run_post_all', run_spec_lines, 
-                                   rc.batlab_run_spec, jobdir, client, 'true')
-            post_curl = post_curl_template.format(number=pr.number, port=rc.port, 
-                                                  server_url=rc.server_url)
-
-            cmd = 'echo "{0}" >> {1}/{2}'.format(post_curl, jobdir, post_file)
-            stdin, stdout, sterr = client.exec_command(cmd)
-            stdout.channel.recv_exit_status()
-        except paramiko.SSHException:
-            event.data['description'] = "Error appending BaTLab callbacks."
-            return            
 
-        # create scp for jobdir
-        jobdir_scp = jobdir_scp_template.format(jobdir=jobdir)
-        cmd = 'echo "{0}" >> {1}/jobdir.scp'.format(jobdir_scp, jobdir)
+        # render the job files locally and ship them as a single tarball.  The
+        # gid is not known until the job is submitted, so the callbacks carry
+        # a token of this submission instead.
+        token = uuid.uuid4().hex
         try:
-            stdin, stdout, sterr = client.exec_command(cmd)
-            stdout.channel.recv_exit_status()
-        except paramiko.SSHException:
-            event.data['description'] = "Error creating jobdir.scp file."
-            return            
-
-        try:
-            inputs = run_spec_lines[_find_startswith(run_spec_lines, 'inputs')].strip()
-        except IndexError:
+            jobdir, tarball, scripts, scripts_tarball = self._upload_job(
+                                        rc, client, host, pr, jobname, token=token)
+        except ValueError:
             event.data['description'] = "Error with run_spec formatting."
             return
+        except (RuntimeError, IOError, OSError) as e:
+            # includes SFTP errors, which are IOErrors
+            msg = "Error uploading BaTLab job."
+            warn("{0}\n{1}".format(msg, e), RuntimeWarning)
+            event.data['description'] = msg
+            return
+        except paramiko.SSHException:
+            event.data['description'] = "Error uploading BaTLab job."
+            return
 
-        if len(inputs.split('=', 1)[-1].strip()) > 0:
-            cmd = "sed -i 's:{0}:{0},jobdir.scp:' {1}/{2}"
-        else:
-            cmd = "sed -i 's:{0}:jobdir.scp:' {1}/{2}"
+        # create the job from the scripts on the submit host, killing the 
+        # existing job if this is a sync event.  If the existing job is on 
+        # another host, it is killed there instead.
+        gid = None
+        if origin.name == 'github-pr-sync' and job in jobs:
+            info = jobs[job]
+            if info.get('host', BATLAB_SUBMIT_HOSTNAME) == host:
+                gid = info['gid']
+            else:
+                self._kill_job(rc, info)
+                del jobs[job]
+        script = job_prep_script(rc, jobdir, tarball, scripts, 
+                                 scripts_tarball=scripts_tarball, gid=gid)
         try:
-            stdin, stdout, sterr = client.exec_command(cmd.format(inputs,
-                                                                  jobdir, 
-                                                                  rc.batlab_run_spec))
-            stdout.channel.recv_exit_status()
+            steps = run_script(client, script)
         except paramiko.SSHException:
-            event.data['description'] = "Error adding jobdir.scp to inputs."
-            return            
+            event.data['description'] = "Error preparing BaTLab job."
+            return
+        if gid is not None and len(steps) > 0 and steps[0].name == 'kill_job':
+            del jobs[job]
+        failed = [step for step in steps if not step.ok]
+        if len(failed) > 0 or len(steps) == 0:
+            step = failed[0] if len(failed) > 0 else None
+            msg = "Error preparing BaTLab job." if step is None else \
+                  prep_errors.get(step.name, "Error preparing BaTLab job.")
+            event.data['description'] = msg
+            if step is not None:
+                warn("{0}\n{1}".format(msg, step.output), RuntimeWarning)
+            return
+        self._remote_scripts.add((host, scripts))
 
-        # submit the job
+        # submit the job, unless a newer event has superseded this one
+        if origin.cancelled:
+            event.data['description'] = "Superseded by a newer event."
+            return
         cmd = 'cd {0}; {1} {2}'
         cmd = cmd.format(jobdir, rc.batlab_submit_cmd, rc.batlab_run_spec)
         try:
@@ -329,10 +689,11 @@ class PolyphemusPlugin(Plugin):
         #pprint.pprint(submiterr.read())
         report_url = lines[-1].strip()
         gid = lines[0].split()[-1]
-        client.close()
-        jobs[job] = {'gid': gid, 'report_url': report_url, 'dir': jobdir}
+        jobs[job] = {'gid': gid, 'report_url': report_url, 'dir': jobdir, 
+                     'host': host, 'build_key': key, 'token': token, 
+                     'submitted': time.time()}
         if rc.verbose:
             print("BaTLab reporting link: " + report_url)
         event.data.update(status='pending', description="BaTLab job submitted.",
-                          target_url=report_url)
+                          target_url=report_url, gid=gid)
 
@@ -1,5 +1,30 @@
 """The plugin to recieve status updates from batlab and re-dispatch them.
 
+BaTLab jobs report their status by posting to the ``/batlabstatus`` route from
+their pre_all and post_all tasks.  Each callback carries the token of the 
+submission that it came from, and callbacks which do not match the tracked job
+of their pull request, such as those of superseded or killed jobs, are 
+ignored.  In case a callback is lost, the jobs in the jobs cache may also be
+polled in the background.  A single command per submit host, over the pooled 
+SSH connection, asks for the status of its tracked jobs, and a batlab-status
+event is dispatched for each job whose status has changed.  The poll interval
+backs off while nothing changes and resets once something does.
+
+Each timed task of a job is run by a wrapper which, once the task is done, 
+prints a timing record on a line of its own::
+
+    @@polyphemus task <platform> <task> <start> <end> <exit>
+
+The platform is the NMI platform that the task ran on, or ``local`` for the
+tasks on the submit host, the start and end are whole seconds since the epoch,
+and the exit is the exit code of the task.  The post_all callback collects
+these records from the run directory and sends them as the ``telemetry`` form
+field.  They are kept, along with how long the job waited in the queue before 
+its first task started, in the telemetry cache.  A GET of ``/batlabstatus`` returns the stored 
+runs, optionally for a single pull request with ``?number=<n>``, and the mean 
+duration of each task as JSON, so that slow tasks and build time regressions 
+may be found.
+
 This module is available as an polyphemus plugin by the name `polyphemus.batlabstat`.
 
 BaTLab Status API
@@ -9,22 +34,281 @@ from __future__ import print_function
 import os
 import io
 import sys
+import time
+import socket
 import pprint
+import threading
 from warnings import warn
 
 if sys.version_info[0] >= 3:
     basestring = str
+    from shlex import quote
+    from queue import Full
+else:
+    from pipes import quote
+    from Queue import Full
 
 try:
     import simplejson as json
 except ImportError:
     import json
 
+import paramiko
 from flask import request
 
 from .utils import RunControl, NotSpecified, PersistentCache
 from .plugins import Plugin
 from .event import Event, runfor
+from .batlabbase import BATLAB_SUBMIT_HOSTNAME, SSH_POOL, STEP_MARKER, \
+    TASK_MARKER, record_result
+
+poll_script_template = """for gid in {gids}; do
+    out=$({status_cmd} "$gid" 2>&1 | tail -n 1)
+    echo "{marker} status $gid $out"
+done
+"""
+
+STATUS_WORDS = {
+    'pending': 'pending', 'submitted': 'pending', 'idle': 'pending', 
+    'queued': 'pending', 'running': 'pending', 
+    'success': 'success', 'succeeded': 'success', 'passed': 'success', 
+    'failure': 'failure', 'failed': 'failure', 
+    'error': 'error', 'removed': 'error', 'held': 'error', 'missing': 'error',
+    }
+"""Maps the last word printed by the status command to a GitHub state."""
+
+def classify_status(output):
+    """Returns the state, 'pending', 'success', 'failure', or 'error', that the 
+    output of the status command describes, or None if it is not understood."""
+    words = output.strip().split()
+    if len(words) == 0:
+        return None
+    return STATUS_WORDS.get(words[-1].strip('.,:;').lower(), None)
+
+def parse_poll(output):
+    """Parses the output of the poll script into a dictionary mapping job ids
+    to the output of the status command."""
+    if not isinstance(output, basestring):
+        output = output.decode('utf-8', 'replace')
+    statuses = {}
+    for line in output.splitlines():
+        fields = line.split(None, 3)
+        if len(fields) < 3 or fields[0] != STEP_MARKER or fields[1] != 'status':
+            continue
+        statuses[fields[2]] = fields[3] if len(fields) == 4 else ''
+    return statuses
+
+def parse_task_records(text):
+    """Parses the timing records of the BaTLab tasks into a list of task 
+    dictionaries with 'platform', 'task', 'start', 'end', 'duration', and 
+    'exit' keys, in the order that the tasks started.  Lines which are not
+    well formed records are skipped.
+    """
+    if not isinstance(text, basestring):
+        text = text.decode('utf-8', 'replace')
+    tasks = []
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) != 7 or ' '.join(fields[:2]) != TASK_MARKER:
+            continue
+        try:
+            start, end, ret = [int(x) for x in fields[4:]]
+        except ValueError:
+            continue
+        tasks.append({'platform': fields[2], 'task': fields[3], 'start': start, 
+                      'end': end, 'duration': end - start, 'exit': ret})
+    tasks.sort(key=lambda t: (t['start'], t['end']))
+    return tasks
+
+def record_telemetry(rc, info, data, log):
+    """Stores the telemetry of a finished job in the telemetry cache, dropping
+    the oldest runs once there are more than batlab_telemetry_max of them.
+
+    Parameters
+    ----------
+    rc : RunControl
+        The run control.
+    info : dict
+        The jobs cache entry of the job, empty if it was not tracked.
+    data : dict
+        The batlab-status event data of the job.
+    log : str
+        The task timing records which were sent by the job.
+
+    Returns
+    -------
+    run : dict
+        The stored telemetry.
+
+    """
+    now = time.time()
+    tasks = parse_task_records(log)
+    submitted = info.get('submitted', None)
+    started = info.get('started', None)
+    if len(tasks) > 0:
+        started = tasks[0]['start']
+    run = {'number': data['number'], 'gid': data.get('gid', None), 
+           'status': data['status'], 'host': info.get('host', None), 
+           'finished': now, 
+           'queue_wait': started - submitted if started and submitted else None,
+           'wall': now - started if started else None,
+           'tasks': tasks}
+    telemetry = PersistentCache(cachefile=rc.batlab_telemetry_cache)
+    telemetry[run['gid'] or (data['number'], now)] = run
+    if len(telemetry) > rc.batlab_telemetry_max:
+        runs = sorted([(r['finished'], k) for k, r in telemetry.items()])
+        for finished, k in runs[:len(runs) - rc.batlab_telemetry_max]:
+            del telemetry[k]
+    return run
+
+def summarize_tasks(runs):
+    """Returns the number of runs, mean and max durations, and number of 
+    failures of each task on each platform, slowest first."""
+    stats = {}
+    for run in runs:
+        for task in run['tasks']:
+            key = (task['platform'], task['task'])
+            s = stats.setdefault(key, {'platform': key[0], 'task': key[1], 
+                                       'count': 0, 'failures': 0, 'max': 0, 
+                                       'total': 0.0})
+            s['count'] += 1
+            s['failures'] += int(task['exit'] != 0)
+            s['total'] += task['duration']
+            s['max'] = max(s['max'], task['duration'])
+    for s in stats.values():
+        s['mean'] = s.pop('total') / s['count']
+    return sorted(stats.values(), key=lambda s: -s['mean'])
+
+class JobPoller(object):
+    """Polls the status of the jobs in the jobs cache in a background thread."""
+
+    _rm_job_stats = frozenset(['success', 'failure', 'error'])
+
+    def __init__(self, rc, dispatch, interval=60.0, max_interval=900.0):
+        """Parameters
+        ----------
+        rc : RunControl
+            The run control, which provides the jobs cache, BaTLab user, ssh key
+            file, and status command.
+        dispatch : callable
+            A function which is given each batlab-status event, such as 
+            ``rc.event_queue.put``.
+        interval : float, optional
+            The shortest time, in seconds, between polls.
+        max_interval : float, optional
+            The longest time, in seconds, between polls.
+
+        """
+        self.rc = rc
+        self.dispatch = dispatch
+        self.interval = interval
+        self.max_interval = max_interval
+        self.polls = 0
+        self.transitions = 0
+        self._wait = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts polling."""
+        self._thread = threading.Thread(target=self._run, 
+                                        name='polyphemus-batlab-poller')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops polling."""
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self._wait):
+            try:
+                njobs, nchanged = self.poll()
+            except Exception as e:
+                warn("could not poll BaTLab job statuses: {0}".format(e), 
+                     RuntimeWarning)
+                njobs, nchanged = 1, 0
+            if njobs == 0:
+                self._wait = self.max_interval
+            elif nchanged > 0:
+                self._wait = self.interval
+            else:
+                self._wait = min(2 * self._wait, self.max_interval)
+
+    def poll(self):
+        """Polls all tracked jobs once, dispatching events for those whose 
+        status changed.  Returns the number of jobs polled and changed."""
+        rc = self.rc
+        jobs = PersistentCache(cachefile=rc.batlab_jobs_cache)
+        tracked = dict([(job, info) for job, info in jobs.items() if 'gid' in info])
+        if len(tracked) == 0:
+            return 0, 0
+        hosts = {}
+        for info in tracked.values():
+            host = info.get('host', BATLAB_SUBMIT_HOSTNAME)
+            hosts.setdefault(host, []).append(info['gid'])
+        statuses = {}
+        for host, gids in hosts.items():
+            # one command per submit host
+            script = poll_script_template.format(marker=STEP_MARKER,
+                        gids=" ".join([quote(gid) for gid in gids]), 
+                        status_cmd=rc.batlab_status_cmd)
+            try:
+                client = SSH_POOL.client(host, rc.batlab_user, 
+                                         key_file=rc.ssh_key_file)
+                stdin, stdout, stderr = client.exec_command(script)
+                output = stdout.read()
+                stdout.channel.recv_exit_status()
+            except (paramiko.SSHException, socket.error) as e:
+                warn("could not poll BaTLab jobs on {0}: {1}".format(host, e), 
+                     RuntimeWarning)
+                continue
+            statuses.update(parse_poll(output))
+        self.polls += 1
+        nchanged = 0
+        for job, info in tracked.items():
+            status = classify_status(statuses.get(info['gid'], ''))
+            if status is None or status == info.get('status', 'pending'):
+                continue
+            # the job may have been replaced, e.g. by a sync, while polling
+            if self._current(jobs, job, info['gid']) is None:
+                continue
+            data = {'status': status, 'number': job[2], 'gid': info['gid'], 
+                    'target_url': info['report_url']}
+            # the cache is only changed once the event has been accepted, so 
+            # that a change which could not be dispatched is seen again later.
+            if not self._dispatch(Event(name='batlab-status', data=data)):
+                continue
+            nchanged += 1
+            current = self._current(jobs, job, info['gid'])
+            if current is None:
+                continue
+            if status in self._rm_job_stats:
+                record_result(rc, current, data)
+                del jobs[job]
+            else:
+                jobs[job] = dict(current, status=status)
+        self.transitions += nchanged
+        return len(tracked), nchanged
+
+    def _current(self, jobs, job, gid):
+        """Returns the jobs cache entry of a job if it is still for gid."""
+        info = jobs[job] if job in jobs else None
+        return info if info is not None and info.get('gid', None) == gid else None
+
+    def _dispatch(self, event, tries=5, wait=1.0):
+        """Dispatches an event, retrying while the event queue is full.  
+        Returns whether the event was dispatched."""
+        for i in range(tries):
+            try:
+                self.dispatch(event)
+                return True
+            except Full:
+                if self._stop.wait(wait):
+                    break
+        warn("could not dispatch {0}, the event queue is full".format(event), 
+             RuntimeWarning)
+        return False
 
 class PolyphemusPlugin(Plugin):
     """This class routes batlab status updates."""
@@ -35,20 +319,98 @@ class PolyphemusPlugin(Plugin):
 
     request_methods = ['GET', 'POST']
 
+    defaultrc = RunControl(
+        batlab_status_cmd=NotSpecified,
+        batlab_poll_interval=60.0,
+        batlab_poll_max_interval=900.0,
+        batlab_telemetry_cache='telemetry.cache',
+        batlab_telemetry_max=1000,
+        )
+
+    rcdocs = {
+        'batlab_status_cmd': ("The command on the BaTLab submit host which is given "
+                              "a job id and whose last word of output is the job "
+                              "state, e.g. 'running', 'success', 'failed', or "
+                              "'removed'.  If not specified, jobs are not polled "
+                              "and statuses only come from the job callbacks."),
+        'batlab_poll_interval': ("The shortest time, in seconds, between polls of "
+                                 "the BaTLab job statuses."),
+        'batlab_poll_max_interval': ("The longest time, in seconds, between polls "
+                                     "of the BaTLab job statuses.  The interval "
+                                     "doubles up to this while no job changes."),
+        'batlab_telemetry_cache': ("The cache file for the task timings which "
+                                   "finished BaTLab jobs send back."),
+        'batlab_telemetry_max': ("The maximum number of BaTLab runs to keep "
+                                 "the task timings of."),
+        }
+
     _rm_job_stats = frozenset(['success', 'failure', 'error'])
 
+    def __init__(self):
+        self._poller = None
+
+    def update_argparser(self, parser):
+        parser.add_argument('--batlab-status-cmd', dest='batlab_status_cmd',
+                            help=self.rcdocs["batlab_status_cmd"])
+        parser.add_argument('--batlab-poll-interval', dest='batlab_poll_interval',
+                            type=float, help=self.rcdocs["batlab_poll_interval"])
+        parser.add_argument('--batlab-poll-max-interval', 
+                            dest='batlab_poll_max_interval', type=float, 
+                            help=self.rcdocs["batlab_poll_max_interval"])
+        parser.add_argument('--batlab-telemetry-cache', 
+                            dest='batlab_telemetry_cache',
+                            help=self.rcdocs["batlab_telemetry_cache"])
+        parser.add_argument('--batlab-telemetry-max', dest='batlab_telemetry_max',
+                            type=int, help=self.rcdocs["batlab_telemetry_max"])
+
+    def setup(self, rc):
+        if rc.batlab_status_cmd is NotSpecified:
+            return
+        if 'event_queue' not in rc:
+            warn("BaTLab jobs are not polled because there is no event queue, "
+                 "see event_workers", RuntimeWarning)
+            return
+        self._poller = JobPoller(rc, rc.event_queue.put, 
+                                 interval=rc.batlab_poll_interval, 
+                                 max_interval=rc.batlab_poll_max_interval)
+        self._poller.start()
+
+    def teardown(self, rc):
+        if self._poller is not None:
+            self._poller.stop()
+
+    def telemetry(self, rc):
+        """Returns the stored telemetry as JSON, most recent runs first."""
+        telemetry = PersistentCache(cachefile=rc.batlab_telemetry_cache)
+        runs = sorted(telemetry.values(), key=lambda r: -r['finished'])
+        number = request.args.get('number', None)
+        if number is not None:
+            runs = [r for r in runs if str(r['number']) == number]
+        return json.dumps({'tasks': summarize_tasks(runs), 'runs': runs[:100]})
+
     def response(self, rc):
         if 'status' not in request.form:
-            return "\n", None
+            return (self.telemetry(rc) if request.method == 'GET' else "\n"), None
         data = json.loads(request.form['status'])
         if 'status' not in data:
             return "\n", None
         jobs = PersistentCache(cachefile=rc.batlab_jobs_cache)
         job = (rc.github_owner, rc.github_repo, data['number'])
-        if job in jobs:
-            if 'target_url' not in data or not data['target_url'].startswith('http'):
-                data['target_url'] = jobs[job]['report_url']
-            if data['status'] in self._rm_job_stats:
-                del jobs[job]
+        info = jobs[job] if job in jobs else {}
+        if data.get('token', None) != info.get('token', None):
+            info = {}  # a callback of a superseded or killed job
+        if 'telemetry' in request.form:
+            record_telemetry(rc, info, data, request.form['telemetry'])
+        if len(info) == 0:
+            return "\n", None
+        if 'target_url' not in data or not data['target_url'].startswith('http'):
+            data['target_url'] = info['report_url']
+        data.setdefault('gid', info['gid'])
+        if data['status'] in self._rm_job_stats:
+            record_result(rc, info, data)
+            del jobs[job]
+        else:
+            jobs[job] = dict(info, status=data['status'], 
+                             started=info.get('started', time.time()))
         event = Event(name='batlab-status', data=data)
         return request.method + ": batlab\n", event
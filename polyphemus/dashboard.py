@@ -1,5 +1,20 @@
 """This provides a basic issue status dashboard and a way to manually re-launch
-jobs.
+jobs.  The dashboard is rendered from the local pull request store, which is 
+kept current by the events that polyphemus processes and is periodically 
+reconciled with GitHub in a background thread.  Open pull requests are 
+paginated and may be filtered with the following query parameters:
+
+:page: The page number, starting at 1.
+:per_page: The number of pull requests per page.
+:status: Only show pull requests with this state, e.g. 'failure'.  Pull 
+    requests without any status have the state 'unknown'.
+:author: Only show pull requests opened by this GitHub user.
+:min_age: Only show pull requests opened at least this many days ago.
+:max_age: Only show pull requests opened at most this many days ago.
+
+The page is streamed to the browser as it is rendered.  If the
+``polyphemus.dashboardevents`` plugin is loaded, the rows are updated in place 
+as statuses change.
 
 This module is available as an polyphemus plugin by the name
 `polyphemus.dashboard`.
@@ -11,25 +26,75 @@ from __future__ import print_function
 import os
 import io
 import sys
+import time
 import pprint
+import threading
 from warnings import warn
+from multiprocessing.pool import ThreadPool
 
 if sys.version_info[0] >= 3:
     basestring = str
+    from urllib.parse import urlencode
+else:
+    from urllib import urlencode
 
 try:
     import simplejson as json
 except ImportError:
     import json
 
-import github3
-
-from flask import request, render_template
+from flask import request, current_app, Response, stream_with_context, url_for
 
 from .utils import RunControl, NotSpecified, PersistentCache
 from .plugins import Plugin
 from .event import Event, runfor
-from .githubbase import get_pull_request_status, ensure_logged_in
+from .githubbase import github_session, github_priority, LOW, PullRequestInfo, \
+    PR_STORE, reconcile_pull_requests
+
+def filter_pull_requests(recs, status=None, author=None, min_age=None, max_age=None):
+    """Filters pull request store records.
+
+    Parameters
+    ----------
+    recs : iterable of dicts
+        Pull request store records.
+    status : str, optional
+        The status state to keep, 'unknown' keeps records without a status.
+    author : str, optional
+        The user who opened the pull request.
+    min_age, max_age : float, optional
+        The minimum and maximum age of the pull request, in days.
+
+    Returns
+    -------
+    recs : generator of dicts
+        The records which pass all filters.
+
+    """
+    now = time.time()
+    for rec in recs:
+        if status is not None:
+            state = 'unknown' if rec['status'] is None else rec['status']['state']
+            if state != status:
+                continue
+        if author is not None and rec.get('user', None) != author:
+            continue
+        if min_age is not None or max_age is not None:
+            created = rec.get('created_at', None)
+            if created is None:
+                continue
+            age = (now - created) / 86400.0
+            if (min_age is not None and age < min_age) or \
+               (max_age is not None and age > max_age):
+                continue
+        yield rec
+
+def _float_arg(args, name):
+    value = args.get(name, '')
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
 
 class PolyphemusPlugin(Plugin):
     """This class routes the dashboard."""
@@ -38,22 +103,95 @@ class PolyphemusPlugin(Plugin):
 
     request_methods = ['GET', 'POST']
 
+    defaultrc = RunControl(
+        dashboard_workers=8,
+        dashboard_reconcile_interval=600,
+        dashboard_page_size=50,
+        )
+
+    rcdocs = {
+        'dashboard_workers': ("The number of threads that fetch pull request "
+                              "statuses concurrently for the dashboard."),
+        'dashboard_reconcile_interval': ("The time, in seconds, between background "
+                                         "reconciliations of the local pull request "
+                                         "store with GitHub.  If zero or less, the "
+                                         "store is only reconciled when the dashboard "
+                                         "is first requested."),
+        'dashboard_page_size': "The default number of open pull requests per page.",
+        }
+
+    def __init__(self):
+        self._pool = None
+        self._stop = threading.Event()
+        self._reconciling = threading.Lock()
+
+    def update_argparser(self, parser):
+        parser.add_argument('--dashboard-workers', dest='dashboard_workers', 
+                            type=int, help=self.rcdocs["dashboard_workers"])
+        parser.add_argument('--dashboard-reconcile-interval', 
+                            dest='dashboard_reconcile_interval', type=float, 
+                            help=self.rcdocs["dashboard_reconcile_interval"])
+        parser.add_argument('--dashboard-page-size', dest='dashboard_page_size', 
+                            type=int, help=self.rcdocs["dashboard_page_size"])
+
+    def setup(self, rc):
+        self._pool = ThreadPool(rc.dashboard_workers)
+        if self._has_github(rc) and rc.dashboard_reconcile_interval > 0:
+            t = threading.Thread(target=self._reconcile_loop, args=(rc,), 
+                                 name='polyphemus-dashboard-reconcile')
+            t.daemon = True
+            t.start()
+
+    def teardown(self, rc):
+        self._stop.set()
+        if self._pool is not None:
+            self._pool.close()
+
+    def _has_github(self, rc):
+        return any([p.startswith('polyphemus.github') for p in rc.plugins])
+
+    def _reconcile(self, rc):
+        gh = github_session(user=rc.github_user, credfile=rc.github_credentials)
+        with github_priority(LOW):
+            reconcile_pull_requests(gh, rc.github_owner, rc.github_repo, 
+                                    pool=self._pool, user=rc.github_user, 
+                                    credfile=rc.github_credentials)
+
+    def _reconcile_once(self, rc, block=True):
+        """Reconciles the store unless, when not blocking, another thread 
+        already is.  Errors are warned about rather than raised."""
+        if not self._reconciling.acquire(block):
+            return
+        try:
+            self._reconcile(rc)
+        except Exception as e:
+            warn("could not reconcile pull requests with GitHub: {0}".format(e),
+                 RuntimeWarning)
+        finally:
+            self._reconciling.release()
+
+    def _reconcile_loop(self, rc):
+        while not self._stop.is_set():
+            self._reconcile_once(rc)
+            self._stop.wait(rc.dashboard_reconcile_interval)
+
     def response(self, rc):
         resp = ""
         event = banner_message = None
-        if any([p.startswith('polyphemus.github') for p in rc.plugins]):
-            gh = github3.GitHub()
-            ensure_logged_in(gh, user=rc.github_user, credfile=rc.github_credentials)
+        if self._has_github(rc):
             if request.method == 'POST':
                 number = int(request.form['number'])
+                gh = github_session(user=rc.github_user, 
+                                    credfile=rc.github_credentials)
                 pr = gh.pull_request(rc.github_owner, rc.github_repo, number)
                 if rc.verbose:
                     print("Launching pull request", pr)
-                event = Event(name='batlab-run', data=pr)
+                event = Event(name='batlab-run', 
+                              data=PullRequestInfo.from_pull_request(pr))
                 banner_message = ('Launched BaTLab Job for Pull Request '
                                   '<a href="{0}">#{1}</a>')
                 banner_message = banner_message.format(pr.html_url, number)
-            resp = self._ghrepsonse(rc, gh, banner_message)
+            resp = self._ghrepsonse(rc, banner_message)
         else:
             resp = "No polyphemus dashboard found."
         return resp, event
@@ -65,17 +203,57 @@ class PolyphemusPlugin(Plugin):
         'error': 'rgba(51, 51, 51, 0.6)',
         }
 
-    def _ghprinfo(self, rc, gh, r, pr):
-        status = get_pull_request_status(gh, r, pr)
-        if status is not None and status.description is None:
-            status.description = "unhelpful message"
-        bgcolor = "#ffffff" if status is None else self._bgcolors[status.state]
-        return pr, status, bgcolor
-
-    def _ghrepsonse(self, rc, gh, banner_message=None):
-        r = gh.repository(rc.github_owner, rc.github_repo)
-        open_prs = [self._ghprinfo(rc, gh, r, pr) for pr in r.iter_pulls(state='open')]
-        closed_prs = [self._ghprinfo(rc, gh, r, pr) for pr in 
-                      r.iter_pulls(state='closed', number=10)]
-        return render_template("github_dashboard.html", rc=rc, open_prs=open_prs, 
-                               closed_prs=closed_prs, banner_message=banner_message)
+    def _ghprinfo(self, rec):
+        status = rec['status']
+        if status is not None and not status['description']:
+            status = dict(status, description="unhelpful message")
+        bgcolor = "#ffffff" if status is None else self._bgcolors[status['state']]
+        return rec, status, bgcolor
+
+    def _ghrepsonse(self, rc, banner_message=None):
+        if PR_STORE.reconciled is None:
+            # the store has never been reconciled, so it may be missing pull 
+            # requests that were opened while polyphemus was down.  This is done
+            # in the background and the store is served as it is meanwhile.
+            t = threading.Thread(target=self._reconcile_once, args=(rc, False),
+                                 name='polyphemus-dashboard-reconcile-once')
+            t.daemon = True
+            t.start()
+            banner_message = banner_message or ("Pull requests are being loaded "
+                                                "from GitHub, reload to see them.")
+        args = request.args
+        filters = {'status': args.get('status', '') or None, 
+                   'author': args.get('author', '') or None,
+                   'min_age': _float_arg(args, 'min_age'), 
+                   'max_age': _float_arg(args, 'max_age')}
+        try:
+            page = max(int(args.get('page', 1)), 1)
+            per_page = min(max(int(args.get('per_page', rc.dashboard_page_size)), 1), 
+                           1000)
+        except ValueError:
+            page, per_page = 1, rc.dashboard_page_size
+        owner, repo = rc.github_owner, rc.github_repo
+        open_recs = list(filter_pull_requests(
+                        PR_STORE.pull_requests(owner, repo, state='open'), **filters))
+        closed_recs = filter_pull_requests(
+                        PR_STORE.pull_requests(owner, repo, state='closed'), **filters)
+        npages = max((len(open_recs) + per_page - 1) // per_page, 1)
+        page_recs = open_recs[(page - 1)*per_page:page*per_page]
+        events_url = None
+        if 'polyphemus.dashboardevents' in rc.plugins:
+            events_url = url_for('polyphemus.dashboardevents', since=PR_STORE.seq)
+        query = dict([(k, v) for k, v in args.items() if k != 'page'])
+        page_url = lambda n: '?' + urlencode(dict(query, page=n))
+        # rows are rendered lazily as the template is streamed
+        context = dict(rc=rc, banner_message=banner_message, filters=filters,
+                       page=page, npages=npages, page_url=page_url, 
+                       nopen=len(open_recs), events_url=events_url, 
+                       bgcolors=self._bgcolors,
+                       open_prs=(self._ghprinfo(rec) for rec in page_recs), 
+                       closed_prs=[self._ghprinfo(rec) for rec in 
+                                   [r for _, r in zip(range(10), closed_recs)]])
+        current_app.update_template_context(context)
+        stream = current_app.jinja_env.get_template("github_dashboard.html")\
+                                      .stream(context)
+        stream.enable_buffering(10)
+        return Response(stream_with_context(stream), mimetype='text/html')
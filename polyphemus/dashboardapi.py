@@ -0,0 +1,102 @@
+"""The plugin which serves the dashboard as JSON, for tools which poll polyphemus.
+
+The ``/dashboard/api`` route returns the pull requests of the repository along
+with their latest statuses, target URLs, and BaTLab job ids.  Every response
+includes a ``cursor``.  Passing this back as ``?since=<cursor>`` returns only
+the pull requests which have changed since then::
+
+    {"cursor": 42, "pull_requests": [{"number": 7, "state": "open", ...}]}
+
+Responses are built from a snapshot of the local pull request store which is
+only rebuilt when the store changes, so polling is cheap and never reaches out
+to GitHub.
+
+This module is available as an polyphemus plugin by the name
+``polyphemus.dashboardapi``.
+
+Dashboard JSON API
+==================
+"""
+from __future__ import print_function
+import sys
+import threading
+from bisect import bisect_right
+
+if sys.version_info[0] >= 3:
+    basestring = str
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from flask import request, Response
+
+from .plugins import Plugin
+from .githubbase import PR_STORE
+
+class Snapshot(object):
+    """An immutable view of the pull requests of a repository, ordered by the
+    sequence number of their last change."""
+
+    def __init__(self, store, owner, repo):
+        """Parameters
+        ----------
+        store : PullRequestStore
+            The store to take the snapshot of.
+        owner : str
+            The repository owner.
+        repo : str
+            The repository name.
+
+        """
+        self.cursor = store.seq
+        recs = store.pull_requests(owner, repo)
+        recs.sort(key=lambda r: r['seq'])
+        self.records = recs
+        self.seqs = [rec['seq'] for rec in recs]
+        self._bodies = {}
+        self._lock = threading.Lock()
+
+    def since(self, cursor=0):
+        """Returns the JSON body listing the pull requests which have changed
+        after the given cursor.  Bodies are cached per cursor."""
+        cursor = max(min(cursor, self.cursor), 0)
+        with self._lock:
+            body = self._bodies.get(cursor, None)
+            if body is None:
+                recs = self.records[bisect_right(self.seqs, cursor):]
+                body = json.dumps({'cursor': self.cursor, 'pull_requests': recs})
+                if len(self._bodies) >= 64:
+                    self._bodies.clear()
+                self._bodies[cursor] = body
+        return body
+
+class PolyphemusPlugin(Plugin):
+    """This class serves the dashboard as JSON."""
+
+    requires = ('polyphemus.dashboard',)
+
+    route = '/dashboard/api'
+
+    def __init__(self):
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def snapshot(self, rc):
+        """Returns the current snapshot, rebuilding it if the store changed."""
+        with self._lock:
+            snap = self._snapshot
+            if snap is None or snap.cursor != PR_STORE.seq:
+                snap = self._snapshot = Snapshot(PR_STORE, rc.github_owner,
+                                                 rc.github_repo)
+        return snap
+
+    def response(self, rc):
+        try:
+            since = int(request.args.get('since', 0))
+        except ValueError:
+            return Response(json.dumps({'error': 'since must be an integer'}),
+                            status=400, mimetype='application/json'), None
+        body = self.snapshot(rc).since(since)
+        return Response(body, mimetype='application/json'), None
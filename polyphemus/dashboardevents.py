@@ -0,0 +1,117 @@
+"""The plugin which pushes live dashboard updates to browsers as server-sent
+events, so that waiting on BaTLab does not mean reloading the dashboard.
+
+The ``/dashboard/events`` route is a long-lived ``text/event-stream``.  Every
+time a pull request in the local store changes, for example when
+``batlabstat`` or ``githubstat`` process a new status, a ``pull_request``
+event is sent whose data is the JSON record and whose id is the record's
+sequence number.  Reconnecting browsers send the last id they saw and are
+caught up on everything that they missed.  Comment lines are sent as a
+heartbeat while nothing changes.
+
+This module is available as an polyphemus plugin by the name
+``polyphemus.dashboardevents``.
+
+Dashboard Events API
+====================
+"""
+from __future__ import print_function
+import sys
+
+if sys.version_info[0] >= 3:
+    basestring = str
+    from queue import Empty
+else:
+    from Queue import Empty
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from flask import request, Response
+
+from .utils import RunControl
+from .plugins import Plugin
+from .githubbase import PR_STORE
+
+def sse_message(rec):
+    """Formats a pull request store record as a server-sent event."""
+    return "id: {0}\nevent: pull_request\ndata: {1}\n\n".format(rec['seq'],
+                                                                json.dumps(rec))
+
+def stream_pull_requests(owner, repo, since=0, heartbeat=15.0, store=PR_STORE):
+    """Yields server-sent events for the pull requests of a repository which
+    change after a sequence number, forever.
+
+    Parameters
+    ----------
+    owner : str
+        The repository owner.
+    repo : str
+        The repository name.
+    since : int, optional
+        Only records which changed after this sequence number are sent.
+    heartbeat : float, optional
+        The time, in seconds, between keep alive comments.
+    store : PullRequestStore, optional
+        The store to watch.
+
+    """
+    q = store.subscribe()
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            # the queue only wakes us up, the store is the source of truth
+            # so that updates dropped for slow subscribers are not lost.
+            recs = [rec for rec in store.pull_requests(owner, repo)
+                    if rec['seq'] > since]
+            recs.sort(key=lambda r: r['seq'])
+            for rec in recs:
+                yield sse_message(rec)
+                since = rec['seq']
+            try:
+                q.get(timeout=heartbeat)
+            except Empty:
+                yield ": keepalive\n\n"
+                continue
+            while True:
+                try:
+                    q.get_nowait()
+                except Empty:
+                    break
+    finally:
+        store.unsubscribe(q)
+
+class PolyphemusPlugin(Plugin):
+    """This class streams live dashboard updates."""
+
+    requires = ('polyphemus.dashboard',)
+
+    route = '/dashboard/events'
+
+    defaultrc = RunControl(
+        dashboard_heartbeat=15.0,
+        )
+
+    rcdocs = {
+        'dashboard_heartbeat': ("The time, in seconds, between keep alive messages "
+                                "on live dashboard connections."),
+        }
+
+    def update_argparser(self, parser):
+        parser.add_argument('--dashboard-heartbeat', dest='dashboard_heartbeat',
+                            type=float, help=self.rcdocs["dashboard_heartbeat"])
+
+    def response(self, rc):
+        try:
+            since = int(request.headers.get('Last-Event-ID', None) or
+                        request.args.get('since', None) or PR_STORE.seq)
+        except ValueError:
+            since = PR_STORE.seq
+        stream = stream_pull_requests(rc.github_owner, rc.github_repo, since=since,
+                                      heartbeat=rc.dashboard_heartbeat)
+        resp = Response(stream, mimetype='text/event-stream')
+        resp.headers['Cache-Control'] = 'no-cache'
+        resp.headers['X-Accel-Buffering'] = 'no'
+        return resp, None
@@ -18,6 +18,12 @@ class Event(object):
         """
         self.name = name
         self.data = data
+        self.cancelled = False
+
+    def cancel(self):
+        """Marks the event as cancelled, e.g. because it has been superseded by 
+        a newer event.  Plugins should stop processing cancelled events."""
+        self.cancelled = True
 
     def __str__(self):
         return "{0} event holding {1}".format(self.name, self.data)
@@ -32,7 +38,9 @@ class Event(object):
         return (self.name == other.name) and (self.data == other.data)
 
 def runfor(*events):
-    """A decorator for running only certain events.
+    """A decorator for running only certain events.  The event names are 
+    recorded on the wrapped function as the ``events`` attribute so that 
+    plugins may be indexed by the events that they handle.
     """
     events = frozenset(events)
     def dec(f):
@@ -41,5 +49,6 @@ def runfor(*events):
             if rc.event.name not in events:
                 return 
             return f(self, rc, *args, **kwargs)
+        wrapper.events = events
         return wrapper
     return dec
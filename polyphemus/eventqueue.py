@@ -0,0 +1,368 @@
+"""The plugin which processes events asynchronously, so that web responses may
+return before the execution pipeline has run.
+
+Events returned by plugin responses are placed on a bounded, in-process queue
+and handled by a pool of worker threads.  Rapid pull request synchronizations
+are coalesced so that only the latest head commit is built.  Accepted events
+are journaled so that they survive a restart.  The queue depth and wait times 
+are served as JSON from the ``/eventqueue`` route.
+
+This module is available as an polyphemus plugin by the name ``polyphemus.eventqueue``.
+
+Event Queue API
+===============
+"""
+from __future__ import print_function
+import sys
+import time
+import threading
+from collections import deque
+from warnings import warn
+
+if sys.version_info[0] >= 3:
+    basestring = str
+    from queue import Full
+else:
+    from Queue import Full
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from .utils import RunControl
+from .plugins import Plugin
+from .journal import EventJournal
+
+COALESCE_EVENTS = frozenset(['github-pr-new', 'github-pr-sync'])
+"""Events for the same pull request which supersede one another."""
+
+def pull_request_key(event):
+    """Returns the (owner, repository, number) tuple of the pull request that 
+    an event refers to, or None if the event data is not a pull request."""
+    pr = event.data
+    if isinstance(pr, tuple) and len(pr) == 3:
+        return pr
+    base = getattr(pr, 'base', None)
+    if base is None:
+        return None
+    return tuple(base.repo) + (pr.number,)
+
+class _Item(object):
+    """An event waiting on the queue."""
+
+    __slots__ = ('event', 'key', 'seq', 'enqueued', 'ready')
+
+    def __init__(self, event, key, seq=None, delay=0.0):
+        self.event = event
+        self.key = key
+        self.seq = seq
+        self.enqueued = time.time()
+        self.ready = self.enqueued + delay
+
+class EventQueue(object):
+    """A bounded queue of events which are handled by a pool of worker threads.
+
+    Events are keyed by the pull request that they refer to.  Events with the
+    same key are never handled concurrently.  Coalescing events (pull request 
+    creation and synchronization) wait out a debounce window before they are 
+    handled.  A coalescing event replaces any pending coalescing event with 
+    the same key and cancels such an event if it is already being handled.
+
+    If a journal is given, accepted events are written to it before they are
+    queued and marked as complete once handled.  Events left pending in the 
+    journal are replayed when the queue is started.
+    """
+
+    def __init__(self, maxsize=100, workers=1, debounce=0.0, 
+                 coalesce=COALESCE_EVENTS, keyfunc=pull_request_key, journal=None):
+        """Parameters
+        ----------
+        maxsize : int, optional
+            The maximum number of events which may be waiting on the queue.
+            Values less than one mean that the queue is unbounded.
+        workers : int, optional
+            The number of worker threads that handle events.
+        debounce : float, optional
+            The time, in seconds, that coalescing events wait for newer events
+            for the same key before being handled.
+        coalesce : set of str, optional
+            The names of the events which supersede one another.
+        keyfunc : callable, optional
+            A function which returns the key of an event, or None if the event
+            should not be keyed.
+        journal : EventJournal, optional
+            The journal to record accepted and completed events in.
+
+        """
+        self.maxsize = maxsize
+        self.workers = workers
+        self.debounce = debounce
+        self.coalesce = frozenset(coalesce)
+        self.keyfunc = keyfunc
+        self.journal = journal
+        self.handler = None
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.coalesced = 0
+        self.superseded = 0
+        self._items = deque()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._threads = []
+        self._running = False
+        self._busy = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._wait_last = 0.0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def start(self, handler):
+        """Starts the worker threads.
+
+        Parameters
+        ----------
+        handler : callable
+            A function which takes an event and processes it, normally
+            ``Plugins.execute()``.
+
+        """
+        self.handler = handler
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            done = []
+            if self.journal is not None:
+                for rec in self.journal.records():
+                    item = _Item(rec.event, rec.key, rec.seq)
+                    done += self._insert(item, force=True)
+        self._complete(done)
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work,
+                                 name='polyphemus-event-worker-{0}'.format(i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout=None):
+        """Stops the worker threads after the remaining events have been handled.
+
+        Parameters
+        ----------
+        timeout : float or None, optional
+            The maximum time, in seconds, to wait on each worker thread.
+
+        """
+        with self._lock:
+            self._running = False
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+        if self.journal is not None:
+            self.journal.close()
+
+    def put(self, event, raw=None):
+        """Places an event on the queue without blocking.  If the queue has a
+        journal, this returns once the event has been durably recorded.
+
+        Parameters
+        ----------
+        event : Event
+            The event to handle.
+        raw : bytes, optional
+            The raw payload that the event was derived from, for the journal.
+
+        Raises
+        ------
+        Full
+            If the queue already holds maxsize events.
+
+        """
+        key = self.keyfunc(event)
+        seq = None
+        done = []
+        if self.journal is not None:
+            seq = self.journal.accept(event, key=key, raw=raw)
+        try:
+            with self._lock:
+                done = self._insert(_Item(event, key, seq))
+        except Full:
+            done = [seq]
+            raise
+        finally:
+            self._complete(done)
+
+    def _insert(self, item, force=False):
+        """Adds an item to the queue, returning the journal sequence numbers of
+        any events that it superseded.  Must be called with the lock held."""
+        key = item.key
+        if key is not None and item.event.name in self.coalesce:
+            inflight = self._inflight.get(key, None)
+            if inflight is not None and inflight.name in self.coalesce:
+                inflight.cancel()
+                self.superseded += 1
+            for pending in self._items:
+                if pending.key == key and pending.event.name in self.coalesce:
+                    done = [pending.seq]
+                    pending.event.cancel()
+                    pending.event = item.event
+                    pending.seq = item.seq
+                    pending.ready = time.time() + self.debounce
+                    self.coalesced += 1
+                    self._cond.notify()
+                    return done
+            item.ready = item.enqueued + self.debounce
+        if not force and 0 < self.maxsize <= len(self._items):
+            self.rejected += 1
+            raise Full("event queue is full")
+        self._items.append(item)
+        self._cond.notify()
+        return []
+
+    def _complete(self, seqs):
+        if self.journal is None:
+            return
+        for seq in seqs:
+            self.journal.complete(seq)
+
+    def stats(self):
+        """Returns a dictionary of the current queue statistics, wait times are
+        given in seconds."""
+        with self._lock:
+            nwaited = self.processed + self.failed
+            return {
+                'depth': len(self._items),
+                'maxsize': self.maxsize,
+                'workers': self.workers,
+                'busy': self._busy,
+                'processed': self.processed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'coalesced': self.coalesced,
+                'superseded': self.superseded,
+                'journal_pending': 0 if self.journal is None else len(self.journal),
+                'wait_mean': self._wait_total / nwaited if nwaited else 0.0,
+                'wait_max': self._wait_max,
+                'wait_last': self._wait_last,
+                }
+
+    def _next(self):
+        """Removes and returns the first item which is ready and whose key is 
+        not in flight, or returns the time to wait until an item may be ready.
+        Must be called with the lock held."""
+        now = time.time()
+        timeout = None
+        for item in self._items:
+            if item.key is not None and item.key in self._inflight:
+                continue
+            if item.ready <= now or not self._running:
+                self._items.remove(item)
+                return item, None
+            wait = item.ready - now
+            timeout = wait if timeout is None else min(timeout, wait)
+        return None, timeout
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while True:
+                    item, timeout = self._next()
+                    if item is not None:
+                        break
+                    if not self._running and len(self._items) == 0:
+                        return
+                    self._cond.wait(timeout)
+                wait = time.time() - item.enqueued
+                self._wait_total += wait
+                self._wait_max = max(self._wait_max, wait)
+                self._wait_last = wait
+                self._busy += 1
+                if item.key is not None:
+                    self._inflight[item.key] = item.event
+            try:
+                self.handler(item.event)
+                ok = True
+            except (Exception, SystemExit) as e:
+                warn("failed to process {0}: {1}".format(item.event, e),
+                     RuntimeWarning)
+                ok = False
+            self._complete([item.seq])
+            with self._lock:
+                self._busy -= 1
+                if item.key is not None:
+                    del self._inflight[item.key]
+                    # events for this key may now be handled
+                    self._cond.notify_all()
+                if ok:
+                    self.processed += 1
+                else:
+                    self.failed += 1
+
+class PolyphemusPlugin(Plugin):
+    """This class provides the asynchronous event queue."""
+
+    requires = ('polyphemus.base',)
+
+    route = '/eventqueue'
+
+    defaultrc = RunControl(
+        event_workers=1,
+        event_queue_size=100,
+        event_debounce=5.0,
+        event_journal='events.journal',
+        )
+
+    rcdocs = {
+        'event_workers': ("The number of worker threads that process events. "
+                          "If this is zero, events are processed inline during "
+                          "the web request.  More than one worker handles "
+                          "events concurrently."),
+        'event_queue_size': ("The maximum number of events waiting to be processed. "
+                             "Requests that would exceed this are rejected with "
+                             "a 503 status."),
+        'event_debounce': ("The time, in seconds, that new and synchronized pull "
+                           "request events wait for newer events from the same "
+                           "pull request, which supersede them."),
+        'event_journal': ("The journal file of accepted events.  Events which were "
+                          "accepted but not completed are replayed on startup.  "
+                          "Each process writes to this name suffixed with its "
+                          "process id.  If None, events are not journaled."),
+        }
+
+    def update_argparser(self, parser):
+        parser.add_argument('--event-workers', dest='event_workers', type=int,
+                            help=self.rcdocs["event_workers"])
+        parser.add_argument('--event-queue-size', dest='event_queue_size', type=int,
+                            help=self.rcdocs["event_queue_size"])
+        parser.add_argument('--event-debounce', dest='event_debounce', type=float,
+                            help=self.rcdocs["event_debounce"])
+        parser.add_argument('--event-journal', dest='event_journal',
+                            help=self.rcdocs["event_journal"])
+
+    def setup(self, rc):
+        if rc.event_workers > 0:
+            journal = None
+            if rc.event_journal:
+                journal = EventJournal(rc.event_journal)
+                if rc.verbose and len(journal) > 0:
+                    print("replaying {0} events from {1}".format(len(journal), 
+                                                                rc.event_journal))
+            rc.event_queue = EventQueue(maxsize=rc.event_queue_size,
+                                        workers=rc.event_workers, 
+                                        debounce=rc.event_debounce, 
+                                        journal=journal)
+
+    def response(self, rc):
+        stats = rc.event_queue.stats() if 'event_queue' in rc else {}
+        return json.dumps(stats), None
+
+    def teardown(self, rc):
+        if 'event_queue' in rc:
+            rc.event_queue.stop()
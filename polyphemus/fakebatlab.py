@@ -0,0 +1,716 @@
+"""A local stand-in for a BaTLab submit host, along with a benchmark which
+measures how long polyphemus takes to get jobs onto it.
+
+The fake submit host is a paramiko SSH server which runs commands with bash in
+a private home directory and serves that directory over SFTP, so the usual
+tools which polyphemus calls on the submit host, such as ``git``, ``curl``,
+``unzip``, ``sed``, and ``tar``, are simply the local ones.  The BaTLab
+commands ``nmi_submit``, ``nmi_rm``, and ``condor_q`` are small shell scripts
+which keep a fake queue of jobs.  Latency may be injected into every command
+invocation, every SFTP request, and any individual command, to mimic a distant
+or busy submit host.
+
+The benchmark starts one or more fake submit hosts, points the BaTLab plugins
+at them, and pushes pull request events through ``polyphemus.batlabrun``
+concurrently.  It reports how long each stage of getting a job submitted took::
+
+    $ python -m polyphemus.fakebatlab --jobs 20 --workers 4 --exec-latency 0.05 \\
+        --latency nmi_submit=2
+
+Fake BaTLab API
+===============
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from getpass import getuser
+
+import paramiko
+
+from .utils import RunControl, check_cmd
+from .event import Event
+from .githubbase import PullRequestInfo, PullRequestRef
+from . import batlabbase
+from . import batlabrun
+from .batlabbase import SSH_POOL, BALANCER
+
+if sys.version_info[0] >= 3:
+    basestring = str
+    from shutil import which
+else:
+    from distutils.spawn import find_executable as which
+
+nmi_submit_template = """#!/bin/bash
+{sleep}
+if [ ! -f "$1" ]; then
+    echo "nmi_submit: cannot find run specification '$1'" >&2
+    exit 1
+fi
+exec 9>>{state}/lock
+flock 9
+n=$(( $(cat {state}/counter 2>/dev/null || echo 0) + 1 ))
+echo $n > {state}/counter
+gid="${{USER:-fake}}_fakebatlab_$(date +%s)_$n"
+echo $gid >> {state}/queue
+echo "Submitted run with global id: $gid"
+echo "Run spec: $(pwd)/$1"
+echo "http://localhost/nmi/results/details?runID=$n"
+"""
+
+nmi_rm_template = """#!/bin/bash
+{sleep}
+exec 9>>{state}/lock
+flock 9
+if ! grep -qx "$1" {state}/queue; then
+    echo "nmi_rm: no such run '$1'" >&2
+    exit 1
+fi
+grep -vx "$1" {state}/queue > {state}/queue.tmp
+mv {state}/queue.tmp {state}/queue
+echo "Removed run $1"
+"""
+
+condor_q_template = """#!/bin/bash
+{sleep}
+n=$(wc -l < {state}/queue)
+echo "-- Schedd: fakebatlab"
+echo "$n jobs; 0 completed, 0 removed, $n idle, 0 running, 0 held, 0 suspended"
+"""
+
+wrapper_template = """#!/bin/bash
+{sleep}
+exec {real} "$@"
+"""
+
+fake_commands = {
+    'nmi_submit': nmi_submit_template,
+    'nmi_rm': nmi_rm_template,
+    'condor_q': condor_q_template,
+    }
+"""The templates of the BaTLab commands which the fake submit host provides."""
+
+def _command_name(command):
+    """The name of the last command in a command line, e.g. 'nmi_submit' for
+    'cd job; nmi_submit x.run-spec'."""
+    words = command.split(';')[-1].split()
+    return words[0] if len(words) > 0 else ''
+
+class FakeSSHServer(paramiko.ServerInterface):
+    """The SSH side of a FakeBatLab, any user and any key or password may log
+    in and commands are handed to the FakeBatLab to run."""
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    def get_allowed_auths(self, username):
+        return 'publickey,password'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        if not isinstance(command, basestring):
+            command = command.decode('utf-8', 'replace')
+        # the exec reply goes out once this returns, the command must not run,
+        # and possibly close the channel, before then
+        replied = threading.Event()
+        t = threading.Thread(target=self.fake.run_command, 
+                             args=(channel, command, replied))
+        t.daemon = True
+        t.start()
+        replied.set()
+        return True
+
+class FakeSFTPInterface(paramiko.SFTPServerInterface):
+    """The SFTP side of a FakeBatLab.  Relative paths are resolved against
+    the fake home directory while absolute paths are used as is."""
+
+    def __init__(self, server, fake, *args, **kwargs):
+        super(FakeSFTPInterface, self).__init__(server, *args, **kwargs)
+        self.fake = fake
+
+    def _path(self, path):
+        self.fake.delay(self.fake.sftp_latency)
+        return os.path.join(self.fake.home, path)
+
+    def canonicalize(self, path):
+        return os.path.normpath(self._path(path))
+
+    def list_folder(self, path):
+        path = self._path(path)
+        try:
+            return [paramiko.SFTPAttributes.from_stat(
+                        os.lstat(os.path.join(path, f)), filename=f)
+                    for f in os.listdir(path)]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self._path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        path = self._path(path)
+        mode = getattr(attr, 'st_mode', None) or 0o666
+        try:
+            fd = os.open(path, flags | getattr(os, 'O_BINARY', 0), mode)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            fstr = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            fstr = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            fstr = 'rb'
+        f = os.fdopen(fd, fstr)
+        handle = paramiko.SFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self._path(oldpath), self._path(newpath))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(self._path(path), attr)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+class FakeBatLab(object):
+    """A fake BaTLab submit host listening on a local port.  Use it as a
+    context manager, or call start() and stop()::
+
+        with FakeBatLab(latency={'nmi_submit': 2.0}) as fake:
+            rc.batlab_submit_hosts = [fake.address]
+
+    """
+
+    def __init__(self, home=None, host='127.0.0.1', port=0, latency=None,
+                 exec_latency=0.0, sftp_latency=0.0, host_key=None):
+        """Parameters
+        ----------
+        home : str, optional
+            The home directory of the fake host, a temporary directory which is
+            removed on stop() by default.
+        host : str, optional
+            The address to listen on.
+        port : int, optional
+            The port to listen on, zero picks a free port.
+        latency : dict, optional
+            Maps command names, such as 'nmi_submit' or 'git', to the time in
+            seconds that each call of the command is delayed by.  This also
+            applies to commands run from within scripts.
+        exec_latency : float, optional
+            The time, in seconds, that every command invocation is delayed by.
+        sftp_latency : float, optional
+            The time, in seconds, that every SFTP request naming a path, e.g.
+            an open or a stat, is delayed by.
+        host_key : paramiko.PKey, optional
+            The host key, a new RSA key by default.
+
+        """
+        self._own_home = home is None
+        self.home = os.path.abspath(home or tempfile.mkdtemp(prefix='fakebatlab-'))
+        self.host = host
+        self.port = port
+        self.latency = dict(latency or {})
+        self.exec_latency = exec_latency
+        self.sftp_latency = sftp_latency
+        self.host_key = host_key or paramiko.RSAKey.generate(2048)
+        self.stats = {}
+        self._sock = None
+        self._transports = []
+        self._running = False
+        self._lock = threading.Lock()
+        self._env = None
+
+    @property
+    def address(self):
+        """The 'host:port' string to connect to."""
+        return "{0}:{1}".format(self.host, self.port)
+
+    @property
+    def state(self):
+        """The directory holding the fake job queue."""
+        return os.path.join(self.home, '.fakebatlab')
+
+    def queue(self):
+        """Returns the global ids of the jobs in the fake queue."""
+        with open(os.path.join(self.state, 'queue')) as f:
+            return [l.strip() for l in f if len(l.strip()) > 0]
+
+    def delay(self, t):
+        if t > 0:
+            time.sleep(t)
+
+    def _install_commands(self):
+        bindir = os.path.join(self.state, 'bin')
+        if not os.path.isdir(bindir):
+            os.makedirs(bindir)
+        open(os.path.join(self.state, 'queue'), 'a').close()
+        path = os.environ.get('PATH', os.defpath)
+        sleep = lambda name: "sleep {0}".format(self.latency[name]) \
+                             if self.latency.get(name, 0) > 0 else ""
+        scripts = {}
+        for name, template in fake_commands.items():
+            scripts[name] = template.format(sleep=sleep(name), state=self.state)
+        for name in self.latency:
+            if name in scripts:
+                continue
+            real = which(name)
+            if real is None:
+                raise ValueError("cannot add latency to {0!r}, it was not found "
+                                 "on the PATH".format(name))
+            scripts[name] = wrapper_template.format(sleep=sleep(name), real=real)
+        for name, script in scripts.items():
+            fname = os.path.join(bindir, name)
+            with open(fname, 'w') as f:
+                f.write(script)
+            os.chmod(fname, 0o755)
+        env = dict(os.environ)
+        env.update(HOME=self.home, PATH=bindir + os.pathsep + path)
+        self._env = env
+
+    def start(self):
+        """Installs the fake commands and starts serving in the background."""
+        self._install_commands()
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((self.host, self.port))
+        self.port = self._sock.getsockname()[1]
+        self._sock.listen(100)
+        self._sock.settimeout(0.5)
+        self._running = True
+        t = threading.Thread(target=self._serve)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        """Stops serving, closes all connections, and removes a temporary home."""
+        self._running = False
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        with self._lock:
+            transports, self._transports = self._transports, []
+        for t in transports:
+            t.close()
+        if self._own_home and os.path.isdir(self.home):
+            shutil.rmtree(self.home, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _serve(self):
+        while self._running:
+            try:
+                sock, addr = self._sock.accept()
+            except socket.timeout:
+                continue
+            except (socket.error, AttributeError):
+                break
+            t = threading.Thread(target=self._handle, args=(sock,))
+            t.daemon = True
+            t.start()
+
+    def _handle(self, sock):
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer,
+                                        FakeSFTPInterface, self)
+        with self._lock:
+            self._transports.append(transport)
+        try:
+            transport.start_server(server=FakeSSHServer(self))
+        except (paramiko.SSHException, socket.error, EOFError):
+            transport.close()
+            return
+        # channels are handled as they are requested, this only drains them.
+        # The accepted channels are held on to until they close, since paramiko
+        # closes a channel once nothing refers to it.
+        channels = []
+        while self._running and transport.is_active():
+            channel = transport.accept(1.0)
+            channels = [c for c in channels if not c.closed]
+            if channel is not None:
+                channels.append(channel)
+
+    def run_command(self, channel, command, replied=None):
+        """Runs a command line for a channel with bash, relaying stdin, stdout,
+        stderr, and the exit status.  If given, the command waits for the 
+        replied event, which is set once the exec request has been answered."""
+        if replied is not None:
+            replied.wait()
+        start = time.time()
+        self.delay(self.exec_latency)
+        proc = subprocess.Popen(['bash', '-c', command], cwd=self.home,
+                                env=self._env, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        pumps = [threading.Thread(target=self._pump_out,
+                                  args=(proc.stdout, channel.sendall)),
+                 threading.Thread(target=self._pump_out,
+                                  args=(proc.stderr, channel.sendall_stderr))]
+        stdin = threading.Thread(target=self._pump_in, args=(channel, proc.stdin))
+        stdin.daemon = True
+        stdin.start()
+        for t in pumps:
+            t.start()
+        for t in pumps:
+            t.join()
+        rtn = proc.wait()
+        try:
+            channel.send_exit_status(rtn)
+        finally:
+            channel.close()
+        name = _command_name(command)
+        with self._lock:
+            count, total = self.stats.get(name, (0, 0.0))
+            self.stats[name] = (count + 1, total + time.time() - start)
+
+    def _pump_in(self, channel, f):
+        try:
+            while True:
+                data = channel.recv(32768)
+                if len(data) == 0:
+                    break
+                f.write(data)
+                f.flush()
+        except (IOError, OSError, socket.error, EOFError):
+            pass
+        finally:
+            try:
+                f.close()
+            except (IOError, OSError):
+                pass
+
+    def _pump_out(self, f, send):
+        try:
+            while True:
+                data = os.read(f.fileno(), 32768)
+                if len(data) == 0:
+                    break
+                send(data)
+        except (IOError, OSError, socket.error, EOFError):
+            pass
+        finally:
+            f.close()
+
+#
+# Benchmark
+#
+
+run_spec_template = """description = polyphemus benchmark
+project = polyphemus
+component = polyphemus
+component_version = 0.0
+platforms = x86_64_Ubuntu12
+inputs = fetch/project.git
+remote_task = remote_task.sh
+"""
+
+STAGES = ('connect', 'wait', 'upload', 'prep', 'submit', 'total')
+"""The stages of submitting a job which the benchmark reports on.  The wait
+stage is the time spent waiting for a free slot on the submit host."""
+
+class StageTimer(object):
+    """Records when each thread enters and leaves the stages of a job."""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def begin(self):
+        self._local.marks = {'begin': time.time()}
+
+    def end(self):
+        """Returns the stage durations of the job on this thread, None for
+        stages that were never reached."""
+        marks = self._local.marks
+        marks['end'] = time.time()
+        get = marks.get
+        span = lambda a, b: get(b) - get(a) if a in marks and b in marks else None
+        return {'connect': span('begin', 'connect_end'),
+                'wait': span('connect_end', 'upload_start'),
+                'upload': span('upload_start', 'upload_end'),
+                'prep': span('prep_start', 'prep_end'),
+                'submit': span('prep_end', 'end'),
+                'total': span('begin', 'end')}
+
+    def wrap(self, func, stage):
+        """Wraps a function so that calling it counts towards a stage."""
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                marks = getattr(self._local, 'marks', None)
+                if marks is not None:
+                    marks.setdefault(stage + '_start', start)
+                    marks[stage + '_end'] = time.time()
+        return timed
+
+def _make_scripts_repo(path):
+    os.makedirs(os.path.join(path, 'fetch'))
+    files = {'cmd.run-spec': run_spec_template,
+             'fetch/project.git': batlabrun.git_fetch_template.format(
+                    repo_url='file:///dev/null', repo_dir='project', branch='master'),
+             'remote_task.sh': "#!/bin/bash\necho building\n"}
+    for name, content in files.items():
+        with open(os.path.join(path, name), 'w') as f:
+            f.write(content)
+    git = ['git', '-C', path, '-c', 'user.name=polyphemus',
+           '-c', 'user.email=polyphemus@localhost']
+    for args in (['init', '--quiet'], ['add', '.'],
+                 ['commit', '--quiet', '-m', 'benchmark scripts']):
+        rtn, out = check_cmd(git + args)
+        if rtn != 0:
+            raise RuntimeError("git {0} failed:\n{1}".format(args[0], out))
+
+def _pull_request(number, round=0):
+    # every round has new head commits, so that it is not a duplicate build
+    base = PullRequestRef(('polyphemus', 'benchmark'), ref='master', sha='0' * 40)
+    head = PullRequestRef(('contributor', 'benchmark'), ref='pr-{0}'.format(number),
+                          sha='{0:020x}{1:020x}'.format(round, number),
+                          clone_url='file:///dev/null')
+    return PullRequestInfo(number, base, head, title='benchmark',
+                           user='contributor', state='open')
+
+def _percentile(xs, p):
+    xs = sorted(xs)
+    return xs[min(int(p * len(xs)), len(xs) - 1)]
+
+def benchmark(jobs=10, workers=4, hosts=1, rounds=1, latency=None,
+              exec_latency=0.0, sftp_latency=0.0, max_concurrent=4,
+              verbose=False):
+    """Submits jobs for a number of pull requests to fake submit hosts through
+    the batlabrun plugin and times each stage of every job.
+
+    Parameters
+    ----------
+    jobs : int, optional
+        The number of pull requests.
+    workers : int, optional
+        The number of jobs that are worked on concurrently, as the event
+        workers would.
+    hosts : int, optional
+        The number of fake submit hosts.
+    rounds : int, optional
+        The number of times that every pull request is submitted.  The first
+        round opens the pull requests, later rounds synchronize them, which
+        kills the earlier jobs.
+    latency, exec_latency, sftp_latency : optional
+        The latencies injected into the fake submit hosts, see FakeBatLab.
+    max_concurrent : int, optional
+        The maximum number of jobs worked on concurrently on each submit host.
+    verbose : bool, optional
+        Print each job as it finishes.
+
+    Returns
+    -------
+    results : list of dicts
+        Per round, the 'wall' clock time, the 'jobs' as a list of dicts of
+        the stage durations along with the job's 'status' and 'description',
+        and the number of new SSH 'connects'.
+
+    """
+    tmpdir = tempfile.mkdtemp(prefix='polyphemus-bench-')
+    fakes = [FakeBatLab(latency=latency, exec_latency=exec_latency,
+                        sftp_latency=sftp_latency) for i in range(hosts)]
+    base = batlabbase.PolyphemusPlugin()
+    run = batlabrun.PolyphemusPlugin()
+    timer = StageTimer()
+    run_script = batlabrun.run_script
+    try:
+        for fake in fakes:
+            fake.start()
+        scripts = os.path.join(tmpdir, 'scripts.git')
+        _make_scripts_repo(scripts)
+        key_file = os.path.join(tmpdir, 'id_rsa')
+        paramiko.RSAKey.generate(2048).write_private_key_file(key_file)
+        rc = RunControl()
+        rc._update(base.defaultrc)
+        rc._update(run.defaultrc)
+        rc._update(RunControl(server_url='http://localhost', port=5000,
+            verbose=False, ssh_key_file=key_file, batlab_user=getuser(),
+            batlab_submit_hosts=[fake.address for fake in fakes],
+            batlab_max_concurrent=max_concurrent,
+            batlab_jobs_cache=os.path.join(tmpdir, 'jobs.cache'),
+            batlab_scripts_url=scripts, batlab_fetch_file='fetch/project.git',
+            batlab_run_spec='cmd.run-spec',
+            batlab_scripts_cache=os.path.join(tmpdir, 'scripts-cache'),
+            batlab_results_cache=os.path.join(tmpdir, 'results.cache')))
+        base.setup(rc)
+        run.setup(rc)
+        BALANCER.choose = timer.wrap(BALANCER.choose, 'connect')
+        SSH_POOL.client = timer.wrap(SSH_POOL.client, 'connect')
+        run._upload_job = timer.wrap(run._upload_job, 'upload')
+        batlabrun.run_script = timer.wrap(run_script, 'prep')
+
+        results = []
+        for r in range(rounds):
+            name = 'github-pr-new' if r == 0 else 'github-pr-sync'
+            pending = list(range(1, jobs + 1))
+            times = []
+            lock = threading.Lock()
+            connects = SSH_POOL.connects
+            def work():
+                while True:
+                    with lock:
+                        if len(pending) == 0:
+                            return
+                        number = pending.pop(0)
+                    pr = _pull_request(number, r)
+                    view = rc._view(event=Event(name, data=pr))
+                    timer.begin()
+                    run.execute(view)
+                    t = timer.end()
+                    t.update(number=number, status=view.event.data['status'],
+                             description=view.event.data['description'])
+                    if verbose:
+                        print("round {0} job {1}: {2} in {3:.3f} s ({4})".format(
+                              r + 1, number, t['status'], t['total'],
+                              t['description']))
+                    with lock:
+                        times.append(t)
+            start = time.time()
+            threads = [threading.Thread(target=work) for i in range(workers)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            results.append({'round': r + 1, 'event': name,
+                            'wall': time.time() - start, 'jobs': times,
+                            'connects': SSH_POOL.connects - connects})
+        return results
+    finally:
+        batlabrun.run_script = run_script
+        for obj, attr in ((BALANCER, 'choose'), (SSH_POOL, 'client')):
+            if attr in obj.__dict__:
+                delattr(obj, attr)
+        SSH_POOL.close()
+        for fake in fakes:
+            fake.stop()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def report(results, out=None):
+    """Prints a summary of benchmark() results."""
+    out = out or sys.stdout
+    for res in results:
+        jobs = res['jobs']
+        ok = len([j for j in jobs if j['status'] == 'pending'])
+        print("round {0} ({1}): {2}/{3} jobs submitted in {4:.3f} s, {5:.2f} jobs/s, "
+              "{6} new connections".format(res['round'], res['event'], ok,
+              len(jobs), res['wall'], len(jobs) / max(res['wall'], 1e-9),
+              res['connects']), file=out)
+        print("  {0:<8} {1:>9} {2:>9} {3:>9} {4:>9}".format(
+              'stage', 'mean', 'median', 'p90', 'max'), file=out)
+        for stage in STAGES:
+            xs = [j[stage] for j in jobs if j[stage] is not None]
+            if len(xs) == 0:
+                continue
+            print("  {0:<8} {1:>9.4f} {2:>9.4f} {3:>9.4f} {4:>9.4f}".format(stage,
+                  sum(xs) / len(xs), _percentile(xs, 0.5), _percentile(xs, 0.9),
+                  max(xs)), file=out)
+        failed = [j for j in jobs if j['status'] != 'pending']
+        for j in failed[:5]:
+            print("  job {0} failed: {1}".format(j['number'], j['description']),
+                  file=out)
+
+def _latency_arg(s):
+    name, _, t = s.partition('=')
+    try:
+        return name, float(t)
+    except ValueError:
+        raise argparse.ArgumentTypeError("latency must be given as "
+                                         "COMMAND=SECONDS, got {0!r}".format(s))
+
+def main(args=None):
+    """Command line interface to the benchmark."""
+    parser = argparse.ArgumentParser("polyphemus-fakebatlab", description=(
+        "Benchmarks submitting BaTLab jobs against local fake submit hosts."))
+    parser.add_argument('-n', '--jobs', type=int, default=10,
+                        help="the number of pull requests")
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help="the number of jobs worked on concurrently")
+    parser.add_argument('--hosts', type=int, default=1,
+                        help="the number of fake submit hosts")
+    parser.add_argument('--rounds', type=int, default=1, help=(
+                        "the number of times each pull request is submitted, "
+                        "later rounds kill the earlier jobs"))
+    parser.add_argument('--max-concurrent', type=int, default=4,
+                        dest='max_concurrent',
+                        help="the maximum number of jobs per submit host")
+    parser.add_argument('--exec-latency', type=float, default=0.0,
+                        dest='exec_latency',
+                        help="the delay, in seconds, of every remote command")
+    parser.add_argument('--sftp-latency', type=float, default=0.0,
+                        dest='sftp_latency',
+                        help="the delay, in seconds, of every SFTP request")
+    parser.add_argument('--latency', type=_latency_arg, action='append',
+                        default=[], metavar='COMMAND=SECONDS',
+                        help="the delay of a single command, e.g. nmi_submit=2")
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help="print each job as it finishes")
+    ns = parser.parse_args(args)
+    results = benchmark(jobs=ns.jobs, workers=ns.workers, hosts=ns.hosts,
+                        rounds=ns.rounds, latency=dict(ns.latency),
+                        exec_latency=ns.exec_latency, sftp_latency=ns.sftp_latency,
+                        max_concurrent=ns.max_concurrent, verbose=ns.verbose)
+    report(results)
+
+if __name__ == '__main__':
+    main()
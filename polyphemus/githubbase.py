@@ -1,4 +1,6 @@
-"""The plugin to interact with github.
+"""The plugin to interact with github.  The remaining GitHub rate limit budget
+and the response cache and client pool statistics are served as JSON from the 
+``/github/ratelimit`` route.
 
 This module is available as an polyphemus plugin by the name `polyphemus.githubbase`.
 
@@ -10,14 +12,21 @@ import os
 import io
 import sys
 import pprint
+import time
 import socket
+import calendar
+import threading
 from warnings import warn
-from collections import Sequence
+from collections import Sequence, OrderedDict
+from contextlib import contextmanager
 from getpass import getuser, getpass
 from tempfile import NamedTemporaryFile
 
 if sys.version_info[0] >= 3:
     basestring = str
+    from queue import Queue, Full
+else:
+    from Queue import Queue, Full
 
 try:
     import simplejson as json
@@ -26,10 +35,12 @@ except ImportError:
 
 from github3 import GitHub, pull_request, repository
 import github3.events
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
 from flask import request
 
 from .utils import RunControl, NotSpecified, writenewonly, newoverwrite, \
-    DEFAULT_RC_FILE, DEFAULT_PLUGINS, nyansep, indent, check_cmd
+    DEFAULT_RC_FILE, DEFAULT_PLUGINS, nyansep, indent, check_cmd, PersistentCache
 from .plugins import Plugin
 from .event import Event, runfor
 
@@ -73,15 +84,711 @@ def ensure_logged_in(gh, user=None, credfile='gh.cred'):
         print("github username not specified, found {0!r}".format(user))
     if not os.path.isfile(credfile):
         gh_make_token(gh, user, credfile=credfile)
-    with io.open(credfile, 'r') as f:
-        token = f.readline().strip()  
-        id = f.readline().strip()
-    gh.login(username=user, token=token)
+    gh.login(username=user, token=load_token(credfile))
 
-_stat_key = lambda s: s.created_at
+_tokens = {}
+_tokens_lock = threading.Lock()
+
+def load_token(credfile='gh.cred'):
+    """Returns the token stored in a github credentials file.  The file is only
+    re-read when its modification time changes.
+
+    Parameters
+    ----------
+    credfile : str, optional
+        The github credentials file name.
+
+    """
+    mtime = os.path.getmtime(credfile)
+    with _tokens_lock:
+        cached = _tokens.get(credfile, None)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with io.open(credfile, 'r') as f:
+            token = f.readline().strip()
+        _tokens[credfile] = (mtime, token)
+        return token
+
+class _CacheEntry(object):
+    """A cached response."""
+
+    __slots__ = ('etag', 'last_modified', 'status', 'headers', 'content', 'encoding')
+
+    def __init__(self, resp):
+        self.etag = resp.headers.get('ETag')
+        self.last_modified = resp.headers.get('Last-Modified')
+        self.status = resp.status_code
+        self.headers = CaseInsensitiveDict(resp.headers)
+        self.content = resp.content
+        self.encoding = resp.encoding
+
+class ResponseCache(object):
+    """A size-bounded LRU cache of GitHub API GET responses, keyed by URL and 
+    credentials.  Cached responses are revalidated with conditional requests,
+    which GitHub does not count against the rate limit when they return 304.
+    """
+
+    def __init__(self, maxsize=1024):
+        """Parameters
+        ----------
+        maxsize : int, optional
+            The maximum number of responses to keep.
+
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the cached entry for a key, or None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry  # move to the most recent end
+            return entry
+
+    def put(self, key, resp):
+        """Caches a response."""
+        entry = _CacheEntry(resp)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def record(self, hit):
+        """Counts a cache hit or miss."""
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        """Returns a dictionary of the cache statistics."""
+        with self._lock:
+            return {'size': len(self._entries), 'maxsize': self.maxsize,
+                    'hits': self.hits, 'misses': self.misses}
+
+RESPONSE_CACHE = ResponseCache()
+"""The response cache that is shared by all pooled GitHub clients."""
+
+HIGH, NORMAL, LOW = 0, 1, 2
+"""GitHub request priorities.  Status writes are high priority, background
+reads such as dashboard reconciliation and hook verification are low."""
+
+class RateLimitExceeded(RuntimeError):
+    """Raised when a GitHub request is deferred because too little of the rate
+    limit remains for its priority."""
+
+_priority = threading.local()
+
+@contextmanager
+def github_priority(priority):
+    """A context manager which sets the priority of the GitHub requests made 
+    by the current thread, e.g. ``with github_priority(LOW): ...``."""
+    prev = getattr(_priority, 'value', NORMAL)
+    _priority.value = priority
+    try:
+        yield
+    finally:
+        _priority.value = prev
+
+class RateLimiter(object):
+    """Schedules GitHub requests against the hourly rate limit.  The limit,
+    remaining budget, and reset time are tracked from the X-RateLimit headers 
+    of every response.  Each priority keeps a reserve of the budget which it
+    may not dip into, so that low priority reads are deferred well before high
+    priority status writes.  Once the budget is spent, waiting requests are
+    released in priority order when the limit resets.
+    """
+
+    def __init__(self, reserves=(0, 50, 200), max_wait=60.0):
+        """Parameters
+        ----------
+        reserves : sequence of int, optional
+            The budget that must remain for a request of each priority (HIGH, 
+            NORMAL, LOW) to be sent.
+        max_wait : float, optional
+            The longest time, in seconds, that a request waits for the limit
+            to reset.  High priority requests are sent regardless after this,
+            others raise RateLimitExceeded.
+
+        """
+        self.reserves = list(reserves)
+        self.max_wait = max_wait
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.sent = [0, 0, 0]
+        self.deferred = [0, 0, 0]
+        self._waiting = [0, 0, 0]
+        self._cond = threading.Condition(threading.Lock())
+
+    def _allowed(self, priority, now):
+        if self.remaining is None or (self.reset is not None and now >= self.reset):
+            return True
+        if any(self._waiting[:priority]):
+            return False  # higher priorities go first
+        return self.remaining > self.reserves[priority]
+
+    def acquire(self, priority=None):
+        """Blocks until a request of the given priority, which defaults to the 
+        priority of the current thread, may be sent."""
+        priority = getattr(_priority, 'value', NORMAL) if priority is None \
+                   else priority
+        with self._cond:
+            now = time.time()
+            deadline = now + self.max_wait
+            self._waiting[priority] += 1
+            try:
+                while not self._allowed(priority, now):
+                    if now >= deadline:
+                        if priority == HIGH:
+                            break
+                        self.deferred[priority] += 1
+                        raise RateLimitExceeded("GitHub rate limit nearly exhausted, "
+                                                "{0} of {1} requests remain".format(
+                                                self.remaining, self.limit))
+                    until = deadline if self.reset is None else \
+                            min(deadline, self.reset)
+                    self._cond.wait(max(until - now, 0.01))
+                    now = time.time()
+            finally:
+                self._waiting[priority] -= 1
+                self._cond.notify_all()
+            if self.remaining is not None and self.remaining > 0:
+                self.remaining -= 1  # until the response tells us otherwise
+            self.sent[priority] += 1
+
+    def update(self, headers):
+        """Updates the budget from the headers of a GitHub response."""
+        if 'X-RateLimit-Remaining' not in headers:
+            return
+        with self._cond:
+            self.limit = int(headers.get('X-RateLimit-Limit', self.limit or 0))
+            self.remaining = int(headers['X-RateLimit-Remaining'])
+            if 'X-RateLimit-Reset' in headers:
+                self.reset = float(headers['X-RateLimit-Reset'])
+            self._cond.notify_all()
+
+    def stats(self):
+        """Returns a dictionary of the rate limit budget and scheduling counts."""
+        with self._cond:
+            return {'limit': self.limit, 'remaining': self.remaining, 
+                    'reset': self.reset, 'sent': list(self.sent), 
+                    'deferred': list(self.deferred), 
+                    'waiting': list(self._waiting)}
+
+RATE_LIMITER = RateLimiter()
+"""The rate limiter that is shared by all pooled GitHub clients."""
+
+class CachingAdapter(HTTPAdapter):
+    """A requests transport adapter which serves GET requests from a 
+    ResponseCache, revalidating them with If-None-Match or If-Modified-Since.
+    Requests which are already conditional are passed through untouched.
+    Every request is first scheduled with a RateLimiter.
+    """
+
+    def __init__(self, cache=RESPONSE_CACHE, limiter=RATE_LIMITER, *args, **kwargs):
+        self.cache = cache
+        self.limiter = limiter
+        super(CachingAdapter, self).__init__(*args, **kwargs)
+
+    def send(self, prepared, **kwargs):
+        if self.limiter is None:
+            return self._send(prepared, **kwargs)
+        self.limiter.acquire()
+        resp = self._send(prepared, **kwargs)
+        self.limiter.update(resp.headers)
+        return resp
+
+    def _send(self, prepared, **kwargs):
+        headers = prepared.headers
+        if prepared.method != 'GET' or kwargs.get('stream', False) or \
+           'If-None-Match' in headers or 'If-Modified-Since' in headers:
+            return super(CachingAdapter, self).send(prepared, **kwargs)
+        key = (prepared.url, headers.get('Authorization'), headers.get('Accept'))
+        entry = self.cache.get(key)
+        if entry is not None:
+            if entry.etag is not None:
+                headers['If-None-Match'] = entry.etag
+            else:
+                headers['If-Modified-Since'] = entry.last_modified
+        resp = super(CachingAdapter, self).send(prepared, **kwargs)
+        if resp.status_code == 304 and entry is not None:
+            self.cache.record(True)
+            fresh = resp.headers
+            resp.headers = CaseInsensitiveDict(entry.headers)
+            resp.headers.update(fresh)
+            resp.status_code = entry.status
+            resp.encoding = entry.encoding
+            resp._content = entry.content
+            return resp
+        self.cache.record(False)
+        if resp.status_code == 200 and ('ETag' in resp.headers or 
+                                        'Last-Modified' in resp.headers):
+            self.cache.put(key, resp)
+        return resp
+
+class ClientPool(object):
+    """A process-wide pool of GitHub clients, keyed by credentials.  A client 
+    is only used by one thread at a time: a thread keeps its client for as 
+    long as it lives, after which the client is handed to the next thread that 
+    asks for one.  Short lived threads, such as those serving web requests, 
+    thus reuse the keep-alive HTTP sessions of earlier ones.
+    """
+
+    def __init__(self):
+        self._owned = {}
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def checkout(self, key):
+        """Returns the mutable [client, token] entry of the current thread for
+        a key, which is [None, None] if a new client must be made."""
+        me = threading.current_thread()
+        with self._lock:
+            owned = self._owned.setdefault(key, {})
+            entry = owned.get(me, None)
+            if entry is None:
+                idle = self._idle.setdefault(key, [])
+                for t in [t for t in owned if not t.is_alive()]:
+                    idle.append(owned.pop(t))
+                entry = owned[me] = idle.pop() if len(idle) > 0 else [None, None]
+            return entry
+
+    def stats(self):
+        """Returns the number of clients in use and idle."""
+        with self._lock:
+            return {'in_use': sum([len(o) for o in self._owned.values()]),
+                    'idle': sum([len(i) for i in self._idle.values()])}
+
+GITHUB_CLIENTS = ClientPool()
+"""The pool of GitHub clients for this process."""
+
+_default_login = {'user': None, 'credfile': None}
+
+def github_session(user=None, credfile=None):
+    """Returns a logged in GitHub client from the process-wide GITHUB_CLIENTS
+    pool.  The client belongs to the calling thread until the thread ends.
+    Clients are logged in again only when the token in the credentials file 
+    changes.  GET requests are served from the shared RESPONSE_CACHE when 
+    GitHub reports that they have not been modified.
+
+    Parameters
+    ----------
+    user : str, None, or NotSpecified, optional
+        The username to log into github with.  Defaults to the github_user 
+        run control parameter.
+    credfile : str or None, optional
+        The github credentials file name.  Defaults to the github_credentials
+        run control parameter.  If this is None or the file does not exist, an 
+        anonymous client is returned.
+
+    """
+    if credfile is None:
+        user, credfile = _default_login['user'], _default_login['credfile']
+    if user is NotSpecified:
+        user = None
+    entry = GITHUB_CLIENTS.checkout((user, credfile))
+    gh, token = entry
+    if gh is None:
+        gh = GitHub()
+        gh._session.mount('https://', CachingAdapter(RESPONSE_CACHE, RATE_LIMITER))
+    if credfile is not None and os.path.isfile(credfile):
+        newtoken = load_token(credfile)
+        if newtoken != token:
+            gh.login(username=user or getuser(), token=newtoken)
+            token = newtoken
+    entry[:] = [gh, token]
+    return gh
+
+def _parse_timestamp(s):
+    """Converts a GitHub ISO 8601 timestamp into seconds since the epoch."""
+    if not s:
+        return None
+    return float(calendar.timegm(time.strptime(s, '%Y-%m-%dT%H:%M:%SZ')))
+
+class PullRequestRef(object):
+    """A lightweight description of the base or head of a pull request."""
+
+    __slots__ = ('repo', 'ref', 'sha', 'label', '_clone_url')
+
+    def __init__(self, repo, ref=None, sha=None, label=None, clone_url=None):
+        """Parameters
+        ----------
+        repo : tuple of str
+            The (owner, repository) that this ref lives in.
+        ref : str, optional
+            The branch name.
+        sha : str, optional
+            The commit hash.
+        label : str, optional
+            The 'owner:branch' label.
+        clone_url : str, optional
+            The URL to clone the repository from.  If not given, this is 
+            looked up on GitHub when first needed.
+
+        """
+        self.repo = tuple(repo)
+        self.ref = ref
+        self.sha = sha
+        self.label = label
+        self._clone_url = clone_url
+
+    @classmethod
+    def from_payload(cls, data):
+        """Creates a ref from the 'base' or 'head' dictionary of a webhook 
+        pull request payload."""
+        repo = data.get('repo') or {}
+        owner = (repo.get('owner') or {}).get('login', '')
+        return cls((owner, repo.get('name', '')), ref=data.get('ref'), 
+                   sha=data.get('sha'), label=data.get('label'),
+                   clone_url=repo.get('clone_url'))
+
+    @property
+    def clone_url(self):
+        """The URL to clone the repository from."""
+        if self._clone_url is None:
+            self._clone_url = github_session().repository(*self.repo).clone_url
+        return self._clone_url
+
+    def __getstate__(self):
+        return dict([(k, getattr(self, k)) for k in self.__slots__])
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
+    def __repr__(self):
+        return "{0}(repo={1!r}, ref={2!r}, sha={3!r})".format(
+                self.__class__.__name__, self.repo, self.ref, self.sha)
+
+class PullRequestInfo(object):
+    """A lightweight description of a pull request that is built from webhook
+    payloads, so that plugins need not fetch the pull request from GitHub.  
+    Fields which are missing from the payload, such as a mergeable state that 
+    GitHub has not yet computed, are fetched from the API when first needed.
+    """
+
+    __slots__ = ('number', 'base', 'head', 'html_url', 'title', 'user', 'state',
+                 'created_at', 'merged', '_mergeable', '_pr')
+
+    def __init__(self, number, base, head, html_url=None, title=None, user=None,
+                 state=None, created_at=None, mergeable=None, merged=False, pr=None):
+        """Parameters
+        ----------
+        number : int
+            The pull request number.
+        base : PullRequestRef
+            The branch that will be merged into.
+        head : PullRequestRef
+            The branch that has the changes.
+        html_url : str, optional
+            The web page of the pull request.
+        title : str, optional
+            The pull request title.
+        user : str, optional
+            The login of the pull request author.
+        state : str, optional
+            Either 'open' or 'closed'.
+        created_at : float, optional
+            When the pull request was opened, in seconds since the epoch.
+        mergeable : bool or None, optional
+            Whether the pull request may be merged, None if unknown.
+        merged : bool, optional
+            Whether the pull request has been merged.
+        pr : github3.pulls.PullRequest, optional
+            The full pull request, if it has already been fetched.
+
+        """
+        self.number = number
+        self.base = base
+        self.head = head
+        self.html_url = html_url
+        self.title = title
+        self.user = user
+        self.state = state
+        self.created_at = created_at
+        self.merged = merged
+        self._mergeable = mergeable
+        self._pr = pr
+
+    @classmethod
+    def from_payload(cls, data):
+        """Creates a pull request from the 'pull_request' dictionary of a 
+        webhook payload."""
+        return cls(data['number'], PullRequestRef.from_payload(data['base']),
+                   PullRequestRef.from_payload(data['head']), 
+                   html_url=data.get('html_url'), title=data.get('title'),
+                   user=(data.get('user') or {}).get('login'), 
+                   state=data.get('state'), 
+                   created_at=_parse_timestamp(data.get('created_at')),
+                   mergeable=data.get('mergeable'), merged=bool(data.get('merged')))
+
+    @classmethod
+    def from_pull_request(cls, pr):
+        """Creates a pull request from a github3 PullRequest object."""
+        base = PullRequestRef(pr.base.repo, pr.base.ref, pr.base.sha, pr.base.label)
+        head = PullRequestRef(pr.head.repo, pr.head.ref, pr.head.sha, pr.head.label)
+        user = getattr(pr.user, 'login', None)
+        created_at = None
+        if pr.created_at is not None:
+            created_at = float(calendar.timegm(pr.created_at.utctimetuple()))
+        return cls(pr.number, base, head, html_url=pr.html_url, title=pr.title, 
+                   user=user, state=pr.state, created_at=created_at, 
+                   mergeable=pr.mergeable, merged=pr.merged_at is not None, pr=pr)
+
+    def _api(self):
+        """Returns the full github3 pull request, fetching it if needed."""
+        if self._pr is None:
+            self._pr = github_session().pull_request(self.base.repo[0], 
+                                                     self.base.repo[1], self.number)
+        return self._pr
+
+    @property
+    def mergeable(self):
+        """Whether the pull request may be merged."""
+        if self._mergeable is None:
+            self._mergeable = self._api().mergeable
+        return self._mergeable
+
+    def iter_files(self, number=-1):
+        """Iterates over the files in the pull request, see 
+        github3.pulls.PullRequest.iter_files()."""
+        return self._api().iter_files(number)
+
+    def __getstate__(self):
+        return dict([(k, getattr(self, k)) for k in self.__slots__ if k != '_pr'])
+
+    def __setstate__(self, state):
+        self._pr = None
+        for k, v in state.items():
+            setattr(self, k, v)
+
+    def __eq__(self, other):
+        if not isinstance(other, PullRequestInfo):
+            return NotImplemented
+        return (self.base.repo, self.number, self.head.sha) == \
+               (other.base.repo, other.number, other.head.sha)
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    def __hash__(self):
+        return hash((self.base.repo, self.number, self.head.sha))
+
+    def __repr__(self):
+        return "{0}({1}/{2}#{3}, head={4!r})".format(self.__class__.__name__, 
+                self.base.repo[0], self.base.repo[1], self.number, self.head.sha)
+
+class PullRequestStore(object):
+    """A local store of pull requests and their latest statuses.  This is kept
+    current by the events that polyphemus processes and is reconciled with 
+    GitHub in the background, so that the dashboard does not need to ask 
+    GitHub for anything.  Records are dictionaries keyed by (owner, 
+    repository, number) and every update is stamped with an increasing 
+    sequence number.  Subscribers receive a copy of every updated record.
+    """
+
+    _pr_fields = ('html_url', 'title', 'user', 'state', 'created_at')
+
+    def __init__(self):
+        self.seq = 0
+        self.reconciled = None
+        self._records = {}
+        self._cache = None
+        self._batching = 0
+        self._dirty = {}
+        self._subscribers = []
+        self._lock = threading.RLock()
+
+    def open(self, cachefile):
+        """Loads and persists the records in a cache file."""
+        with self._lock:
+            self._cache = PersistentCache(cachefile=cachefile)
+            self._records = dict(self._cache.items())
+            self.seq = max([rec['seq'] for rec in self._records.values()] or [0])
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, key):
+        """Returns a copy of the record for a key, or None."""
+        with self._lock:
+            rec = self._records.get(key, None)
+            return None if rec is None else dict(rec)
+
+    def update(self, key, **fields):
+        """Updates the fields of a record, creating it if needed.  Fields whose
+        value is None are ignored.  Returns a copy of the record."""
+        with self._lock:
+            rec = self._records.get(key, None)
+            if rec is None:
+                rec = {'owner': key[0], 'repo': key[1], 'number': key[2],
+                       'html_url': None, 'title': None, 'user': None, 
+                       'state': 'open', 'created_at': None, 'status': None, 
+                       'batlab_gid': None, 'updated_at': None}
+            else:
+                rec = dict(rec)
+            fields = dict([(k, v) for k, v in fields.items() if v is not None])
+            if all([rec.get(k, None) == v for k, v in fields.items()]) and \
+               key in self._records:
+                return dict(rec)
+            rec.update(fields)
+            self.seq += 1
+            rec['seq'] = self.seq
+            rec['updated_at'] = time.time()
+            self._records[key] = rec
+            if self._batching > 0:
+                self._dirty[key] = rec
+            elif self._cache is not None:
+                self._cache[key] = rec
+            for q in self._subscribers:
+                try:
+                    q.put_nowait(dict(rec))
+                except Full:
+                    pass  # slow subscribers catch up from the sequence numbers
+            return dict(rec)
+
+    @contextmanager
+    def batch(self):
+        """A context manager which defers persisting updates until it exits, 
+        when all of the updated records are written at once, e.g. 
+        ``with store.batch(): ...`` while reconciling."""
+        with self._lock:
+            self._batching += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batching -= 1
+                if self._batching == 0 and len(self._dirty) > 0:
+                    dirty, self._dirty = self._dirty, {}
+                    if self._cache is not None:
+                        self._cache.update(dirty)
+
+    def subscribe(self, maxsize=1000):
+        """Returns a queue which receives a copy of every record that is 
+        updated from now on.  Call unsubscribe() with the queue when done."""
+        q = Queue(maxsize)
+        with self._lock:
+            self._subscribers.append(q)
+        return q
+
+    def unsubscribe(self, q):
+        """Stops sending updated records to a subscribed queue."""
+        with self._lock:
+            if q in self._subscribers:
+                self._subscribers.remove(q)
+
+    def update_pull_request(self, pr):
+        """Updates the store from a PullRequestInfo."""
+        key = tuple(pr.base.repo) + (pr.number,)
+        fields = dict([(k, getattr(pr, k)) for k in self._pr_fields])
+        return self.update(key, **fields)
+
+    def update_status(self, key, state, description='', target_url='', sha=None):
+        """Updates the latest status of a pull request."""
+        status = {'state': state, 'description': description, 
+                  'target_url': target_url, 'sha': sha}
+        return self.update(tuple(key), status=status)
+
+    def pull_requests(self, owner, repo, state=None):
+        """Returns copies of the records for a repository, most recent first.
+
+        Parameters
+        ----------
+        owner : str
+            The repository owner.
+        repo : str
+            The repository name.
+        state : str or None, optional
+            If given, only pull requests in this state, 'open' or 'closed', 
+            are returned.
+
+        """
+        with self._lock:
+            recs = [dict(rec) for rec in self._records.values() if 
+                    rec['owner'] == owner and rec['repo'] == repo and 
+                    (state is None or rec['state'] == state)]
+        sortkey = (lambda r: r['number']) if state == 'open' else \
+                  (lambda r: r['seq'])
+        recs.sort(key=sortkey, reverse=True)
+        return recs
+
+PR_STORE = PullRequestStore()
+"""The local pull request store for this process."""
+
+def reconcile_pull_requests(gh, owner, repo, store=PR_STORE, pool=None, nclosed=10,
+                            user=None, credfile=None):
+    """Updates a pull request store from GitHub with the open pull requests, 
+    the most recently closed ones, and their latest statuses.  Pull requests
+    which the store has as open but which GitHub does not are marked closed.
+
+    Parameters
+    ----------
+    gh : GitHub
+        A logged in GitHub instance
+    owner : str
+        The repository owner.
+    repo : str
+        The repository name.
+    store : PullRequestStore, optional
+        The store to update.
+    pool : ThreadPool, optional
+        A pool used to fetch statuses concurrently.  Each pool thread uses its
+        own client from github_session().
+    nclosed : int, optional
+        The number of closed pull requests to fetch.
+    user : str, None, or NotSpecified, optional
+        The username that the pool threads log into github with.
+    credfile : str or None, optional
+        The github credentials file name for the pool threads.
+
+    """
+    r = gh.repository(owner, repo)
+    open_prs = list(r.iter_pulls(state='open'))
+    closed_prs = list(r.iter_pulls(state='closed', number=nclosed))
+    prs = open_prs + closed_prs
+    mapper = map if pool is None else pool.map
+    priority = getattr(_priority, 'value', NORMAL)
+    local = threading.local()
+    def fetch(pr):
+        # pool threads run with the priority of the caller and, since sessions
+        # are not thread-safe, with their own client.
+        with github_priority(priority):
+            if pool is None:
+                return get_pull_request_status(gh, r, pr)
+            if getattr(local, 'repo', None) is None:
+                local.gh = github_session(user=user, credfile=credfile)
+                local.repo = local.gh.repository(owner, repo)
+            return get_pull_request_status(local.gh, local.repo, pr)
+    statuses = list(mapper(fetch, prs))
+    with store.batch():
+        for pr, status in zip(prs, statuses):
+            info = PullRequestInfo.from_pull_request(pr)
+            store.update_pull_request(info)
+            if status is not None:
+                store.update_status((owner, repo, pr.number), status.state, 
+                                    status.description, status.target_url, 
+                                    sha=pr.head.sha)
+        open_numbers = set([pr.number for pr in open_prs])
+        for rec in store.pull_requests(owner, repo, state='open'):
+            if rec['number'] not in open_numbers:
+                store.update((owner, repo, rec['number']), state='closed')
+    store.reconciled = time.time()
 
 def get_pull_request_status(gh, r, pr):
-    """Sets a state for every commit associated with a pull request.
+    """Gets the latest status of the head commit of a pull request.  GitHub lists
+    statuses newest first, so only a single status is requested.
 
     Parameters
     ----------
@@ -89,8 +796,9 @@ def get_pull_request_status(gh, r, pr):
         A logged in GitHub instance
     r : Repository
         A github3 repository objects
-    pr : PullRequest or len-3 sequence
-        A github3 pull request object or a tuple of (owner, repository, number).
+    pr : PullRequest, PullRequestInfo, or len-3 sequence
+        A github3 pull request object, a pull request descriptor, or a tuple 
+        of (owner, repository, number).
 
     Returns
     -------
@@ -100,10 +808,9 @@ def get_pull_request_status(gh, r, pr):
     """
     if isinstance(pr, Sequence):
         pr = gh.pull_request(*pr)
-    statuses = sorted(r.iter_statuses(pr.head.sha), key=_stat_key)
-    if len(statuses) == 0:
-        return None
-    return statuses[-1]
+    for status in r.iter_statuses(pr.head.sha, number=1):
+        return status
+    return None
 
 def set_pull_request_status(pr, state, target_url="", description='', user=None, 
                             credfile='gh.cred'):
@@ -111,8 +818,9 @@ def set_pull_request_status(pr, state, target_url="", description='', user=None,
 
     Parameters
     ----------
-    pr : PullRequest or len-3 sequence
-        A github3 pull request object or a tuple of (owner, repository, number).
+    pr : PullRequest, PullRequestInfo, or len-3 sequence
+        A github3 pull request object, a pull request descriptor, or a tuple 
+        of (owner, repository, number).
     state : str
         Accepted values are 'pending', 'success', 'error', 'failure'.
     target_url : str, optional
@@ -125,28 +833,49 @@ def set_pull_request_status(pr, state, target_url="", description='', user=None,
         The github credentials file name.
 
     """
-    gh = GitHub()
-    ensure_logged_in(gh, user=user, credfile=credfile)
-    if isinstance(pr, Sequence):
-        r = gh.repository(*pr[:2])
-        pr = gh.pull_request(*pr)
+    if not os.path.isfile(credfile):
+        ensure_logged_in(GitHub(), user=user, credfile=credfile)
+    try:
+        gh = github_session(user=user, credfile=credfile)
+    except (IOError, OSError) as e:
+        warn("cannot set the {0!r} status of pull request {1}, the github "
+             "credentials could not be read: {2}".format(state, pr, e), 
+             RuntimeWarning)
+        return
+    with github_priority(HIGH):
+        if isinstance(pr, Sequence):
+            r = gh.repository(*pr[:2])
+            pr = gh.pull_request(*pr)
+        else:
+            #r = gh.repository(*pr.repository)  Broken on github3.py v0.8+
+            r = gh.repository(*pr.base.repo)
+        status = r.create_status(pr.head.sha, state=state, target_url=target_url, 
+                                 description=description)    
+    if status is None:
+        warn("failed to set the {0!r} status of {1}/{2}#{3} on GitHub, "
+             "{4} requests remain".format(state, pr.base.repo[0], pr.base.repo[1], 
+             pr.number, RATE_LIMITER.remaining), RuntimeWarning)
     else:
-        #r = gh.repository(*pr.repository)  Broken on github3.py v0.8+
-        r = gh.repository(*pr.base.repo)
-    status = r.create_status(pr.head.sha, state=state, target_url=target_url, 
-                             description=description)    
+        PR_STORE.update_status(tuple(pr.base.repo) + (pr.number,), state, 
+                               description, target_url, sha=pr.head.sha)
 
 class PolyphemusPlugin(Plugin):
     """This class provides basic functionality for github interactions."""
 
     requires = ('polyphemus.base',)
 
+    route = '/github/ratelimit'
+
     defaultrc = RunControl(
         github_owner=NotSpecified,
         github_repo=NotSpecified,
         github_events=['pull_request'],
         github_user=NotSpecified,
         github_credentials='gh.cred',
+        github_cache_size=1024,
+        github_status_cache='status.cache',
+        github_rate_reserves=[0, 50, 200],
+        github_rate_wait=60.0,
         )
 
     rcdocs = {
@@ -157,6 +886,18 @@ class PolyphemusPlugin(Plugin):
                         "to the repo."),
         'github_credentials': ("The github credentials file where token "
                                "authentication is stored."),
+        'github_cache_size': ("The maximum number of github API responses to "
+                              "cache and revalidate with conditional requests."),
+        'github_status_cache': ("The cache file for the local store of pull "
+                                "requests and their statuses."),
+        'github_rate_reserves': ("The number of github API requests which must "
+                                 "remain in the hourly rate limit for high (status "
+                                 "writes), normal, and low (dashboard and hook "
+                                 "verification) priority requests to be sent."),
+        'github_rate_wait': ("The longest time, in seconds, that a github request "
+                             "waits for the rate limit to reset.  After this, low "
+                             "and normal priority requests are deferred with an "
+                             "error while high priority ones are sent anyway."),
         }
 
     def update_argparser(self, parser):
@@ -170,6 +911,15 @@ class PolyphemusPlugin(Plugin):
                             help=self.rcdocs["github_user"])
         parser.add_argument('--github-credentials', dest='github_credentials',
                             help=self.rcdocs["github_credentials"])
+        parser.add_argument('--github-cache-size', dest='github_cache_size', 
+                            type=int, help=self.rcdocs["github_cache_size"])
+        parser.add_argument('--github-status-cache', dest='github_status_cache',
+                            help=self.rcdocs["github_status_cache"])
+        parser.add_argument('--github-rate-reserves', nargs=3, type=int,
+                            dest='github_rate_reserves', 
+                            help=self.rcdocs["github_rate_reserves"])
+        parser.add_argument('--github-rate-wait', dest='github_rate_wait', 
+                            type=float, help=self.rcdocs["github_rate_wait"])
 
     def setup(self, rc):
         if rc.github_owner is NotSpecified:
@@ -178,3 +928,14 @@ class PolyphemusPlugin(Plugin):
         if rc.github_repo is NotSpecified:
             raise ValueError('github_repo run control parameter must be specified '
                              'to use the githubhook plugin.')
+        _default_login.update(user=rc.github_user, credfile=rc.github_credentials)
+        RESPONSE_CACHE.maxsize = rc.github_cache_size
+        RATE_LIMITER.reserves = list(rc.github_rate_reserves)
+        RATE_LIMITER.max_wait = rc.github_rate_wait
+        PR_STORE.open(rc.github_status_cache)
+
+    def response(self, rc):
+        stats = {'rate_limit': RATE_LIMITER.stats(), 
+                 'response_cache': RESPONSE_CACHE.stats(),
+                 'clients': GITHUB_CLIENTS.stats()}
+        return json.dumps(stats), None
@@ -34,7 +34,9 @@ from .utils import RunControl, NotSpecified, writenewonly, \
     DEFAULT_RC_FILE, DEFAULT_PLUGINS, nyansep, indent, check_cmd
 from .plugins import Plugin
 from .event import Event, runfor
-from .githubbase import ensure_logged_in, set_pull_request_status
+from .githubbase import ensure_logged_in, set_pull_request_status, \
+    github_session, github_priority, LOW, RateLimitExceeded, PullRequestInfo, \
+    PR_STORE
 
 def verify_hook(owner, repo, url, events, user=None, credfile='gh.cred'):
     """Ensures that the github WebURL API hook has been set up properly.
@@ -56,8 +58,13 @@ def verify_hook(owner, repo, url, events, user=None, credfile='gh.cred'):
         The github credentials file name.
 
     """
-    gh = GitHub()
-    ensure_logged_in(gh, user=user, credfile=credfile)
+    if not os.path.isfile(credfile):
+        ensure_logged_in(GitHub(), user=user, credfile=credfile)
+    with github_priority(LOW):
+        _verify_hook(github_session(user=user, credfile=credfile), owner, repo, 
+                     url, events)
+
+def _verify_hook(gh, owner, repo, url, events):
     r = gh.repository(owner, repo)
     for hook in r.iter_hooks():
         if hook.name != 'web':
@@ -100,8 +107,12 @@ class PolyphemusPlugin(Plugin):
     def setup(self, rc):
         hookurl = ("{0}/githubhook" if rc.port == 80 else \
                    "{0}:{1}/githubhook").format(rc.server_url, rc.port)
-        verify_hook(rc.github_owner, rc.github_repo, hookurl, rc.github_events, 
-                    user=rc.github_user, credfile=rc.github_credentials)
+        try:
+            verify_hook(rc.github_owner, rc.github_repo, hookurl, rc.github_events, 
+                        user=rc.github_user, credfile=rc.github_credentials)
+        except RateLimitExceeded as e:
+            warn("could not verify the github webhook: {0}".format(e), 
+                 RuntimeWarning)
 
     _action_to_event = {'opened': 'github-pr-new', 'synchronize': 'github-pr-sync'}
 
@@ -109,21 +120,21 @@ class PolyphemusPlugin(Plugin):
         rawdata = json.loads(request.data)
         if 'pull_request' not in rawdata:
             return "\n", None
+        pr = PullRequestInfo.from_payload(rawdata['pull_request'])
+        PR_STORE.update_pull_request(pr)
         action = rawdata['action']
         if action not in self._action_to_event:
             # Can be one of 'opened', 'closed', 'synchronize', or 'reopened', 
             # but we only care about "opened" and "synchronize".
             return "\n", None
-        gh = GitHub()
-        pr = gh.pull_request(rc.github_owner, rc.github_repo, rawdata['number'])
         event = Event(name=self._action_to_event[action], data=pr)
         return request.method + ": github\n", event
 
     @runfor(*_action_to_event.values())
     def execute(self, rc):
         """The github hook plugin is executed for 'github-pr-new' and 'github-pr-sync'
-        events.  The event data must be either a github3 PullRequest object or a
-        tuple of the form (owner, repository, number).
+        events.  The event data must be either a PullRequestInfo object, a github3 
+        PullRequest object, or a tuple of the form (owner, repository, number).
         """
         event = rc.event
         pr = event.data
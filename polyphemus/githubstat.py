@@ -25,7 +25,7 @@ import github3.events
 from .utils import RunControl, NotSpecified, writenewonly
 from .plugins import Plugin
 from .event import Event, runfor
-from .githubbase import set_pull_request_status
+from .githubbase import set_pull_request_status, PR_STORE
 
 class PolyphemusPlugin(Plugin):
     """This class provides functionality for updating pull request statuses on 
@@ -46,7 +46,7 @@ class PolyphemusPlugin(Plugin):
         """The githubstat plugin is only executed for 'batlab-status' and
         'swc-status' events and requires that the event data be a dictionary
         with 'status' and 'number' as keys.  It optionally may also include
-        'target_url' and 'description' keys.
+        'target_url', 'description', and 'gid' (the BaTLab job id) keys.
         """
         data = rc.event.data
         pr = (rc.github_owner, rc.github_repo, data['number'])
@@ -54,3 +54,5 @@ class PolyphemusPlugin(Plugin):
             target_url=data.get('target_url', ""), 
             description=data.get('description', self._status_descs[data['status']]), 
             user=rc.github_user, credfile=rc.github_credentials)
+        if data.get('gid', None):
+            PR_STORE.update(pr, batlab_gid=data['gid'])
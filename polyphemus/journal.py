@@ -0,0 +1,314 @@
+"""An append-only journal of accepted events, so that events which were accepted
+but never finished may be replayed after a restart.
+
+Each accepted event is written along with the raw request payload that it was
+derived from.  When the event has been processed, a completion record is
+written.  Writes of accepted events are made durable with group commits:
+concurrent writers share a single fsync rather than each paying for their own.
+
+Several processes, such as those of a web server, may share a journal.  Each
+process writes to its own file, named after the journal and the process id,
+and holds a lock on it for as long as it runs.  On startup, a process takes
+over the files of the processes which have exited, so that each of their 
+pending events is replayed exactly once.
+
+Journal API
+===========
+"""
+from __future__ import print_function
+import os
+import io
+import sys
+import threading
+from warnings import warn
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+if sys.version_info[0] >= 3:
+    basestring = str
+
+class JournalRecord(object):
+    """An accepted event which has not yet been completed."""
+
+    __slots__ = ('seq', 'key', 'raw', 'event')
+
+    def __init__(self, seq, key, raw, event):
+        self.seq = seq
+        self.key = key
+        self.raw = raw
+        self.event = event
+
+    def __repr__(self):
+        return "{0}(seq={1}, key={2!r}, event={3!r})".format(
+                self.__class__.__name__, self.seq, self.key, self.event)
+
+class EventJournal(object):
+    """An append-only, group-committed journal of accepted events."""
+
+    def __init__(self, filename, compact_every=1000):
+        """Parameters
+        ----------
+        filename : str
+            Path to the journal.  Where file locks are available, this process
+            writes to the file of this name suffixed with its process id.
+        compact_every : int, optional
+            The journal is rewritten to hold only the pending events after this
+            many completion records have been written.
+
+        """
+        self.filename = filename
+        if fcntl is None:
+            self.path = filename
+        else:
+            self.path = "{0}.{1}".format(filename, os.getpid())
+        self.compact_every = compact_every
+        self.pending = {}
+        self.index = {}
+        self._seq = 0
+        self._written = 0
+        self._synced = 0
+        self._ndone = 0
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._f = None
+        self._owner = None
+        pardir = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.isdir(pardir):
+            os.makedirs(pardir)
+        if fcntl is None:
+            self._load(self.filename)
+            self.compact()
+        else:
+            self._claim()
+
+    def _claim(self):
+        """Locks the file of this process and takes over the files of the 
+        processes which have exited.  Their pending events are rewritten into
+        this process's file before their files are removed.  Processes which
+        start at the same time take turns on a lock file."""
+        self._owner = io.open(self.path + '.lock', 'ab')
+        fcntl.flock(self._owner.fileno(), fcntl.LOCK_EX)
+        with io.open(self.filename + '.lock', 'ab') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            orphans = []
+            try:
+                for path in self._journal_files():
+                    orphan = self._adopt(path)
+                    if orphan is not None:
+                        orphans.append(orphan)
+                self.compact()
+                for path, orphan in orphans:
+                    os.remove(path)
+                    if orphan is not None:
+                        os.remove(path + '.lock')
+            finally:
+                for path, orphan in orphans:
+                    if orphan is not None:
+                        orphan.close()
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    def _journal_files(self):
+        """The paths of the journal files of all processes, along with the 
+        file of the unsuffixed journal name."""
+        pardir, base = os.path.split(os.path.abspath(self.filename))
+        paths = []
+        for name in os.listdir(pardir):
+            if name == base or (name.startswith(base + '.') and 
+                                name[len(base) + 1:].isdigit()):
+                paths.append(os.path.join(pardir, name))
+        return sorted(paths)
+
+    def _adopt(self, path):
+        """Loads a journal file if it is this process's own or if its process
+        has exited.  Returns None if the file is not to be removed, and a 
+        (path, lock) tuple otherwise, where the lock is held on the file and
+        is None for the unsuffixed journal."""
+        if path == os.path.abspath(self.path):
+            self._load(path)
+            return None
+        if path == os.path.abspath(self.filename):
+            self._load(path)
+            return (path, None)
+        lock = io.open(path + '.lock', 'ab')
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            lock.close()  # its process is still running
+            return None
+        self._load(path)
+        return (path, lock)
+
+    def _load(self, path):
+        """Reads the pending records of a journal file.  They are given new
+        sequence numbers, after those of the records which are already 
+        pending."""
+        if not os.path.isfile(path):
+            return
+        pending = {}
+        with io.open(path, 'rb') as f:
+            while True:
+                try:
+                    rec = pickle.load(f)
+                except EOFError:
+                    break
+                except Exception:
+                    warn("truncated record in event journal {0!r}".format(
+                         path), RuntimeWarning)
+                    break
+                if rec[0] == 'accept':
+                    pending[rec[1]] = rec
+                elif rec[0] == 'done':
+                    pending.pop(rec[1], None)
+        for seq in sorted(pending):
+            _, _, key, raw, event = pending[seq]
+            self._seq += 1
+            self._add(JournalRecord(self._seq, key, raw, event))
+
+    def _add(self, rec):
+        self.pending[rec.seq] = rec
+        if rec.key is not None:
+            self.index.setdefault(rec.key, []).append(rec.seq)
+
+    def _remove(self, seq):
+        rec = self.pending.pop(seq, None)
+        if rec is None or rec.key is None:
+            return
+        seqs = self.index[rec.key]
+        seqs.remove(seq)
+        if len(seqs) == 0:
+            del self.index[rec.key]
+
+    def __len__(self):
+        return len(self.pending)
+
+    def records(self, key=None):
+        """Returns the pending records in the order that they were accepted.
+
+        Parameters
+        ----------
+        key : tuple, optional
+            If given, only the records for this key, e.g. the (owner, repository,
+            number) of a pull request, are returned.
+
+        """
+        with self._lock:
+            if key is None:
+                seqs = sorted(self.pending)
+            else:
+                seqs = list(self.index.get(key, ()))
+            return [self.pending[seq] for seq in seqs]
+
+    def accept(self, event, key=None, raw=None, sync=True):
+        """Writes an accepted event to the journal.
+
+        Parameters
+        ----------
+        event : Event
+            The derived event.
+        key : tuple, optional
+            The key, such as the pull request, which the event is indexed by.
+        raw : bytes, optional
+            The raw payload that the event was derived from.
+        sync : bool, optional
+            Whether to wait until the record is durable on disk.
+
+        Returns
+        -------
+        seq : int or None
+            The sequence number of the record, or None if the event could not
+            be journaled.
+
+        """
+        with self._lock:
+            seq = self._seq + 1
+            try:
+                data = pickle.dumps(('accept', seq, key, raw, event),
+                                    pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                warn("could not journal {0}: {1}".format(event, e), RuntimeWarning)
+                return None
+            self._seq = seq
+            self._f.write(data)
+            self._add(JournalRecord(seq, key, raw, event))
+            self._written = seq
+        if sync:
+            self.sync(seq)
+        return seq
+
+    def complete(self, seq):
+        """Writes a completion record for an event.  This is flushed to the
+        operating system but not synced, a lost completion record only causes
+        an event to be replayed."""
+        if seq is None:
+            return
+        with self._lock:
+            if seq not in self.pending:
+                return
+            self._f.write(pickle.dumps(('done', seq), pickle.HIGHEST_PROTOCOL))
+            self._f.flush()
+            self._remove(seq)
+            self._ndone += 1
+            compact = self._ndone >= self.compact_every
+        if compact:
+            self.compact()
+
+    def sync(self, seq=None):
+        """Ensures that all records up to and including seq are durable.
+        Concurrent callers are batched into a single fsync."""
+        seq = self._written if seq is None else seq
+        with self._sync_lock:
+            if seq <= self._synced:
+                return  # another caller's fsync covered this record
+            with self._lock:
+                written = self._written
+                self._f.flush()
+                fd = self._f.fileno()
+            os.fsync(fd)
+            self._synced = written
+
+    def compact(self):
+        """Rewrites the journal so that it only contains the pending events."""
+        with self._sync_lock:
+            with self._lock:
+                if self._f is not None:
+                    self._f.close()
+                tmp = self.path + '.tmp'
+                with io.open(tmp, 'wb') as f:
+                    for seq in sorted(self.pending):
+                        rec = self.pending[seq]
+                        pickle.dump(('accept', seq, rec.key, rec.raw, rec.event),
+                                    f, pickle.HIGHEST_PROTOCOL)
+                    f.flush()
+                    os.fsync(f.fileno())
+                if os.name == 'nt' and os.path.exists(self.path):
+                    os.remove(self.path)
+                os.rename(tmp, self.path)
+                self._f = io.open(self.path, 'ab')
+                self._synced = self._written = self._seq
+                self._ndone = 0
+
+    def close(self):
+        """Syncs and closes the journal.  The file of this process is removed
+        if it has no pending events, and is otherwise left to be taken over."""
+        self.sync()
+        with self._lock:
+            self._f.close()
+            if self._owner is None:
+                return
+            if len(self.pending) == 0:
+                with io.open(self.filename + '.lock', 'ab') as lock:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+                    try:
+                        os.remove(self.path)
+                        os.remove(self.path + '.lock')
+                    finally:
+                        fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+            fcntl.flock(self._owner.fileno(), fcntl.LOCK_UN)
+            self._owner.close()
+            self._owner = None
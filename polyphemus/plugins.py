@@ -82,6 +82,10 @@ Interface
     controller.If needed, the rc should be modified in-place so that changes 
     propagate to other plugins and further calls on this plugin. This should 
     return None. 
+:events: This is a list of the event names that execute() handles, a function 
+    which returns such a list, or None.  If None, the names are taken from the
+    ``runfor`` decorator on execute(), if present. Otherwise the plugin is 
+    executed for every event.
 :teardown(rc): Performs any cleanup tasks needed by the plugin, including removing
     temporary files.  If needed, the rc should be modified in-place so that changes 
     propagate to other plugins and further calls on this plugin. This should 
@@ -148,14 +152,18 @@ import warnings
 import importlib
 import argparse
 import textwrap
+from bisect import bisect_left
 from functools import wraps
 
-from flask import Flask
+from flask import Flask, request
 
 from .utils import RunControl, NotSpecified, nyansep
 
 if sys.version_info[0] >= 3:
     basestring = str
+    from queue import Full
+else:
+    from Queue import Full
 
 class Plugin(object):
     """A base plugin for other polyphemus pluigins to inherit.
@@ -206,6 +214,13 @@ class Plugin(object):
     data 'POST' is also needed.  See the flask documentation for more details.
     """
 
+    events = None
+    """This is a sequence of event names, or a function which returns such, that
+    the execute() method handles.  If this is None, the event names are taken 
+    from the ``runfor`` decorator on execute(), when present, and otherwise 
+    execute() is called for every event.
+    """
+
     def __init__(self):
         """The __init__() method may take no arguments or keyword arguments."""
         pass
@@ -330,6 +345,8 @@ class Plugins(object):
         self.rc = None
         self.rcdocs = {}
         self.warnings = []
+        self._handlers = None
+        self._catchall = None
 
     def _load(self, modnames, loaddeps=True):
         for modname in modnames:
@@ -393,22 +410,75 @@ class Plugins(object):
         return rc
 
     def setup(self):
-        """Performs all plugin setup tasks."""
+        """Performs all plugin setup tasks and builds the event dispatch index."""
         rc = self.rc
         try:
             for plugin in self.plugins:
                 plugin.setup(rc)
         except Exception as e:
             self.exit(e)
+        self.build_index()
         if rc.only_setup:
             self.exit(0)
 
-    def execute(self):
-        """Preforms all plugin executions."""
-        rc = self.rc
+    def build_index(self):
+        """Builds the index which maps event names to the plugins that handle 
+        them.  Plugins which do not override execute() are never dispatched to.
+        """
+        handlers = {}
+        catchall = []
+        for i, plugin in enumerate(self.plugins):
+            if not _overrides_execute(plugin):
+                continue
+            events = plugin_events(plugin)
+            if events is None:
+                catchall.append(i)
+                continue
+            for name in events:
+                handlers.setdefault(name, []).append(i)
+        for idx in handlers.values():
+            idx.extend(catchall)
+            idx.sort()
+        self._handlers = handlers
+        self._catchall = catchall
+
+    def handlers(self, name):
+        """Returns the plugins whose execute() methods handle the named event, 
+        in execution order."""
+        return [self.plugins[i] for i in self._handler_indices(name)]
+
+    def _handler_indices(self, name):
+        if self._handlers is None:
+            self.build_index()
+        return self._handlers.get(name, self._catchall)
+
+    def execute(self, event=None):
+        """Preforms all plugin executions.
+
+        Parameters
+        ----------
+        event : Event, optional
+            If given, the plugins are executed on a copy-on-write view of the 
+            run control whose rc.event is this event.  This keeps concurrent
+            executions from clobbering one another.  Otherwise, the run control
+            and its current event are used directly.  Execution stops early if 
+            the event is cancelled.
+
+        """
+        rc = self.rc if event is None else self.rc._view(event=event)
+        origin = rc.event
         try:
-            for plugin in self.plugins:
-                plugin.execute(rc)
+            # plugins may replace rc.event, so the handlers are looked up again 
+            # after each execution, starting from the following plugin.
+            i = 0
+            while not origin.cancelled:
+                idx = self._handler_indices(rc.event.name)
+                j = bisect_left(idx, i)
+                if j == len(idx):
+                    break
+                i = idx[j]
+                self.plugins[i].execute(rc)
+                i += 1
         except Exception as e:
             self.exit(e)
 
@@ -422,13 +492,16 @@ class Plugins(object):
             app.add_url_rule(plugin.route, plugin.__module__, view, 
                              methods=plugin.request_methods)
         self.rc.app = app
+        if 'event_queue' in self.rc:
+            self.rc.event_queue.start(self.execute)
 
     def run_app(self):
         """Runs, and possibly builds, the flask web application."""
         rc = self.rc
         if 'app' not in rc:
             self.build_app()
-        rc.app.run(host=rc.host, port=rc.port, debug=rc.debug)
+        # threaded, so that long-lived streams do not block other requests
+        rc.app.run(host=rc.host, port=rc.port, debug=rc.debug, threaded=True)
 
     def teardown(self):
         """Preforms all plugin teardown tasks."""
@@ -467,6 +540,21 @@ class Plugins(object):
         else:
             sys.exit(err)
 
+def plugin_events(plugin):
+    """Returns the frozenset of event names that a plugin's execute() method 
+    handles, or None if it handles all events."""
+    events = plugin.events if hasattr(plugin, 'events') else None
+    if callable(events):
+        events = events()
+    if events is None:
+        events = getattr(plugin.execute, 'events', None)
+    return None if events is None else frozenset(events)
+
+def _overrides_execute(plugin):
+    base = getattr(Plugin.execute, '__func__', Plugin.execute)
+    meth = getattr(type(plugin), 'execute', None)
+    return getattr(meth, '__func__', meth) is not base
+
 def summarize_rcdocs(modnames, headersep="=", maxdflt=2000):
     """For a list of plugin module names, return a rST string that 
     summarizes the docstrings for all run control parameters.
@@ -507,13 +595,24 @@ def wrap_response(plugins, plugin):
     -------
     response : function
         The response proxy function that is bound to plugins and plugin.
+        If the run control has an event queue, events are placed on the 
+        queue and the response is returned with a 202 (Accepted) status.
 
     """
     @wraps(plugin.response)
     def response(*args, **kwargs):
-        resp, event = plugin.response(plugins.rc, *args, **kwargs)
-        if event is not None:
-            plugins.rc.event = event
-            plugins.execute()
-        return resp
+        rc = plugins.rc
+        resp, event = plugin.response(rc, *args, **kwargs)
+        if event is None:
+            return resp
+        if 'event_queue' not in rc:
+            plugins.execute(event)
+            return resp
+        try:
+            rc.event_queue.put(event, raw=request.get_data())
+        except Full:
+            warnings.warn("event queue full, rejecting " + str(event), 
+                          RuntimeWarning)
+            return "event queue full, try again later\n", 503
+        return resp, 202
     return response
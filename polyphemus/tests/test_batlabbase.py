@@ -0,0 +1,33 @@
+"""Tests for the build keys and results of BaTLab jobs."""
+from __future__ import print_function
+import os
+
+from polyphemus.utils import RunControl, PersistentCache
+from polyphemus.batlabbase import build_key, record_result
+
+
+def test_build_key():
+    key = build_key('head', 'base', 'scripts', 'run spec')
+    assert key == build_key('head', 'base', 'scripts', 'run spec')
+    assert key != build_key('head2', 'base', 'scripts', 'run spec')
+    assert key != build_key('head', 'base', 'scripts', 'run spec 2')
+    # parts are delimited, so they may not run into one another
+    assert build_key('ab', 'c', 's', 'r') != build_key('a', 'bc', 's', 'r')
+    assert build_key('head', None, 'scripts', 'run spec') is None
+
+
+def test_record_result(tmpdir):
+    rc = RunControl(batlab_results_cache=os.path.join(str(tmpdir), 'results.db'))
+    info = {'gid': 'g1', 'report_url': 'http://report', 'build_key': 'k1'}
+    record_result(rc, info, {'status': 'failure', 'number': 1,
+                             'description': 'build and test failed'})
+    record_result(rc, dict(info, build_key='k2'), {'status': 'error', 'number': 1})
+    record_result(rc, dict(info, build_key=None), {'status': 'success', 'number': 1})
+    results = PersistentCache(cachefile=rc.batlab_results_cache)
+    assert list(results) == ['k1']
+    result = results['k1']
+    assert result['status'] == 'failure'
+    assert result['description'] == 'build and test failed'
+    assert result['target_url'] == 'http://report'
+    assert result['gid'] == 'g1'
+    results.close()
@@ -0,0 +1,69 @@
+"""Tests for the BaTLab status polling and telemetry."""
+from __future__ import print_function
+import os
+from getpass import getuser
+
+import paramiko
+
+from polyphemus.utils import RunControl, PersistentCache
+from polyphemus.fakebatlab import FakeBatLab
+from polyphemus.batlabbase import SSH_POOL, TASK_MARKER
+from polyphemus.batlabstat import JobPoller, classify_status, parse_poll, \
+    parse_task_records, summarize_tasks
+
+
+def test_classify_status():
+    assert classify_status("job g1 succeeded.") == 'success'
+    assert classify_status("RUNNING") == 'pending'
+    assert classify_status("held") == 'error'
+    assert classify_status("") is None
+    assert classify_status("what") is None
+
+
+def test_parse_poll():
+    output = ("@@polyphemus status g1 job g1 succeeded\n"
+              "noise\n"
+              "@@polyphemus status g2\n")
+    assert parse_poll(output) == {'g1': 'job g1 succeeded', 'g2': ''}
+
+
+def test_parse_task_records():
+    log = "\n".join([
+        "{0} x86_64_RHEL6 remote_task 110 150 1".format(TASK_MARKER),
+        "{0} local pre_all 100 105 0".format(TASK_MARKER),
+        "{0} x86_64_RHEL6 remote_task 170 180 0".format(TASK_MARKER),
+        "{0} local pre_all soon".format(TASK_MARKER),
+        "return value 0",
+        ])
+    tasks = parse_task_records(log)
+    assert [(t['task'], t['duration'], t['exit']) for t in tasks] == \
+           [('pre_all', 5, 0), ('remote_task', 40, 1), ('remote_task', 10, 0)]
+    summary = summarize_tasks([{'tasks': tasks}])
+    assert summary[0] == {'platform': 'x86_64_RHEL6', 'task': 'remote_task',
+                          'count': 2, 'failures': 1, 'max': 40, 'mean': 25.0}
+
+
+def test_poll_dispatches_changed_jobs(tmpdir):
+    key_file = os.path.join(str(tmpdir), 'id_rsa')
+    paramiko.RSAKey.generate(2048).write_private_key_file(key_file)
+    with FakeBatLab() as fake:
+        rc = RunControl(batlab_user=getuser(), ssh_key_file=key_file,
+                        batlab_jobs_cache=os.path.join(str(tmpdir), 'jobs.db'),
+                        batlab_results_cache=os.path.join(str(tmpdir), 'results.db'),
+                        batlab_status_cmd="printf 'job %s succeeded\\n'")
+        jobs = PersistentCache(cachefile=rc.batlab_jobs_cache)
+        jobs[('o', 'r', 1)] = {'gid': 'g1', 'report_url': 'http://report',
+                               'host': fake.address, 'build_key': 'k1'}
+        jobs[('o', 'r', 2)] = {'gid': 'g2', 'report_url': 'http://report',
+                               'host': fake.address, 'status': 'success'}
+        events = []
+        poller = JobPoller(rc, events.append)
+        try:
+            assert poller.poll() == (2, 1)
+        finally:
+            SSH_POOL.discard(fake.address, rc.batlab_user, key_file)
+    assert [(e.name, e.data['number'], e.data['status']) for e in events] == \
+           [('batlab-status', 1, 'success')]
+    assert list(jobs) == [('o', 'r', 2)]
+    results = PersistentCache(cachefile=rc.batlab_results_cache)
+    assert results['k1']['status'] == 'success'
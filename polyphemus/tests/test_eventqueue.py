@@ -0,0 +1,104 @@
+"""Tests for the asynchronous event queue."""
+from __future__ import print_function
+import os
+import sys
+import time
+import threading
+
+if sys.version_info[0] >= 3:
+    from queue import Full
+else:
+    from Queue import Full
+
+from polyphemus.event import Event
+from polyphemus.journal import EventJournal
+from polyphemus.eventqueue import EventQueue
+
+
+def test_handles_events_in_order():
+    handled = []
+    q = EventQueue(workers=1)
+    q.start(lambda event: handled.append(event.data))
+    for i in range(5):
+        q.put(Event(name='github-pr-comment', data=('o', 'r', i)))
+    q.stop()
+    assert handled == [('o', 'r', i) for i in range(5)]
+    assert q.stats()['processed'] == 5
+
+
+def test_coalesces_syncs_of_a_pull_request():
+    handled = []
+    q = EventQueue(workers=1, debounce=0.2)
+    q.start(lambda event: handled.append(event))
+    first = Event(name='github-pr-new', data=('o', 'r', 1))
+    second = Event(name='github-pr-sync', data=('o', 'r', 1))
+    other = Event(name='github-pr-sync', data=('o', 'r', 2))
+    q.put(first)
+    q.put(second)
+    q.put(other)
+    q.stop()
+    assert first.cancelled
+    assert handled == [second, other]
+    assert q.stats()['coalesced'] == 1
+
+
+def test_debounces_coalescing_events():
+    handled = []
+    q = EventQueue(workers=1, debounce=0.3)
+    q.start(lambda event: handled.append(time.time()))
+    put = time.time()
+    q.put(Event(name='github-pr-sync', data=('o', 'r', 1)))
+    while len(handled) == 0:
+        time.sleep(0.01)
+    q.stop()
+    assert handled[0] - put >= 0.3
+
+
+def test_supersedes_the_event_in_flight():
+    started = threading.Event()
+    release = threading.Event()
+    handled = []
+    def handler(event):
+        started.set()
+        release.wait(5.0)
+        handled.append(event)
+    q = EventQueue(workers=2)
+    q.start(handler)
+    first = Event(name='github-pr-sync', data=('o', 'r', 1))
+    second = Event(name='github-pr-sync', data=('o', 'r', 1))
+    q.put(first)
+    assert started.wait(5.0)
+    q.put(second)
+    assert first.cancelled
+    release.set()
+    q.stop()
+    # events of the same pull request are never handled concurrently
+    assert handled == [first, second]
+    assert q.stats()['superseded'] == 1
+
+
+def test_rejects_events_when_full():
+    q = EventQueue(maxsize=1, workers=1)
+    q.put(Event(name='github-pr-comment', data=('o', 'r', 1)))
+    try:
+        q.put(Event(name='github-pr-comment', data=('o', 'r', 2)))
+    except Full:
+        pass
+    else:
+        assert False, "the queue accepted more than maxsize events"
+    assert q.stats()['rejected'] == 1
+    assert len(q) == 1
+
+
+def test_replays_journaled_events(tmpdir):
+    filename = os.path.join(str(tmpdir), 'events.journal')
+    q = EventQueue(workers=1, journal=EventJournal(filename))
+    q.put(Event(name='github-pr-comment', data=('o', 'r', 1)))
+    q.put(Event(name='github-pr-comment', data=('o', 'r', 2)))
+    q.journal.close()  # as if the process stopped before handling them
+    handled = []
+    q = EventQueue(workers=1, journal=EventJournal(filename))
+    q.start(lambda event: handled.append(event.data))
+    q.stop()
+    assert handled == [('o', 'r', 1), ('o', 'r', 2)]
+    assert len(EventJournal(filename)) == 0
@@ -0,0 +1,32 @@
+"""Smoke tests for submitting jobs to a fake BaTLab submit host."""
+from __future__ import print_function
+
+import paramiko
+
+from polyphemus.fakebatlab import FakeBatLab, benchmark
+
+
+def test_fake_submit():
+    with FakeBatLab() as fake:
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(fake.host, port=fake.port, username='polyphemus', 
+                       password='x', look_for_keys=False, allow_agent=False)
+        try:
+            _, stdout, _ = client.exec_command('touch x.run-spec; nmi_submit x.run-spec')
+            lines = stdout.read().decode().splitlines()
+            assert stdout.channel.recv_exit_status() == 0
+        finally:
+            client.close()
+        assert fake.queue() == [lines[0].split()[-1]]
+        assert lines[-1].startswith('http')
+
+
+def test_benchmark():
+    results = benchmark(jobs=2, workers=2, rounds=2)
+    assert len(results) == 2
+    for res in results:
+        assert len(res['jobs']) == 2
+        for job in res['jobs']:
+            assert job['status'] == 'pending', job['description']
+            assert job['total'] is not None
@@ -0,0 +1,85 @@
+"""Tests for the journal of accepted events."""
+from __future__ import print_function
+import os
+import multiprocessing
+
+from polyphemus.journal import EventJournal, fcntl
+
+
+def test_replays_pending_records(tmpdir):
+    filename = os.path.join(str(tmpdir), 'events.journal')
+    j = EventJournal(filename)
+    seqs = [j.accept('event {0}'.format(i), key=('o', 'r', i % 2))
+            for i in range(4)]
+    j.complete(seqs[1])
+    j.close()
+    j = EventJournal(filename)
+    assert [rec.event for rec in j.records()] == ['event 0', 'event 2', 'event 3']
+    assert [rec.event for rec in j.records(key=('o', 'r', 1))] == ['event 3']
+    j.close()
+
+
+def test_compacts_completed_records(tmpdir):
+    filename = os.path.join(str(tmpdir), 'events.journal')
+    j = EventJournal(filename, compact_every=2)
+    for i in range(10):
+        j.complete(j.accept('event {0}'.format(i)))
+    seq = j.accept('pending')
+    size = os.path.getsize(j.path)
+    j.complete(j.accept('done'))
+    j.complete(j.accept('done'))
+    assert os.path.getsize(j.path) == size
+    assert [rec.seq for rec in j.records()] == [seq]
+    j.close()
+
+
+def test_close_removes_empty_journal(tmpdir):
+    filename = os.path.join(str(tmpdir), 'events.journal')
+    j = EventJournal(filename)
+    j.complete(j.accept('event'))
+    j.close()
+    assert not os.path.exists(j.path)
+
+
+def _crash(filename, n):
+    j = EventJournal(filename)
+    seqs = [j.accept('event {0}-{1}'.format(n, i)) for i in range(3)]
+    j.complete(seqs[0])
+    os._exit(0)
+
+
+def _start(filename, results):
+    j = EventJournal(filename)
+    events = [rec.event for rec in j.records()]
+    for rec in j.records():
+        j.complete(rec.seq)
+    j.close()
+    results.put(events)
+
+
+def test_replays_crashed_processes_once(tmpdir):
+    if fcntl is None:
+        return
+    filename = os.path.join(str(tmpdir), 'events.journal')
+    # a live process keeps its own pending events
+    live = EventJournal(filename)
+    live.accept('live')
+    for n in range(3):
+        p = multiprocessing.Process(target=_crash, args=(filename, n))
+        p.start()
+        p.join()
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=_start, args=(filename, results))
+             for i in range(4)]
+    for p in procs:
+        p.start()
+    replayed = [results.get(timeout=30) for p in procs]
+    for p in procs:
+        p.join()
+    assert sorted(sum(replayed, [])) == ['event 0-1', 'event 0-2', 'event 1-1',
+                                         'event 1-2', 'event 2-1', 'event 2-2']
+    assert [rec.event for rec in live.records()] == ['live']
+    live.close()
+    assert sorted(os.listdir(str(tmpdir))) == [os.path.basename(live.path), 
+                                              os.path.basename(live.path) + '.lock', 
+                                              'events.journal.lock']
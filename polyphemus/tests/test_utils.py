@@ -0,0 +1,90 @@
+"""Tests for the run control views and the persistent cache."""
+from __future__ import print_function
+import io
+import os
+import threading
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from polyphemus.utils import RunControl, ChainDict, PersistentCache
+
+
+def test_chain_dict():
+    parent = {'a': 1, 'b': 2}
+    d = ChainDict(parent)
+    d['b'] = 3
+    d['c'] = 4
+    del d['a']
+    assert 'a' not in d
+    assert dict(d) == {'b': 3, 'c': 4}
+    assert parent == {'a': 1, 'b': 2}
+    d['a'] = 5
+    assert d['a'] == 5
+    parent['e'] = 6
+    assert d['e'] == 6
+
+
+def test_run_control_view():
+    rc = RunControl(a=1, b=[2])
+    view = rc._view(b=[3], event='x')
+    view.c = 4
+    assert (view.a, view.b, view.c, view.event) == (1, [3], 4, 'x')
+    assert rc.b == [2]
+    assert 'c' not in rc and 'event' not in rc
+    rc.a = 5
+    assert view.a == 5
+
+
+def test_persistent_cache(tmpdir):
+    cachefile = os.path.join(str(tmpdir), 'cache.db')
+    cache = PersistentCache(cachefile=cachefile)
+    cache[('o', 'r', 1)] = {'gid': 'g1'}
+    cache.update({('o', 'r', 2): {'gid': 'g2'}, 'x': [1, 2]})
+    del cache['x']
+    assert len(cache) == 2
+    assert ('o', 'r', 1) in cache and 'x' not in cache
+    try:
+        del cache['x']
+    except KeyError:
+        pass
+    else:
+        assert False, "deleting a missing key did not raise a KeyError"
+    cache.close()
+    cache = PersistentCache(cachefile=cachefile)
+    assert dict(cache.items()) == {('o', 'r', 1): {'gid': 'g1'},
+                                   ('o', 'r', 2): {'gid': 'g2'}}
+    assert sorted([v['gid'] for v in cache.values()]) == ['g1', 'g2']
+    cache.close()
+
+
+def test_persistent_cache_is_shared(tmpdir):
+    cachefile = os.path.join(str(tmpdir), 'cache.db')
+    caches = [PersistentCache(cachefile=cachefile) for i in range(4)]
+    def write(cache, n):
+        for i in range(25):
+            cache[(n, i)] = i
+    threads = [threading.Thread(target=write, args=(c, n))
+               for n, c in enumerate(caches)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(caches[0]) == 100
+    for c in caches:
+        c.close()
+
+
+def test_persistent_cache_migrates_pickles(tmpdir):
+    cachefile = os.path.join(str(tmpdir), 'cache.pkl')
+    legacy = {('o', 'r', 1): {'gid': 'g1'}, 'scripts': 'abc'}
+    with io.open(cachefile, 'wb') as f:
+        pickle.dump(legacy, f, 2)
+    cache = PersistentCache(cachefile=cachefile)
+    assert dict(cache.items()) == legacy
+    cache['new'] = 1
+    cache.close()
+    cache = PersistentCache(cachefile=cachefile)
+    assert len(cache) == 3
+    cache.close()
@@ -9,7 +9,9 @@ import io
 import re
 import sys
 import glob
+import sqlite3
 import tempfile
+import threading
 import functools
 import subprocess
 from copy import deepcopy
@@ -22,6 +24,10 @@ try:
     import cPickle as pickle
 except ImportError:
     import pickle
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 if sys.version_info[0] >= 3:
     basestring = str
@@ -29,9 +35,11 @@ if sys.version_info[0] >= 3:
 DEFAULT_RC_FILE = "polyphemusrc.py"
 """Default run control file name."""
 
-DEFAULT_PLUGINS = ('polyphemus.base', 'polyphemus.githubhook', 'polyphemus.batlabrun', 
+DEFAULT_PLUGINS = ('polyphemus.base', 'polyphemus.eventqueue', 
+                   'polyphemus.githubhook', 'polyphemus.batlabrun', 
                    'polyphemus.batlabstat', 'polyphemus.githubstat', 
-                   'polyphemus.dashboard')
+                   'polyphemus.dashboard', 'polyphemus.dashboardapi', 
+                   'polyphemus.dashboardevents')
 """Default list of plugin module names."""
 
 FORBIDDEN_NAMES = frozenset(['del', 'global'])
@@ -286,6 +294,72 @@ class RunControl(object):
                 v = self._updaters[k](getattr(self, k), v)
             setattr(self, k, v)
 
+    def _view(self, **kwargs):
+        """Returns a cheap, copy-on-write view of this run control.  Attributes
+        that are set on the view are stored in the view only, while all other 
+        attributes are read from this run control.  This allows events to be 
+        executed concurrently, each with their own view.  Note that values are 
+        shared rather than copied, so mutable values should be replaced on the 
+        view rather than modified in-place.
+
+        Parameters
+        ----------
+        kwargs : optional
+            Items to place into the view.
+
+        """
+        view = self.__class__()
+        view._dict = ChainDict(self._dict)
+        view._updaters = self._updaters
+        for k, v in kwargs.items():
+            setattr(view, k, v)
+        return view
+
+class ChainDict(MutableMapping):
+    """A mapping which writes to its own dictionary and reads from a parent 
+    mapping for keys that it does not have."""
+
+    def __init__(self, parent):
+        """Parameters
+        -------------
+        parent : Mapping
+            The mapping to read through to.
+
+        """
+        self.parent = parent
+        self.local = {}
+        self.deleted = set()
+
+    def __getitem__(self, key):
+        if key in self.local:
+            return self.local[key]
+        elif key in self.deleted:
+            raise KeyError(key)
+        return self.parent[key]
+
+    def __setitem__(self, key, value):
+        self.local[key] = value
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.local.pop(key, None)
+        self.deleted.add(key)
+
+    def __contains__(self, key):
+        return key in self.local or (key not in self.deleted and key in self.parent)
+
+    def __iter__(self):
+        for key in self.local:
+            yield key
+        for key in list(self.parent.keys()):
+            if key not in self.local and key not in self.deleted:
+                yield key
+
+    def __len__(self):
+        return sum(1 for key in self)
+
 def infer_format(filename, format):
     """Tries to figure out a file format."""
     if isinstance(format, basestring):
@@ -406,52 +480,154 @@ def check_cmd(args):
 # Persisted Cache
 #
 
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+def _dumpkey(key):
+    f = io.BytesIO()
+    p = pickle.Pickler(f, 2)
+    p.fast = True  # no memo, so that equal keys always have the same pickle
+    p.dump(key)
+    return sqlite3.Binary(f.getvalue())
+
+def _loadblob(blob):
+    return pickle.loads(bytes(blob))
+
 class PersistentCache(MutableMapping):
-    """A quick persistent cache."""
+    """A quick persistent cache.  Items are stored as rows of an SQLite 
+    database in write-ahead log mode, so reading or writing an item does not 
+    touch the rest of the cache and many threads and processes may use the same
+    cache file at once.  Keys and values may be any picklable objects, though
+    keys are compared by their pickles.  Values are copies, so modified values 
+    must be set again to be saved.  Cache files of a single pickled dictionary,
+    as written by older versions, are migrated when they are opened.
+    """
 
-    def __init__(self, cachefile='cache.pkl'):
+    def __init__(self, cachefile='cache.pkl', timeout=30.0):
         """Parameters
         -------------
         cachefile : str, optional
             Path to description cachefile.
+        timeout : float, optional
+            The time, in seconds, to wait for other writers to finish.
 
         """
         self.cachefile = cachefile
-        if os.path.isfile(cachefile):
-            with io.open(cachefile, 'rb') as f:
-                self.cache = pickle.load(f)
-        else:
-            self.cache = {}
+        pardir = os.path.split(os.path.abspath(cachefile))[0]
+        if not os.path.exists(pardir):
+            os.makedirs(pardir)
+        if self._is_legacy():
+            self._migrate(timeout)
+        self._lock = threading.RLock()
+        self._conn = self._connect(cachefile, timeout)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+
+    @staticmethod
+    def _connect(filename, timeout):
+        conn = sqlite3.connect(filename, timeout=timeout, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute("CREATE TABLE IF NOT EXISTS cache "
+                     "(key BLOB PRIMARY KEY, value BLOB NOT NULL)")
+        return conn
+
+    def _is_legacy(self):
+        """Whether the cache file holds a pickled dictionary."""
+        if not os.path.isfile(self.cachefile) or os.path.getsize(self.cachefile) == 0:
+            return False
+        with io.open(self.cachefile, 'rb') as f:
+            return f.read(len(SQLITE_HEADER)) != SQLITE_HEADER
+
+    def _migrate(self, timeout):
+        """Converts a pickled dictionary cache file to a database, which then
+        atomically replaces it.  Processes which open the file at the same time 
+        take turns on a lock file, and only the first one converts it."""
+        with io.open(self.cachefile + '.lock', 'ab') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                if self._is_legacy():
+                    self._migrate_locked(timeout)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    def _migrate_locked(self, timeout):
+        with io.open(self.cachefile, 'rb') as f:
+            cache = pickle.load(f)
+        tmp = "{0}.{1}.tmp".format(self.cachefile, os.getpid())
+        conn = self._connect(tmp, timeout)
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany("INSERT OR REPLACE INTO cache VALUES (?, ?)", 
+                             [(_dumpkey(k), self._dumpvalue(v)) 
+                              for k, v in cache.items()])
+        conn.close()
+        os.rename(tmp, self.cachefile)
+
+    @staticmethod
+    def _dumpvalue(value):
+        return sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
 
     def __len__(self):
-        return len(self.cache)
+        return self._query("SELECT COUNT(*) FROM cache")[0][0]
 
     def __contains__(self, key):
-        return key in self.cache
+        return len(self._query("SELECT 1 FROM cache WHERE key = ?", 
+                               (_dumpkey(key),))) > 0
 
     def __getitem__(self, key):
-        return self.cache[key]  # return the results of the finder only
+        rows = self._query("SELECT value FROM cache WHERE key = ?", 
+                           (_dumpkey(key),))
+        if len(rows) == 0:
+            raise KeyError(key)
+        return _loadblob(rows[0][0])
 
     def __setitem__(self, key, value):
-        self.cache[key] = value
-        self.dump()
+        self._query("INSERT OR REPLACE INTO cache VALUES (?, ?)", 
+                    (_dumpkey(key), self._dumpvalue(value)))
+
+    def update(self, *args, **kwargs):
+        """Sets many items, as with dict.update(), in a single transaction."""
+        items = dict(*args, **kwargs)
+        with self._lock:
+            with self._conn:
+                self._conn.execute("BEGIN")
+                self._conn.executemany("INSERT OR REPLACE INTO cache VALUES (?, ?)",
+                    [(_dumpkey(k), self._dumpvalue(v)) for k, v in items.items()])
 
     def __delitem__(self, key):
-        del self.cache[key]
-        self.dump()
+        with self._lock:
+            cur = self._conn.execute("DELETE FROM cache WHERE key = ?", 
+                                     (_dumpkey(key),))
+            if cur.rowcount == 0:
+                raise KeyError(key)
 
     def __iter__(self):
-        for key in self.cache.keys():
-            yield key
+        for row in self._query("SELECT key FROM cache"):
+            yield _loadblob(row[0])
+
+    def items(self):
+        """Returns a list of all (key, value) pairs, read in a single query."""
+        return [(_loadblob(k), _loadblob(v)) for k, v in 
+                self._query("SELECT key, value FROM cache")]
+
+    def values(self):
+        """Returns a list of all values, read in a single query."""
+        return [_loadblob(row[0]) for row in self._query("SELECT value FROM cache")]
 
     def dump(self):
-        """Writes the cache out to the filesystem."""
-        if not os.path.exists(self.cachefile):
-            pardir = os.path.split(os.path.abspath(self.cachefile))[0]
-            if not os.path.exists(pardir):
-                os.makedirs(pardir)
-        with io.open(self.cachefile, 'wb') as f:
-            pickle.dump(self.cache, f, pickle.HIGHEST_PROTOCOL)
+        """Writes the cache out to the filesystem.  Items are written as soon
+        as they are set, so this only checkpoints the write-ahead log."""
+        self._query("PRAGMA wal_checkpoint")
+
+    def close(self):
+        """Closes the database connection."""
+        with self._lock:
+            self._conn.close()
 
     def __str__(self):
-        return pformat(self.cache)
+        return pformat(dict(self.items()))
@@ -73,7 +73,7 @@ def setup():
         scripts = [os.path.join(scripts_dir, f)
                    for f in os.listdir(scripts_dir)
                    if not f.endswith('.bat')]
-    packages = ['polyphemus']
+    packages = ['polyphemus', 'polyphemus.tests']
     pack_dir = {'polyphemus': 'polyphemus',}
     pack_data = {'polyphemus': ['templates/*.html'],}
     setup_kwargs = {